@@ -0,0 +1,118 @@
+import queue
+import threading
+import time
+import uuid
+
+from omr_engine import metrics
+
+
+class QueueFullError(Exception):
+    """Hàng đợi chấm bài đã đầy (server sẽ trả về 429)."""
+
+
+class GradingService:
+    """
+    Dịch vụ chấm bài bất đồng bộ:
+      - submit() đưa job vào hàng đợi có giới hạn và trả về job_id ngay lập tức
+      - một nhóm luồng worker lấy job ra chấm (dùng chung model đã tải trong tiến trình)
+      - get() cho phép client hỏi kết quả, có thể chờ (long-poll) tối đa `wait` giây
+    """
+
+    def __init__(self, num_workers=2, max_queue_size=64, result_ttl=600):
+        self.num_workers = num_workers
+        self.result_ttl = result_ttl
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._workers = []
+
+    def start(self):
+        """Khởi động các luồng worker (chỉ chạy 1 lần)."""
+        with self._lock:
+            if self._workers:
+                return
+            for i in range(self.num_workers):
+                worker = threading.Thread(target=self._worker_loop, name=f"grading-worker-{i}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit(self, func, *args):
+        """
+        Đưa 1 job vào hàng đợi. Ném QueueFullError nếu hàng đợi đầy.
+        """
+        self.start()
+        self._purge_expired()
+
+        job_id = uuid.uuid4().hex
+        job = {
+            "job_id": job_id,
+            "status": "queued",
+            "created_at": time.time(),
+            "finished_at": None,
+            "result": None,
+            "http_status": None,
+            "done": threading.Event(),
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+        try:
+            self._queue.put_nowait((job, func, args))
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(job_id, None)
+            metrics.record_error("queue_full")
+            raise QueueFullError("Hàng đợi chấm bài đã đầy, vui lòng thử lại sau.")
+        return job_id
+
+    def get(self, job_id, wait=0):
+        """
+        Lấy trạng thái job (None nếu không tồn tại).
+        Nếu wait > 0 và job chưa xong, chờ tối đa `wait` giây.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        if wait > 0:
+            job["done"].wait(timeout=wait)
+        return {
+            "job_id": job["job_id"],
+            "status": job["status"],
+            "queue_depth": self.queue_depth(),
+            "result": job["result"],
+            "http_status": job["http_status"],
+        }
+
+    def _worker_loop(self):
+        while True:
+            job, func, args = self._queue.get()
+            job["status"] = "running"
+            # Thời gian job nằm chờ trong hàng đợi
+            metrics.observe("omr_stage_seconds", time.time() - job["created_at"], stage="queue_wait")
+            try:
+                result, http_status = func(*args)
+                job["result"] = result
+                job["http_status"] = http_status
+                job["status"] = "done" if http_status == 200 else "failed"
+            except Exception as e:
+                print(f"LỖI NGHIÊM TRỌNG KHI CHẤM (job {job['job_id']}): {e}")
+                metrics.record_error(type(e).__name__)
+                job["result"] = {"error": f"Lỗi server nghiêm trọng: {str(e)}"}
+                job["http_status"] = 500
+                job["status"] = "failed"
+            finally:
+                job["finished_at"] = time.time()
+                job["done"].set()
+                self._queue.task_done()
+
+    def _purge_expired(self):
+        """Xóa kết quả của các job đã xong quá `result_ttl` giây."""
+        now = time.time()
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job["finished_at"] is not None and now - job["finished_at"] > self.result_ttl]
+            for job_id in expired:
+                del self._jobs[job_id]
@@ -1,141 +1,613 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, g, request, jsonify, render_template, stream_with_context
 import os
+import csv
+import io
 import json
-import uuid 
+import time
+import zipfile
+
+import numpy as np
 
 import sys
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(BASE_DIR)
 
-from omr_engine.grader import grade_paper
+from omr_engine.grader import grade_bytes
+from omr_engine.model_loader import warm_up, is_model_loaded
+from omr_engine import metrics
+from omr_engine.answer_key_store import AnswerKeyStore, is_valid_test_id
+from omr_engine.template_registry import AUTO_TEMPLATE, TemplateError, get_template, list_templates
+from omr_engine.batch_grader import grade_uploads, iter_zip_images, result_source, zip_image_names
+from omr_engine.scoring import item_analysis
+from omr_engine.results_store import DEFAULT_SESSION, EXPORT_COLUMNS, ResultsStore
+from app.grading_service import GradingService, QueueFullError
 
 # --- CẤU HÌNH ---
 app = Flask(__name__, template_folder='templates')
 
-UPLOAD_FOLDER = os.path.join(BASE_DIR, 'data', 'uploads')
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Cấu hình hàng đợi chấm bài bất đồng bộ (/jobs)
+GRADING_WORKERS = int(os.environ.get('OMR_GRADING_WORKERS', 2))
+GRADING_QUEUE_SIZE = int(os.environ.get('OMR_GRADING_QUEUE_SIZE', 64))
+JOB_RESULT_TTL_SECONDS = int(os.environ.get('OMR_JOB_RESULT_TTL', 600))
+MAX_JOB_WAIT_SECONDS = 30
+RETRY_AFTER_SECONDS = 5
 
+# Kho đáp án: giới hạn số đáp án trong bộ nhớ, và thư mục lưu trữ (dùng chung giữa các tiến trình,
+# giữ lại sau khi khởi động lại). OMR_ANSWER_KEY_DIR= (rỗng) để chỉ giữ trong bộ nhớ.
+ANSWER_KEY_CACHE_SIZE = int(os.environ.get('OMR_ANSWER_KEY_CACHE_SIZE', 128))
+ANSWER_KEY_DIR = os.environ.get('OMR_ANSWER_KEY_DIR', os.path.join(BASE_DIR, 'data', 'answer_keys')) or None
 
-def save_temp_file(file):
-    """Hàm tiện ích: Lưu file tạm và trả về đường dẫn"""
-    ext = os.path.splitext(file.filename)[1]
-    temp_filename = str(uuid.uuid4()) + ext
-    temp_path = os.path.join(UPLOAD_FOLDER, temp_filename)
-    file.save(temp_path)
-    return temp_path
+# Trả về header Server-Timing (thời gian từng bước) cho mọi request; hoặc chỉ khi request có ?timing=1
+SERVER_TIMING_HEADERS = os.environ.get('OMR_SERVER_TIMING', '0') == '1'
+# Chỉ bật trình gỡ lỗi của Flask khi chạy thử trên máy (OMR_DEBUG=1): nó cho chạy mã tùy ý từ trình duyệt
+DEBUG = os.environ.get('OMR_DEBUG', '0') == '1'
 
-# --- TRANG CHỦ ---
-@app.route('/', methods=['GET'])
-def index():
-    return render_template('index.html')
+# Chấm cả lớp trong 1 request (/grade_class): giới hạn số bài làm mỗi request
+MAX_CLASS_SHEETS = int(os.environ.get('OMR_MAX_CLASS_SHEETS', 500))
+
+# Kho kết quả đã chấm (SQLite): mọi bài làm chấm qua /grade, /jobs, /grade_class được lưu lại để truy vấn sau.
+# OMR_RESULTS_DB= (rỗng) để tắt.
+RESULTS_DB_PATH = os.environ.get('OMR_RESULTS_DB', os.path.join(BASE_DIR, 'data', 'omr_results.sqlite3'))
+RESULTS_PAGE_SIZE = 100
+MAX_RESULTS_PAGE_SIZE = 10000
+
+answer_key_store = AnswerKeyStore(max_entries=ANSWER_KEY_CACHE_SIZE, persist_dir=ANSWER_KEY_DIR)
+results_store = ResultsStore(RESULTS_DB_PATH) if RESULTS_DB_PATH else None
+grading_service = GradingService(num_workers=GRADING_WORKERS,
+                                 max_queue_size=GRADING_QUEUE_SIZE,
+                                 result_ttl=JOB_RESULT_TTL_SECONDS)
+
+metrics.register_gauge("omr_grading_queue_depth", grading_service.queue_depth, "Số job đang chờ trong hàng đợi /jobs")
+metrics.register_gauge("omr_answer_keys_cached", lambda: len(answer_key_store.list_keys()),
+                       "Số đáp án đang nằm trong bộ nhớ")
+metrics.register_gauge("omr_model_loaded", lambda: int(is_model_loaded()), "Model đã được tải hay chưa")
+if results_store is not None:
+    metrics.register_gauge("omr_results_pending_writes", results_store.pending,
+                           "Số kết quả đang chờ ghi vào kho kết quả")
+
+
+def read_upload(file):
+    """Hàm tiện ích: Đọc toàn bộ file upload vào bộ nhớ (không ghi ra đĩa)"""
+    return file.read()
+
+def get_requested_template():
+    """
+    Lấy tên mẫu phiếu từ trường 'template' (bỏ trống = mẫu mặc định, "auto" = tự nhận diện).
+    Trả về (template, error_response).
+    """
+    template = request.form.get('template', '').strip() or None
+    if template is not None and template != AUTO_TEMPLATE:
+        try:
+            get_template(template)
+        except TemplateError as e:
+            return None, (jsonify({"error": str(e)}), 400)
+    return template, None
+
+def get_requested_session():
+    """Kỳ thi / buổi chấm (trường 'session') để nhóm kết quả trong kho kết quả."""
+    return request.form.get('session', '').strip() or DEFAULT_SESSION
+
+def get_answer_key_upload():
+    """
+    Lấy đáp án từ request: hoặc file 'answer_key_image', hoặc trường 'answer_key_test_id'
+    (mã đề của đáp án đã đăng ký trước qua /answer_keys).
+    Trả về (answer_key, error_response), answer_key là dict {"bytes", "filename", "test_id"}.
+    """
+    key_test_id = request.form.get('answer_key_test_id', '').strip()
+    if key_test_id:
+        return {"bytes": None, "filename": None, "test_id": key_test_id}, None
 
-# --- API CHẤM ĐIỂM (ĐÃ SỬA) ---
-@app.route('/grade', methods=['POST'])
-def grade_exam():
-    """API nhận 2 ảnh, chấm điểm, và kiểm tra Mã đề."""
-    
     if 'answer_key_image' not in request.files:
-        return jsonify({"error": "Không có file 'Ảnh Đáp Án'."}), 400
+        return None, (jsonify({"error": "Không có file 'Ảnh Đáp Án'."}), 400)
     answer_key_file = request.files['answer_key_image']
     if answer_key_file.filename == '':
-        return jsonify({"error": "Chưa chọn file 'Ảnh Đáp Án'."}), 400
+        return None, (jsonify({"error": "Chưa chọn file 'Ảnh Đáp Án'."}), 400)
+    return {"bytes": read_upload(answer_key_file), "filename": answer_key_file.filename, "test_id": None}, None
+
+def get_uploaded_files():
+    """
+    Kiểm tra và lấy đáp án và file 'student_image' từ request.
+    Trả về (answer_key, student_file, error_response).
+    """
+    answer_key, error_response = get_answer_key_upload()
+    if error_response is not None:
+        return None, None, error_response
         
     if 'student_image' not in request.files:
-        return jsonify({"error": "Không có file 'Ảnh Bài Làm'."}), 400
+        return None, None, (jsonify({"error": "Không có file 'Ảnh Bài Làm'."}), 400)
     student_file = request.files['student_image']
     if student_file.filename == '':
-        return jsonify({"error": "Chưa chọn file 'Ảnh Bài Làm'."}), 400
+        return None, None, (jsonify({"error": "Chưa chọn file 'Ảnh Bài Làm'."}), 400)
 
-    temp_key_path = None
-    temp_student_path = None
-    
+    return answer_key, student_file, None
+
+# --- ĐO THỜI GIAN REQUEST (/metrics + header Server-Timing) ---
+@app.before_request
+def start_request_metrics():
+    if metrics.ENABLED:
+        g.request_start = time.perf_counter()
+        metrics.start_request_timing()
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.get('request_start')
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unknown"
+    metrics.observe("omr_http_request_seconds", elapsed, endpoint=endpoint)
+    metrics.inc("omr_http_requests_total", endpoint=endpoint, status=str(response.status_code))
+
+    if SERVER_TIMING_HEADERS or request.args.get('timing') == '1':
+        timings = dict(metrics.request_timings() or {})
+        timings["total"] = elapsed
+        response.headers['Server-Timing'] = metrics.server_timing_header(timings)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def export_metrics():
+    """Số liệu theo định dạng Prometheus: thời gian từng bước, số lần gọi model, lỗi, hàng đợi..."""
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+# --- TRANG CHỦ ---
+@app.route('/', methods=['GET'])
+def index():
+    return render_template('index.html')
+
+# --- LOGIC CHẤM ĐIỂM (DÙNG CHUNG CHO /grade VÀ /jobs) ---
+def resolve_answer_key(answer_key, template=None):
+    """
+    Lấy đáp án từ kho (theo mã đề hoặc theo nội dung ảnh); chỉ đọc bằng model khi chưa có trong kho.
+    Trả về (key_result, error_result): error_result là (dict lỗi, mã HTTP) hoặc None.
+    """
+    if answer_key["test_id"]:
+        key_result = answer_key_store.get_by_test_id(answer_key["test_id"])
+        if key_result is None:
+            return None, ({"error": f"Chưa đăng ký đáp án cho mã đề '{answer_key['test_id']}'."}, 404)
+        return key_result, None
+
+    print(f"--- Đang đọc đáp án từ: {answer_key['filename']} ---")
+    key_result, error = answer_key_store.get_or_extract(answer_key["bytes"], answer_key["filename"], template)
+    if error is not None:
+        return None, ({"error": f"Không thể đọc file đáp án: {error}"}, 500)
+    return key_result, None
+
+def get_key_marks(key_result, template=None):
+    """
+    Đáp án dạng mảng bool và mẫu phiếu của nó (bài làm phải đọc theo đúng mẫu phiếu này).
+    Trả về (key_template, key_marks, error_result): error_result là (dict lỗi, mã HTTP) hoặc None.
+    """
     try:
-        temp_key_path = save_temp_file(answer_key_file)
-        temp_student_path = save_temp_file(student_file)
+        key_template, key_marks = answer_key_store.get_marks(key_result)
+    except TemplateError as e:
+        return None, None, ({"error": f"Không thể dùng đáp án: {e}"}, 500)
+    if template not in (None, AUTO_TEMPLATE) and template != key_template.name:
+        return None, None, ({"error": f"Yêu cầu mẫu phiếu '{template}' nhưng đáp án dùng mẫu phiếu "
+                                      f"'{key_template.name}'."}, 400)
+    return key_template, key_marks, None
 
-        # 1. Đọc ảnh đáp án
-        print(f"--- Đang đọc đáp án từ: {answer_key_file.filename} ---")
-        key_result = grade_paper(temp_key_path, answer_key=None) 
-        
-        if key_result.get("status") != "success":
-            os.remove(temp_key_path)
-            os.remove(temp_student_path)
-            return jsonify({"error": f"Không thể đọc file đáp án: {key_result.get('error')}"}), 500
-
-        key_test_id = key_result.get("test_id", "ERROR_KEY")
-        extracted_answer_key_list = list(key_result['student_answers'].values())
-
-        # 2. Đọc ảnh bài làm (chưa chấm)
-        print(f"--- Đang đọc bài làm: {student_file.filename} ---")
-        student_read_result = grade_paper(temp_student_path, answer_key=None)
-
-        if student_read_result.get("status") != "success":
-             os.remove(temp_key_path)
-             os.remove(temp_student_path)
-             return jsonify({"error": f"Không thể đọc file bài làm: {student_read_result.get('error')}"}), 500
-
-        student_test_id = student_read_result.get("test_id", "ERROR_STUDENT")
-        student_sbd = student_read_result.get("sbd", "ERROR_SBD")
-        student_answers_dict = student_read_result.get("student_answers", {})
-
-        # 3. --- LOGIC KIỂM TRA MÃ ĐỀ ---
-        test_id_mismatch = False
-        # Chỉ kiểm tra nếu cả 2 mã đề đọc được và không chứa lỗi/bỏ trống ('X')
-        if ("ERROR" not in [key_test_id, student_test_id] and 
+def save_answer_key(key_result, key_template, key_marks):
+    """Lưu đáp án vào kho kết quả (1 lần / đáp án), để phân tích câu hỏi sau này."""
+    if results_store is not None:
+        results_store.add_key(key_result.get("key_hash"), key_marks, key_template, key_result.get("test_id"))
+
+def save_graded_sheet(result, session, source, key_result, key_template, answer_marks=None):
+    """Lưu 1 bài làm đã chấm vào kho kết quả (ghi theo lô ở luồng nền, không làm chậm request)."""
+    if results_store is None:
+        return
+    try:
+        results_store.add(result, session, source, key_result.get("key_hash"), answer_marks, key_template)
+    except Exception as e:
+        print(f"Cảnh báo: Không lưu được kết quả của {source}: {e}")
+        metrics.record_error("results_store_error")
+
+def is_test_id_mismatch(key_test_id, student_test_id):
+    """Chỉ báo sai mã đề nếu cả 2 mã đề đọc được và không chứa lỗi/bỏ trống ('X')."""
+    return ("ERROR" not in [key_test_id, student_test_id] and
             "X" not in key_test_id and "X" not in student_test_id and
-            key_test_id != student_test_id):
-             test_id_mismatch = True
-        # --- KẾT THÚC KIỂM TRA ---
-
-        # 4. TÍNH ĐIỂM
-        final_result = {
-             "status": "success",
-             "sbd": student_sbd,
-             "test_id": student_test_id,
-             "student_answers": student_answers_dict,
-             "answer_key_info": { # Thông tin từ phiếu đáp án
-                  "read_from_image": answer_key_file.filename,
-                  "sbd": key_result.get("sbd"),
-                  "test_id": key_test_id,
-                  "student_answers": key_result.get("student_answers")
-             },
-             "test_id_mismatch": test_id_mismatch # Thêm cờ báo lỗi
-        }
-
-        if test_id_mismatch:
-             # GHI ĐÈ ĐIỂM = 0 NẾU SAI MÃ ĐỀ
-             final_result["total_questions"] = len(extracted_answer_key_list)
-             final_result["total_correct"] = 0
-             final_result["score_10"] = 0.0
-        else:
-             # Nếu mã đề khớp (hoặc không thể so sánh), tiến hành chấm điểm
-             total_correct = 0
-             num_questions = len(extracted_answer_key_list)
-             
-             for i in range(num_questions):
-                 # So sánh đáp án của học sinh (từ dict) và đáp án key (từ list)
-                 if student_answers_dict.get(i) == extracted_answer_key_list[i]:
-                      total_correct += 1
-             
-             score = (total_correct / num_questions) * 10.0 if num_questions > 0 else 0.0
-             final_result["total_questions"] = num_questions
-             final_result["total_correct"] = total_correct
-             final_result["score_10"] = round(score, 2)
-
-        # 5. Xóa file tạm và trả kết quả
-        os.remove(temp_key_path)
-        os.remove(temp_student_path)
-        return jsonify(final_result)
+            key_test_id != student_test_id)
+
+def grade_key_and_student(answer_key, student_bytes, student_filename, template=None, session=None):
+    """
+    Lấy đáp án, đọc bài làm và chấm điểm (cả 2 phiếu đọc theo mẫu phiếu `template`).
+    Kết quả được lưu vào kho kết quả theo kỳ thi `session`.
+    Trả về (kết quả dạng dict, mã HTTP).
+    """
+    # 1. Lấy đáp án (từ kho đáp án, hoặc đọc ảnh nếu chưa có)
+    key_result, error_result = resolve_answer_key(answer_key, template)
+    if error_result is not None:
+        return error_result
+
+    key_test_id = key_result.get("test_id", "ERROR_KEY")
+    # Đáp án dạng mảng bool (chuyển 1 lần / đáp án, nằm sẵn trong kho); bài làm đọc theo đúng mẫu phiếu của đáp án
+    key_template, key_marks, error_result = get_key_marks(key_result, template)
+    if error_result is not None:
+        return error_result
+
+    # 2. Đọc và chấm ảnh bài làm (so sánh bằng mảng, không so sánh chuỗi)
+    print(f"--- Đang đọc bài làm: {student_filename} ---")
+    student_read_result = grade_bytes(student_bytes, answer_key=key_marks, template=key_template)
+
+    if "quality" in student_read_result:
+        # Ảnh bị từ chối ở bước kiểm tra chất lượng: lỗi của ảnh gửi lên, không phải lỗi server
+        return {"error": f"Ảnh bài làm không đạt chất lượng: {student_read_result['error']}",
+                "quality": student_read_result["quality"]}, 422
+    if student_read_result.get("status") != "success":
+        return {"error": f"Không thể đọc file bài làm: {student_read_result.get('error')}"}, 500
+
+    student_test_id = student_read_result.get("test_id", "ERROR_STUDENT")
+    student_sbd = student_read_result.get("sbd", "ERROR_SBD")
+
+    # 3. --- LOGIC KIỂM TRA MÃ ĐỀ ---
+    test_id_mismatch = is_test_id_mismatch(key_test_id, student_test_id)
+
+    # 4. TÍNH ĐIỂM (đã chấm ở bước 2)
+    final_result = {
+         "status": "success",
+         "template": key_template.name,
+         "sbd": student_sbd,
+         "test_id": student_test_id,
+         "student_answers": student_read_result.get("student_answers", {}),
+         "answer_key_info": { # Thông tin từ phiếu đáp án
+              "read_from_image": key_result.get("read_from_image"),
+              "key_hash": key_result.get("key_hash"),
+              "sbd": key_result.get("sbd"),
+              "test_id": key_test_id,
+              "student_answers": key_result.get("student_answers")
+         },
+         "test_id_mismatch": test_id_mismatch, # Thêm cờ báo lỗi
+         "total_questions": student_read_result["total_questions"],
+         "total_blank": student_read_result["total_blank"],
+         "total_multi_marked": student_read_result["total_multi_marked"],
+    }
+
+    if test_id_mismatch:
+         # GHI ĐÈ ĐIỂM = 0 NẾU SAI MÃ ĐỀ
+         final_result["total_correct"] = 0
+         final_result["score_10"] = 0.0
+    else:
+         # Nếu mã đề khớp (hoặc không thể so sánh), giữ điểm đã chấm
+         final_result["total_correct"] = student_read_result["total_correct"]
+         final_result["score_10"] = student_read_result["score_10"]
+
+    # 5. Lưu vào kho kết quả
+    save_answer_key(key_result, key_template, key_marks)
+    save_graded_sheet(final_result, session, student_filename, key_result, key_template)
+    return final_result, 200
+
+# --- API CHẤM ĐIỂM (ĐÃ SỬA) ---
+@app.route('/grade', methods=['POST'])
+def grade_exam():
+    """API nhận 2 ảnh, chấm điểm, và kiểm tra Mã đề."""
+    
+    answer_key, student_file, error_response = get_uploaded_files()
+    if error_response is not None:
+        return error_response
+    template, error_response = get_requested_template()
+    if error_response is not None:
+        return error_response
+
+    try:
+        # Giải mã ảnh trực tiếp từ request, không cần file tạm
+        result, http_status = grade_key_and_student(answer_key, read_upload(student_file), student_file.filename,
+                                                    template, get_requested_session())
+        return jsonify(result), http_status
         
     except Exception as e:
-        if temp_key_path and os.path.exists(temp_key_path):
-            os.remove(temp_key_path)
-        if temp_student_path and os.path.exists(temp_student_path):
-            os.remove(temp_student_path)
         print(f"LỖI NGHIÊM TRỌNG KHI CHẤM: {e}")
+        metrics.record_error(type(e).__name__)
         # Thêm str(e) để hiển thị lỗi rõ hơn trên web
         return jsonify({"error": f"Lỗi server nghiêm trọng: {str(e)}"}), 500
 
+# --- API CHẤM CẢ LỚP (1 ĐÁP ÁN, NHIỀU BÀI LÀM) ---
+def get_class_uploads():
+    """
+    Lấy các bài làm của cả lớp: nhiều file 'student_images' và/hoặc 1 file zip 'student_zip'.
+    Trả về (uploads, num_sheets, error_response): uploads là generator các cặp (tên file, bytes).
+    Dữ liệu upload được đọc vào bộ nhớ ngay (file upload bị đóng khi hàm xử lý request trả về,
+    trước khi luồng kết quả chạy xong); ảnh trong zip chỉ được giải nén khi đường ống chấm cần tới.
+    File PDF / TIFF nhiều trang được tách thành từng trang ngay trong đường ống chấm (num_sheets đếm theo file).
+    """
+    student_files = [(f.filename, read_upload(f)) for f in request.files.getlist('student_images') if f.filename != '']
+    archive, zip_names = None, []
+    zip_file = request.files.get('student_zip')
+    if zip_file is not None and zip_file.filename != '':
+        try:
+            archive = zipfile.ZipFile(io.BytesIO(read_upload(zip_file)))
+        except zipfile.BadZipFile:
+            return None, 0, (jsonify({"error": "File 'student_zip' không phải file zip hợp lệ."}), 400)
+        zip_names = zip_image_names(archive)
+
+    num_sheets = len(student_files) + len(zip_names)
+    if num_sheets == 0:
+        return None, 0, (jsonify({"error": "Không có ảnh bài làm ('student_images' hoặc 'student_zip')."}), 400)
+    if num_sheets > MAX_CLASS_SHEETS:
+        return None, 0, (jsonify({"error": f"Quá nhiều bài làm: {num_sheets} (tối đa {MAX_CLASS_SHEETS})."}), 413)
+
+    def uploads():
+        yield from student_files
+        if archive is not None:
+            yield from iter_zip_images(archive, zip_names)
+    return uploads(), num_sheets, None
+
+def class_student_result(result, key_test_id):
+    """Kết quả 1 bài làm trong /grade_class (cùng quy tắc sai mã đề = 0 điểm như /grade)."""
+    if result.get("status") != "success":
+        line = {"type": "student", "file": result.get("file"), "status": "error", "error": result.get("error")}
+        for key in ("page", "quality"):
+            if result.get(key) is not None:
+                line[key] = result[key]
+        return line
+    result = dict(result, type="student")
+    result["test_id_mismatch"] = is_test_id_mismatch(key_test_id, result["test_id"])
+    if result["test_id_mismatch"]:
+        result["total_correct"] = 0
+        result["score_10"] = 0.0
+    return result
+
+def stream_class_results(uploads, num_sheets, key_result, key_template, key_marks, session=None):
+    """
+    Chấm cả lớp theo lô (gộp nhiều bài làm vào 1 lần gọi model) và sinh ra từng dòng NDJSON
+    ngay khi chấm xong; dòng cuối là tổng kết cả lớp (điểm + phân tích từng câu hỏi).
+    Mọi bài làm chấm được đều được lưu vào kho kết quả theo kỳ thi `session`.
+    """
+    start = time.perf_counter()
+    key_test_id = key_result.get("test_id", "ERROR_KEY")
+    marks, scores = [], []
+    num_failed = num_mismatch = 0
+    save_answer_key(key_result, key_template, key_marks)
+    try:
+        for result in grade_uploads(uploads, answer_key=key_marks, template=key_template, keep_marks=True):
+            answer_marks = result.pop("answer_marks", None)
+            line = class_student_result(result, key_test_id)
+            if line["status"] != "success":
+                num_failed += 1
+            else:
+                save_graded_sheet(line, session, result_source(line), key_result, key_template, answer_marks)
+                if line["test_id_mismatch"]:
+                    num_mismatch += 1 # Bài làm sai mã đề không tính vào thống kê của lớp
+                else:
+                    marks.append(answer_marks)
+                    scores.append(line["score_10"])
+            yield json.dumps(line, ensure_ascii=False) + "\n"
+    except Exception as e:
+        print(f"LỖI NGHIÊM TRỌNG KHI CHẤM CẢ LỚP: {e}")
+        metrics.record_error(type(e).__name__)
+        yield json.dumps({"type": "error", "error": f"Lỗi server nghiêm trọng: {str(e)}"}, ensure_ascii=False) + "\n"
+        return
+
+    scores = np.asarray(scores, dtype=np.float64)
+    summary = {
+        "type": "summary",
+        "template": key_template.name,
+        "answer_key_info": {
+            "read_from_image": key_result.get("read_from_image"),
+            "key_hash": key_result.get("key_hash"),
+            "test_id": key_test_id,
+        },
+        "num_students": len(scores) + num_failed + num_mismatch, # File PDF / TIFF nhiều trang: mỗi trang 1 bài
+        "num_graded": len(scores),
+        "num_failed": num_failed,
+        "num_test_id_mismatch": num_mismatch,
+        "mean_score_10": round(float(scores.mean()), 2) if len(scores) else None,
+        "min_score_10": round(float(scores.min()), 2) if len(scores) else None,
+        "max_score_10": round(float(scores.max()), 2) if len(scores) else None,
+        "item_analysis": item_analysis(np.stack(marks) if marks else np.zeros((0,) + key_marks.shape, dtype=bool),
+                                       key_marks, key_template.options),
+        "elapsed_seconds": round(time.perf_counter() - start, 3),
+    }
+    yield json.dumps(summary, ensure_ascii=False) + "\n"
+
+@app.route('/grade_class', methods=['POST'])
+def grade_class():
+    """
+    Chấm cả lớp trong 1 request: 1 đáp án ('answer_key_image' hoặc 'answer_key_test_id')
+    + nhiều bài làm ('student_images' và/hoặc 'student_zip').
+    Trả về luồng NDJSON (application/x-ndjson): mỗi dòng 1 bài làm, dòng cuối là tổng kết cả lớp.
+    """
+    answer_key, error_response = get_answer_key_upload()
+    if error_response is not None:
+        return error_response
+    template, error_response = get_requested_template()
+    if error_response is not None:
+        return error_response
+    uploads, num_sheets, error_response = get_class_uploads()
+    if error_response is not None:
+        return error_response
+
+    # Đọc đáp án 1 lần trước khi bắt đầu trả kết quả (lỗi đáp án vẫn trả về mã HTTP bình thường)
+    try:
+        key_result, error_result = resolve_answer_key(answer_key, template)
+        if error_result is None:
+            key_template, key_marks, error_result = get_key_marks(key_result, template)
+    except Exception as e:
+        print(f"LỖI NGHIÊM TRỌNG KHI ĐỌC ĐÁP ÁN: {e}")
+        metrics.record_error(type(e).__name__)
+        return jsonify({"error": f"Lỗi server nghiêm trọng: {str(e)}"}), 500
+    if error_result is not None:
+        return jsonify(error_result[0]), error_result[1]
+
+    print(f"--- Đang chấm {num_sheets} bài làm theo đáp án: {key_result.get('read_from_image') or key_result.get('test_id')} ---")
+    stream = stream_class_results(uploads, num_sheets, key_result, key_template, key_marks, get_requested_session())
+    return Response(stream_with_context(stream), mimetype='application/x-ndjson')
+
+# --- API CHẤM ĐIỂM BẤT ĐỒNG BỘ (HÀNG ĐỢI + WORKER) ---
+@app.route('/jobs', methods=['POST'])
+def submit_grading_job():
+    """
+    Nhận 2 ảnh giống /grade nhưng KHÔNG chờ chấm xong:
+    trả về job_id ngay (202), hoặc 429 nếu hàng đợi đầy.
+    """
+    answer_key, student_file, error_response = get_uploaded_files()
+    if error_response is not None:
+        return error_response
+    template, error_response = get_requested_template()
+    if error_response is not None:
+        return error_response
+
+    try:
+        job_id = grading_service.submit(grade_key_and_student, answer_key, read_upload(student_file),
+                                        student_file.filename, template, get_requested_session())
+    except QueueFullError as e:
+        response = jsonify({"error": str(e), "queue_depth": grading_service.queue_depth()})
+        response.headers['Retry-After'] = str(RETRY_AFTER_SECONDS)
+        return response, 429
+
+    return jsonify({"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_grading_job(job_id):
+    """
+    Lấy kết quả job. Tham số ?wait=N để chờ (long-poll) tối đa N giây.
+    """
+    try:
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        return jsonify({"error": "Tham số 'wait' không hợp lệ."}), 400
+    wait = min(max(wait, 0.0), MAX_JOB_WAIT_SECONDS)
+
+    job = grading_service.get(job_id, wait=wait)
+    if job is None:
+        return jsonify({"error": "Không tìm thấy job (hoặc kết quả đã hết hạn)."}), 404
+    return jsonify(job), 200
+
+# --- API KHO ĐÁP ÁN ---
+@app.route('/answer_keys', methods=['POST'])
+def register_answer_key():
+    """
+    Đăng ký 1 phiếu đáp án: đọc 1 lần rồi lưu vào kho.
+    Các request sau chỉ cần gửi 'answer_key_test_id' thay vì upload lại ảnh đáp án.
+    """
+    if 'answer_key_image' not in request.files or request.files['answer_key_image'].filename == '':
+        return jsonify({"error": "Không có file 'Ảnh Đáp Án'."}), 400
+    answer_key_file = request.files['answer_key_image']
+    template, error_response = get_requested_template()
+    if error_response is not None:
+        return error_response
+
+    try:
+        key_result, error = answer_key_store.get_or_extract(read_upload(answer_key_file), answer_key_file.filename,
+                                                            template)
+    except Exception as e:
+        print(f"LỖI NGHIÊM TRỌNG KHI ĐỌC ĐÁP ÁN: {e}")
+        metrics.record_error(type(e).__name__)
+        return jsonify({"error": f"Lỗi server nghiêm trọng: {str(e)}"}), 500
+    if error is not None:
+        return jsonify({"error": f"Không thể đọc file đáp án: {error}"}), 500
+
+    response = dict(key_result)
+    response["status"] = "success"
+    response["test_id_registered"] = is_valid_test_id(key_result["test_id"])
+    return jsonify(response), 201
+
+@app.route('/answer_keys', methods=['GET'])
+def list_answer_keys():
+    """Danh sách các đáp án đang được lưu trong bộ nhớ."""
+    return jsonify({"answer_keys": answer_key_store.list_keys()}), 200
+
+@app.route('/answer_keys/<test_id>', methods=['GET'])
+def get_answer_key(test_id):
+    """Xem đáp án đã đăng ký theo mã đề."""
+    key_result = answer_key_store.get_by_test_id(test_id)
+    if key_result is None:
+        return jsonify({"error": f"Chưa đăng ký đáp án cho mã đề '{test_id}'."}), 404
+    return jsonify(key_result), 200
+
+# --- API MẪU PHIẾU ---
+@app.route('/templates', methods=['GET'])
+def list_sheet_templates():
+    """Danh sách các mẫu phiếu có thể chọn qua trường 'template' (hoặc "auto")."""
+    templates = []
+    for name in list_templates():
+        try:
+            templates.append(get_template(name).describe())
+        except TemplateError as e:
+            templates.append({"name": name, "error": str(e)})
+    return jsonify({"default": get_template().name, "auto": AUTO_TEMPLATE, "templates": templates}), 200
+
+# --- API KHO KẾT QUẢ (TRUY VẤN / XUẤT, KHÔNG CHẤM LẠI) ---
+# Kết quả được ghi theo lô ở luồng nền: bài vừa chấm xuất hiện sau tối đa ~0.5 giây.
+def get_results_store():
+    """Trả về (results_store, error_response)."""
+    if results_store is None:
+        return None, (jsonify({"error": "Kho kết quả đang tắt (OMR_RESULTS_DB)."}), 503)
+    return results_store, None
+
+def get_results_filters():
+    """Bộ lọc ?session=&test_id=&sbd= (bỏ trống = không lọc)."""
+    return {name: request.args.get(name, '').strip() or None for name in ('session', 'test_id', 'sbd')}
+
+@app.route('/results/sessions', methods=['GET'])
+def list_result_sessions():
+    """Các kỳ thi đã lưu và số phiếu của từng kỳ thi."""
+    store, error_response = get_results_store()
+    if error_response is not None:
+        return error_response
+    return jsonify({"sessions": store.sessions()}), 200
+
+@app.route('/results', methods=['GET'])
+def export_results():
+    """
+    Kết quả đã chấm, lọc theo ?session=&test_id=&sbd=.
+    ?format=csv: xuất toàn bộ (luồng CSV, đọc từng khối từ kho); mặc định JSON có phân trang (?limit=&offset=).
+    """
+    store, error_response = get_results_store()
+    if error_response is not None:
+        return error_response
+    filters = get_results_filters()
+
+    if request.args.get('format') == 'csv':
+        def rows():
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+            writer.writeheader()
+            for count, record in enumerate(store.query(**filters), 1):
+                writer.writerow(record)
+                if count % 1000 == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+        filename = f"results_{filters['session'] or 'all'}.csv"
+        return Response(stream_with_context(rows()), mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+    try:
+        limit = min(max(int(request.args.get('limit', RESULTS_PAGE_SIZE)), 1), MAX_RESULTS_PAGE_SIZE)
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return jsonify({"error": "Tham số 'limit' / 'offset' không hợp lệ."}), 400
+    return jsonify({"total": store.count(**filters), "limit": limit, "offset": offset,
+                    "results": list(store.query(**filters, limit=limit, offset=offset))}), 200
+
+@app.route('/results/summary', methods=['GET'])
+def summarize_results():
+    """Thống kê điểm theo từng mã đề của 1 kỳ thi (?session=&test_id=)."""
+    store, error_response = get_results_store()
+    if error_response is not None:
+        return error_response
+    filters = get_results_filters()
+    return jsonify({"session": filters['session'],
+                    "test_ids": store.summary(filters['session'], filters['test_id'])}), 200
+
+@app.route('/results/item_stats', methods=['GET'])
+def result_item_stats():
+    """Phân tích từng câu hỏi (độ khó, độ phân biệt, phương án nhiễu) theo từng đáp án (?session=&test_id=)."""
+    store, error_response = get_results_store()
+    if error_response is not None:
+        return error_response
+    filters = get_results_filters()
+    start = time.perf_counter()
+    stats = store.item_stats(filters['session'], filters['test_id'])
+    return jsonify({"session": filters['session'], "answer_keys": stats,
+                    "elapsed_seconds": round(time.perf_counter() - start, 3)}), 200
+
 # --- Chạy server ---
+# `python app/main.py` chỉ để chạy thử (server của Flask). Chạy thật: `gunicorn app.main:app` từ thư mục
+# omr_project, cấu hình trong gunicorn.conf.py (hook post_fork gọi warm_up() để mỗi worker tải model đúng 1 lần).
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    # Chế độ debug bật reloader: tiến trình cha chỉ theo dõi file, tiến trình con (WERKZEUG_RUN_MAIN=true)
+    # mới phục vụ request -> chỉ tải model ở tiến trình con, không tải 2 lần
+    if not DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        warm_up()
+    app.run(host='0.0.0.0', port=5000, debug=DEBUG, threaded=True)
@@ -0,0 +1,22 @@
+import os
+
+# --- CHẠY SERVER THẬT BẰNG GUNICORN ---
+# Từ thư mục omr_project:  gunicorn app.main:app
+# (gunicorn tự đọc file cấu hình này). Không bật trình gỡ lỗi của Flask, worker tải model đúng 1 lần.
+
+bind = os.environ.get('OMR_BIND', '0.0.0.0:5000')
+# CHỈ 1 tiến trình: trạng thái job chấm nền (/jobs, GradingService), bộ đếm /metrics và cache đáp án
+# nằm trong bộ nhớ của từng tiến trình. Nhiều worker thì GET /jobs/<id> có thể rơi vào worker khác -> 404.
+# Tăng khả năng phục vụ bằng `threads` (TensorFlow nhả GIL khi chạy model, đọc ảnh/nắn phiếu bằng OpenCV cũng vậy).
+workers = 1
+worker_class = 'gthread'
+threads = int(os.environ.get('OMR_WEB_THREADS', 8))
+timeout = int(os.environ.get('OMR_WEB_TIMEOUT', 300)) # Chấm file zip lớn có thể lâu
+# Không preload: mỗi worker tự import app sau khi fork (model TensorFlow và các luồng nền không đi qua fork)
+preload_app = False
+
+
+def post_fork(server, worker):
+    """Tải model + chạy thử trong worker ngay sau khi fork, để request đầu tiên không phải chờ."""
+    from omr_engine.model_loader import warm_up
+    warm_up()
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from .grader import grade_bytes
+from .scoring import answers_to_marks
+from .template_registry import get_template
+
+
+def content_hash(image_bytes, template=None):
+    """
+    Mã băm SHA-256 của nội dung file ảnh (dùng làm khóa cache).
+    Cùng 1 ảnh đọc theo mẫu phiếu khác nhau cho ra đáp án khác nhau -> tên mẫu được băm chung.
+    """
+    digest = hashlib.sha256(image_bytes)
+    if template is not None:
+        digest.update(b"\0template=" + str(template).encode("utf-8"))
+    return digest.hexdigest()
+
+def is_valid_test_id(test_id):
+    """Chỉ những mã đề đọc được đầy đủ (không lỗi, không bỏ trống 'X') mới được dùng làm khóa."""
+    return bool(test_id) and "ERROR" not in test_id and "X" not in test_id
+
+
+class AnswerKeyStore:
+    """
+    Kho đáp án đã đọc sẵn, để phiếu đáp án không phải chấm lại ở mỗi request.
+      - Tra cứu theo mã băm nội dung ảnh hoặc theo mã đề (test_id)
+      - Giới hạn số lượng, loại bỏ đáp án ít dùng nhất (LRU)
+      - Tùy chọn lưu xuống thư mục `persist_dir` (1 file JSON / đáp án) để dùng lại sau khi khởi động lại,
+        và để các tiến trình server dùng chung: tra mã đề không thấy trong bộ nhớ thì tìm tiếp trên đĩa
+    """
+
+    def __init__(self, max_entries=128, persist_dir=None):
+        self.max_entries = max_entries
+        self.persist_dir = persist_dir
+        self._entries = OrderedDict() # key_hash -> thông tin đáp án
+        self._by_test_id = {}         # test_id -> key_hash
+        self._marks = {}              # key_hash -> (template, mảng bool đáp án) đã chuyển sẵn để chấm
+        self._lock = threading.Lock()
+
+        if persist_dir:
+            os.makedirs(persist_dir, exist_ok=True)
+            self._load_persisted()
+
+    # --- TRA CỨU ---
+    def get_by_hash(self, key_hash):
+        with self._lock:
+            entry = self._entries.get(key_hash)
+            if entry is not None:
+                self._entries.move_to_end(key_hash)
+                return entry
+        entry = self._read_persisted(key_hash)
+        if entry is not None:
+            self._remember(entry)
+        return entry
+
+    def get_by_test_id(self, test_id):
+        with self._lock:
+            key_hash = self._by_test_id.get(test_id)
+        if key_hash is None:
+            # Có thể đáp án vừa được tiến trình khác (worker khác của server) lưu xuống đĩa
+            entry = self._find_persisted(test_id)
+            if entry is not None:
+                self._remember(entry)
+            return entry
+        return self.get_by_hash(key_hash)
+
+    def get_or_extract(self, image_bytes, filename=None, template=None):
+        """
+        Lấy đáp án từ cache theo nội dung ảnh (và mẫu phiếu yêu cầu); nếu chưa có thì đọc phiếu bằng model rồi lưu lại.
+        Trả về (thông tin đáp án, lỗi). lỗi là None nếu thành công.
+        """
+        key_hash = content_hash(image_bytes, template)
+        entry = self.get_by_hash(key_hash)
+        if entry is not None:
+            return entry, None
+
+        key_result = grade_bytes(image_bytes, answer_key=None, template=template)
+        if key_result.get("status") != "success":
+            return None, key_result.get("error")
+
+        entry = {
+            "key_hash": key_hash,
+            "read_from_image": filename,
+            "template": key_result.get("template"),
+            "sbd": key_result.get("sbd"),
+            "test_id": key_result.get("test_id"),
+            "student_answers": key_result.get("student_answers"),
+        }
+        self._remember(entry)
+        self._write_persisted(entry)
+        return entry, None
+
+    def get_marks(self, entry):
+        """
+        Đáp án dạng mảng bool (số câu, số lựa chọn) cùng mẫu phiếu của nó, chuyển từ chuỗi đúng 1 lần / đáp án.
+        Trả về (template, key_marks). Ném TemplateError nếu mẫu phiếu của đáp án không còn tồn tại.
+        """
+        key_hash = entry["key_hash"]
+        with self._lock:
+            cached = self._marks.get(key_hash)
+        if cached is not None:
+            return cached
+        # Đáp án lưu từ phiên bản cũ không ghi mẫu phiếu -> mẫu mặc định
+        template = get_template(entry.get("template"))
+        cached = (template, answers_to_marks(entry["student_answers"], template.options, template.num_questions))
+        with self._lock:
+            if key_hash in self._entries:
+                self._marks[key_hash] = cached
+        return cached
+
+    def list_keys(self):
+        """Danh sách tóm tắt các đáp án đang nằm trong bộ nhớ."""
+        with self._lock:
+            return [{"key_hash": e["key_hash"], "test_id": e["test_id"], "template": e.get("template"),
+                     "read_from_image": e["read_from_image"]}
+                    for e in self._entries.values()]
+
+    # --- LRU ---
+    def _remember(self, entry):
+        with self._lock:
+            key_hash = entry["key_hash"]
+            self._entries[key_hash] = entry
+            self._entries.move_to_end(key_hash)
+            if is_valid_test_id(entry["test_id"]):
+                self._by_test_id[entry["test_id"]] = key_hash
+
+            while len(self._entries) > self.max_entries:
+                old_hash, old_entry = self._entries.popitem(last=False)
+                self._marks.pop(old_hash, None)
+                if self._by_test_id.get(old_entry["test_id"]) == old_hash and not self.persist_dir:
+                    # Không có bản lưu trên đĩa -> bỏ luôn chỉ mục theo mã đề
+                    del self._by_test_id[old_entry["test_id"]]
+
+    # --- LƯU TRỮ TRÊN ĐĨA ---
+    def _persist_path(self, key_hash):
+        return os.path.join(self.persist_dir, f"{key_hash}.json")
+
+    def _write_persisted(self, entry):
+        if not self.persist_dir:
+            return
+        path = self._persist_path(entry["key_hash"])
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path) # Ghi nguyên tử: không bao giờ để lại file JSON dở dang
+
+    def _read_persisted(self, key_hash):
+        if not self.persist_dir:
+            return None
+        try:
+            with open(self._persist_path(key_hash), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # JSON đổi khóa số thành chuỗi -> đổi lại thành int như grade_paper trả về
+        entry["student_answers"] = {int(q): ans for q, ans in entry["student_answers"].items()}
+        return entry
+
+    def _persisted_names(self):
+        """Tên các file đáp án trong thư mục lưu trữ, cũ trước mới sau."""
+        files = [name for name in os.listdir(self.persist_dir) if name.endswith(".json")]
+        files.sort(key=lambda name: os.path.getmtime(os.path.join(self.persist_dir, name)))
+        return files
+
+    def _find_persisted(self, test_id):
+        """Đáp án MỚI NHẤT có mã đề `test_id` trong thư mục lưu trữ, hoặc None."""
+        if not self.persist_dir or not is_valid_test_id(test_id):
+            return None
+        try:
+            files = self._persisted_names()
+        except OSError:
+            return None
+        for name in reversed(files):
+            entry = self._read_persisted(name[:-len(".json")])
+            if entry is not None and entry.get("test_id") == test_id:
+                return entry
+        return None
+
+    def _load_persisted(self):
+        """Nạp chỉ mục mã đề và các đáp án mới nhất từ thư mục lưu trữ."""
+        for name in self._persisted_names():
+            entry = self._read_persisted(name[:-len(".json")])
+            if entry is None:
+                print(f"Cảnh báo: Bỏ qua file đáp án lỗi: {name}")
+                continue
+            self._remember(entry)
@@ -0,0 +1,365 @@
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+import numpy as np
+
+from . import metrics
+from .grader import (load_sheet, load_sheet_bytes, prepare_sheet, decode_target_size, check_sheet_quality,
+                     collect_sheet_rois, classify_bubbles, decode_sheet_marks, build_result, grade_paper)
+from .image_io import is_document, iter_document_pages
+from .answer_key_store import content_hash
+from .results_store import DEFAULT_SESSION, ResultsStore
+from .scoring import answers_to_marks, item_analysis
+from .template_registry import get_template
+
+# .pdf / .tif / .tiff có thể nhiều trang: mỗi trang là 1 phiếu (xem expand_documents)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.pdf')
+
+# Số phiếu gộp vào 1 lần gọi model (mỗi phiếu = 330 ô)
+DEFAULT_BATCH_SHEETS = 16
+# Số ảnh được đọc trước tối đa (giới hạn bộ nhớ)
+DEFAULT_PREFETCH = 8
+# Số luồng đọc/giải mã ảnh song song
+DEFAULT_DECODE_WORKERS = 2
+
+
+# --- 1. DUYỆT DANH SÁCH ẢNH ---
+def iter_image_paths(source):
+    """
+    Trả về danh sách đường dẫn ảnh (đã sắp xếp) từ 1 thư mục hoặc 1 mẫu glob.
+    """
+    if os.path.isdir(source):
+        names = sorted(entry.name for entry in os.scandir(source)
+                       if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS))
+        return [os.path.join(source, name) for name in names]
+    return sorted(p for p in glob.iglob(source) if p.lower().endswith(IMAGE_EXTENSIONS))
+
+def zip_image_names(archive):
+    """Tên các ảnh trong 1 zipfile.ZipFile đã mở (đã sắp xếp, bỏ thư mục và file ẩn/rác của macOS)."""
+    return sorted(info.filename for info in archive.infolist()
+                  if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS)
+                  and not os.path.basename(info.filename).startswith('.')
+                  and not info.filename.startswith('__MACOSX/'))
+
+def iter_zip_images(archive, names=None):
+    """
+    Duyệt các ảnh trong 1 zipfile.ZipFile đã mở, theo thứ tự tên.
+    Sinh ra (tên file trong zip, dữ liệu nhị phân); chỉ đọc từng ảnh khi cần.
+    """
+    for name in zip_image_names(archive) if names is None else names:
+        yield name, archive.read(name)
+
+def expand_documents(items, load, template=None):
+    """
+    Tách các tài liệu nhiều trang (PDF / TIFF của máy scan) thành từng trang, chỉ khi đường ống cần tới.
+    items: các cặp (tên, dữ liệu cho `load`). Sinh ra (tên, (hàm đọc, dữ liệu)) cho prefetch_sheets:
+      - ảnh thường: giữ nguyên (tên, (load, dữ liệu))
+      - mỗi trang tài liệu: ((tên file, số trang), (prepare_sheet, ảnh trang đã vẽ ở kích thước mẫu phiếu))
+    Trang được vẽ ở luồng gọi (PyMuPDF không an toàn đa luồng), prefetch_sheets giới hạn số trang trong bộ nhớ.
+    Tài liệu không đọc được (hỏng, thiếu PyMuPDF...) thành 1 kết quả lỗi, các file khác vẫn được chấm.
+    """
+    target_size = decode_target_size(template)
+    for name, data in items:
+        if not is_document(name):
+            yield name, (load, data)
+            continue
+        pages = iter_document_pages(name, data, target_size)
+        page_number = 0
+        while True:
+            try:
+                with metrics.stage("decode"):
+                    page_number, image = next(pages)
+            except StopIteration:
+                break
+            except Exception as e:
+                print(f"Lỗi khi đọc {name} (trang {page_number + 1}): {e}", file=sys.stderr)
+                yield (name, page_number + 1), (_document_error, str(e))
+                break
+            yield (name, page_number), (prepare_sheet, image)
+
+def _document_error(message, template=None):
+    metrics.record_error("document_error")
+    metrics.inc("omr_sheets_total", status="error")
+    return None, None, f"Không thể đọc tài liệu: {message}"
+
+def _load_item(item, template=None):
+    load, data = item
+    return load(data, template)
+
+def result_source(result):
+    """Nguồn của 1 kết quả: tên file, thêm "#page=N" với trang của tài liệu nhiều trang."""
+    if result.get("page") is None:
+        return result.get("file")
+    return f"{result.get('file')}#page={result['page']}"
+
+
+# --- 2. ĐỌC ẢNH TRƯỚC (PREFETCH) ---
+def prefetch_sheets(items, prefetch=DEFAULT_PREFETCH, workers=DEFAULT_DECODE_WORKERS, template=None,
+                    load=load_sheet):
+    """
+    Đọc, chọn mẫu phiếu và nắn ảnh ở các luồng nền, giữ đúng thứ tự đầu vào.
+    items: các cặp (tên, dữ liệu) với dữ liệu là thứ `load` nhận (đường dẫn cho load_sheet,
+    bytes cho load_sheet_bytes). Tối đa `prefetch` ảnh nằm trong bộ nhớ cùng lúc.
+    Sinh ra (tên, warped_gray, template, error).
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for path, data in items:
+            pending.append((path, pool.submit(load, data, template)))
+            if len(pending) >= prefetch:
+                done_path, future = pending.popleft()
+                yield (done_path,) + future.result()
+        while pending:
+            done_path, future = pending.popleft()
+            yield (done_path,) + future.result()
+
+
+# --- 3. CHẤM THEO LÔ ---
+def _grade_chunk(chunk, answer_key, classifier_mode=None, keep_marks=False):
+    """
+    Gộp ROI của nhiều phiếu thành 1 lô, gọi model 1 lần rồi tách kết quả.
+    keep_marks=True: thêm mảng bool "answer_marks" vào kết quả (để phân tích cả lớp, không ghi ra file).
+    """
+    results = [None] * len(chunk)
+    sheets = []
+    for idx, (path, warped_gray, template, error) in enumerate(chunk):
+        if error is not None:
+            results[idx] = {"error": error}
+            continue
+        rejection = check_sheet_quality(warped_gray, template)
+        if rejection is not None:
+            results[idx] = rejection # Ảnh hỏng không chiếm chỗ trong lô gửi qua model
+            continue
+        rois, valid = collect_sheet_rois(warped_gray, template)
+        sheets.append((idx, rois, valid, template))
+
+    if sheets:
+        # 1 lần gọi model cho tất cả các ô (cần dự đoán) của cả lô (các phiếu có thể khác mẫu)
+        probs, escalated = classify_bubbles(np.concatenate([rois for _, rois, _, _ in sheets]),
+                                                np.concatenate([valid for _, _, valid, _ in sheets]),
+                                                classifier_mode)
+        offset = 0
+        for idx, rois, valid, template in sheets:
+            sheet_probs = probs[offset:offset + len(rois)]
+            sheet_escalated = escalated[offset:offset + len(rois)]
+            offset += len(rois)
+            test_id, sbd, answer_marks = decode_sheet_marks(sheet_probs, template=template)
+            results[idx] = build_result(test_id, sbd, answer_marks, answer_key, template)
+            if results[idx].get("status") == "success":
+                # Tỉ lệ riêng của từng phiếu (giống grade_paper), không phải của cả lô
+                results[idx]["model_escalation_ratio"] = round(float(sheet_escalated.mean()), 4)
+                if keep_marks:
+                    results[idx]["answer_marks"] = answer_marks
+
+    return [(item[0], result) for item, result in zip(chunk, results)]
+
+def grade_batch(source, answer_key=None, batch_sheets=DEFAULT_BATCH_SHEETS,
+                prefetch=DEFAULT_PREFETCH, workers=DEFAULT_DECODE_WORKERS, classifier_mode=None,
+                template=None, keep_marks=False):
+    """
+    Chấm cả 1 thư mục (hoặc mẫu glob) ảnh bài làm.
+    answer_key: mảng bool (số câu, số lựa chọn) hoặc list chuỗi đáp án.
+    template: tên mẫu phiếu, "auto" (nhận diện từng phiếu theo ô mốc) hoặc None (mẫu mặc định).
+    Là generator: sinh ra từng kết quả (dict có thêm khóa "file") ngay khi chấm xong,
+    nên bộ nhớ không phụ thuộc vào số lượng ảnh.
+    """
+    paths = iter_image_paths(source) if isinstance(source, str) else list(source)
+    return grade_sheets(((path, path) for path in paths), load_sheet, answer_key, batch_sheets,
+                        prefetch, workers, classifier_mode, template, keep_marks)
+
+def grade_uploads(uploads, answer_key=None, batch_sheets=DEFAULT_BATCH_SHEETS,
+                  prefetch=DEFAULT_PREFETCH, workers=DEFAULT_DECODE_WORKERS, classifier_mode=None,
+                  template=None, keep_marks=False):
+    """
+    Như grade_batch nhưng nhận ảnh đã nằm trong bộ nhớ (vd: file upload, ảnh trong zip):
+    uploads là các cặp (tên file, dữ liệu nhị phân). Không ghi gì ra đĩa.
+    """
+    return grade_sheets(uploads, load_sheet_bytes, answer_key, batch_sheets,
+                        prefetch, workers, classifier_mode, template, keep_marks)
+
+def grade_sheets(items, load, answer_key=None, batch_sheets=DEFAULT_BATCH_SHEETS,
+                 prefetch=DEFAULT_PREFETCH, workers=DEFAULT_DECODE_WORKERS, classifier_mode=None,
+                 template=None, keep_marks=False):
+    """
+    Đường ống chung của grade_batch / grade_uploads: items là các cặp (tên, dữ liệu cho `load`).
+    Kết quả của 1 trang trong tài liệu nhiều trang có thêm khóa "page" (số trang, bắt đầu từ 1).
+    """
+    chunk = []
+    for item in prefetch_sheets(expand_documents(items, load, template), prefetch=max(prefetch, 1),
+                                workers=max(workers, 1), template=template, load=_load_item):
+        chunk.append(item)
+        if len(chunk) >= batch_sheets:
+            for name, result in _grade_chunk(chunk, answer_key, classifier_mode, keep_marks):
+                yield _set_source(result, name)
+            chunk = []
+    if chunk:
+        for name, result in _grade_chunk(chunk, answer_key, classifier_mode, keep_marks):
+            yield _set_source(result, name)
+
+def _set_source(result, name):
+    if isinstance(name, tuple):
+        result["file"], result["page"] = name
+    else:
+        result["file"] = name
+    return result
+
+
+# --- 4. GHI KẾT QUẢ ---
+CSV_FIELDS = ["file", "page", "status", "template", "sbd", "test_id", "total_correct", "total_questions",
+              "total_blank", "total_multi_marked", "score_10", "answers", "model_escalation_ratio", "error"]
+
+def _answers_to_string(student_answers):
+    """Chuyển dict đáp án thành chuỗi giống định dạng file nhãn: A,B,X,A|C,..."""
+    return ",".join(student_answers[q] for q in sorted(student_answers))
+
+def write_results(results, output_file, fmt="jsonl"):
+    """
+    Ghi lần lượt từng kết quả ra file (JSONL hoặc CSV) ngay khi nhận được.
+    Trả về (số phiếu, số phiếu lỗi).
+    """
+    total = 0
+    failed = 0
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(output_file, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+
+    for result in results:
+        total += 1
+        if result.get("status") != "success":
+            failed += 1
+        if writer is not None:
+            row = {key: result.get(key, "") for key in CSV_FIELDS}
+            if "student_answers" in result:
+                row["answers"] = _answers_to_string(result["student_answers"])
+            writer.writerow(row)
+        else:
+            output_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output_file.flush()
+    return total, failed
+
+def store_results(results, store, session, key_hash=None, key_template=None):
+    """
+    Lưu từng kết quả chấm thành công vào kho kết quả (results_store.ResultsStore) trước khi ghi file.
+    Cần grade_batch(..., keep_marks=True): bài làm được lưu thẳng từ mảng bool, không chuyển lại từ chuỗi.
+    """
+    for result in results:
+        if result.get("status") == "success":
+            store.add(result, session, result_source(result), key_hash, result.get("answer_marks"), key_template)
+        yield result
+
+def collect_marks(results, marks_by_template=None):
+    """
+    Lấy mảng "answer_marks" ra khỏi từng kết quả (grade_batch(..., keep_marks=True)) trước khi ghi file,
+    gom theo mẫu phiếu vào marks_by_template (tên mẫu -> list mảng) để phân tích cả lớp (None = bỏ đi).
+    """
+    for result in results:
+        marks = result.pop("answer_marks", None)
+        if marks is not None and marks_by_template is not None:
+            marks_by_template.setdefault(result["template"], []).append(marks)
+        yield result
+
+
+# --- 5. DÒNG LỆNH ---
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chấm hàng loạt phiếu trả lời trắc nghiệm.")
+    parser.add_argument("source", help="Thư mục ảnh, mẫu glob (vd: 'scans/*.jpg'), file .zip chứa ảnh, "
+                                       "hoặc file PDF / TIFF nhiều trang của máy scan (mỗi trang 1 phiếu)")
+    parser.add_argument("-o", "--output", default="-", help="File kết quả (mặc định: stdout)")
+    parser.add_argument("-f", "--format", choices=["jsonl", "csv"], default=None,
+                        help="Định dạng kết quả (mặc định: theo đuôi file, hoặc jsonl)")
+    parser.add_argument("-k", "--answer-key", default=None, help="Ảnh phiếu đáp án để chấm điểm")
+    parser.add_argument("--batch-sheets", type=int, default=DEFAULT_BATCH_SHEETS,
+                        help="Số phiếu gộp vào 1 lần gọi model")
+    parser.add_argument("--prefetch", type=int, default=DEFAULT_PREFETCH,
+                        help="Số ảnh đọc trước tối đa")
+    parser.add_argument("--workers", type=int, default=DEFAULT_DECODE_WORKERS,
+                        help="Số luồng đọc ảnh")
+    parser.add_argument("--classifier", choices=["cnn", "tiered"], default=None,
+                        help="Chế độ phân loại ô (mặc định: theo template_config.CLASSIFIER_MODE)")
+    parser.add_argument("-t", "--template", default=None,
+                        help="Tên mẫu phiếu, hoặc 'auto' để nhận diện từng phiếu (mặc định: mẫu mặc định)")
+    parser.add_argument("--item-analysis", default=None,
+                        help="File JSON ghi thống kê từng câu hỏi của cả lớp (cần --answer-key)")
+    parser.add_argument("--results-db", default=None,
+                        help="Lưu thêm kết quả vào kho kết quả SQLite này (cùng định dạng với server, OMR_RESULTS_DB)")
+    parser.add_argument("--session", default=None, help="Tên kỳ thi khi lưu vào --results-db")
+    args = parser.parse_args(argv)
+    if args.item_analysis and not args.answer_key:
+        parser.error("--item-analysis cần --answer-key")
+
+    fmt = args.format
+    if fmt is None:
+        fmt = "csv" if args.output.lower().endswith(".csv") else "jsonl"
+
+    answer_key = None
+    key_template = None
+    key_hash = None
+    if args.answer_key:
+        key_result = grade_paper(args.answer_key, classifier_mode=args.classifier, template=args.template)
+        if key_result.get("status") != "success":
+            print(f"Không thể đọc file đáp án: {key_result.get('error')}", file=sys.stderr)
+            return 1
+        # Chuyển đáp án sang mảng bool 1 lần cho cả lô
+        key_template = get_template(key_result["template"])
+        answer_key = answers_to_marks(key_result["student_answers"], key_template.options, key_template.num_questions)
+        with open(args.answer_key, "rb") as f:
+            key_hash = content_hash(f.read(), key_template.name)
+
+    store = None
+    if args.results_db:
+        store = ResultsStore(args.results_db)
+        if answer_key is not None:
+            store.add_key(key_hash, answer_key, key_template, key_result.get("test_id"))
+
+    start = time.perf_counter()
+    marks_by_template = {}
+    grade = grade_batch
+    source = args.source
+    with ExitStack() as stack:
+        if source.lower().endswith(".zip") and os.path.isfile(source):
+            # Ảnh nằm trong file zip: đọc thẳng từ zip, không giải nén ra đĩa.
+            # Zip phải mở tới khi ghi xong kết quả (results là generator, đọc ảnh dần dần)
+            grade = grade_uploads
+            source = iter_zip_images(stack.enter_context(zipfile.ZipFile(source)))
+        results = grade(source, answer_key=answer_key, batch_sheets=args.batch_sheets,
+                        prefetch=args.prefetch, workers=args.workers, classifier_mode=args.classifier,
+                        template=args.template, keep_marks=bool(args.item_analysis or store))
+        if store is not None:
+            results = store_results(results, store, args.session or DEFAULT_SESSION, key_hash, key_template)
+        if args.item_analysis or store is not None:
+            results = collect_marks(results, marks_by_template if args.item_analysis else None)
+        if args.output == "-":
+            total, failed = write_results(results, sys.stdout, fmt)
+        else:
+            with open(args.output, "w", encoding="utf-8", newline="") as f:
+                total, failed = write_results(results, f, fmt)
+    if store is not None:
+        store.flush()
+    elapsed = time.perf_counter() - start
+
+    rate = total / elapsed if elapsed > 0 else 0.0
+    print(f"--- Đã chấm {total} phiếu ({failed} lỗi) trong {elapsed:.2f}s: {rate:.2f} phiếu/giây ---",
+          file=sys.stderr)
+
+    if args.item_analysis:
+        marks = marks_by_template.get(key_template.name, [])
+        analysis = item_analysis(np.stack(marks) if marks else np.zeros((0,) + answer_key.shape, dtype=bool),
+                                 answer_key, key_template.options)
+        analysis["template"] = key_template.name
+        with open(args.item_analysis, "w", encoding="utf-8") as f:
+            json.dump(analysis, f, ensure_ascii=False, indent=1)
+        print(f"--- Đã ghi phân tích {analysis['num_sheets']} phiếu vào: {args.item_analysis} ---", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
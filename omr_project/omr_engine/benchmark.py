@@ -0,0 +1,230 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from . import template_config as config
+from .grader import (decode_image_bytes, select_template, find_and_warp, check_sheet_quality,
+                     collect_sheet_rois, classify_bubbles, decode_sheet_marks)
+from .model_loader import MODEL_BACKEND, warm_up
+from .scoring import score_marks
+from .synthetic_sheets import FILL_PATTERNS, generate_sheets, random_answer_marks
+
+# --- BENCHMARK TOÀN BỘ ĐƯỜNG ỐNG CHẤM BÀI ---
+# Sinh phiếu giả lập (biết trước đáp án đúng) -> đo từng bước:
+#   decode (giải mã JPEG) -> warp (chọn mẫu + nắn) -> quality (kiểm tra chất lượng ảnh) -> crop (cắt ô)
+#   -> classify (model) -> score (giải mã + chấm)
+# Kết quả là 1 file JSON (độ trễ theo phân vị, phiếu/giây, RAM tối đa, độ chính xác) để so sánh giữa các commit.
+# Chạy: python -m omr_engine.benchmark --sheets 200 -o bench.json
+
+STAGES = ("decode", "warp", "quality", "crop", "classify", "score")
+PERCENTILES = (50, 90, 99)
+DEFAULT_SHEETS = 100
+DEFAULT_WARMUP_SHEETS = 3
+
+
+# --- 1. THÔNG TIN MÔI TRƯỜNG ---
+def peak_rss_mb():
+    """RAM tối đa của tiến trình (MB), None nếu hệ điều hành không hỗ trợ."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux báo theo KB, macOS theo byte
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def git_revision():
+    """Mã commit hiện tại (để so sánh kết quả giữa các commit), None nếu không có git."""
+    try:
+        output = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return output.stdout.strip() or None
+
+def environment_info():
+    import cv2
+    return {
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "model_backend": MODEL_BACKEND,
+        "cpu_count": os.cpu_count(),
+    }
+
+
+# --- 2. CHẤM 1 PHIẾU, ĐO TỪNG BƯỚC ---
+def grade_timed(image_bytes, key_marks, template=None, classifier_mode=None):
+    """
+    Chấm 1 phiếu giống grader.grade_bytes nhưng đo thời gian từng bước.
+    Trả về (timings (dict bước -> giây), test_id, sbd, answer_marks, num_escalated) hoặc ném lỗi
+    (kể cả khi phiếu bị kiểm tra chất lượng từ chối, như grade_bytes).
+    """
+    timings = {}
+    t0 = time.perf_counter()
+    image = decode_image_bytes(image_bytes, template)
+    if image is None:
+        raise ValueError("Không giải mã được ảnh")
+    t1 = time.perf_counter()
+    template = select_template(image, template)
+    _, warped_gray = find_and_warp(image, template)
+    if warped_gray is None:
+        raise ValueError("Không nắn được ảnh")
+    t2 = time.perf_counter()
+    rejection = check_sheet_quality(warped_gray, template)
+    if rejection is not None:
+        raise ValueError(f"Bị từ chối ({rejection['quality']['reason']}): {rejection['error']}")
+    t3 = time.perf_counter()
+    rois, valid = collect_sheet_rois(warped_gray, template)
+    t4 = time.perf_counter()
+    probs, escalated = classify_bubbles(rois, valid, classifier_mode)
+    t5 = time.perf_counter()
+    test_id, sbd, answer_marks = decode_sheet_marks(probs, template=template)
+    score_marks(answer_marks, key_marks)
+    t6 = time.perf_counter()
+
+    timings.update(decode=t1 - t0, warp=t2 - t1, quality=t3 - t2, crop=t4 - t3, classify=t5 - t4, score=t6 - t5,
+                   total=t6 - t0)
+    return timings, test_id, sbd, answer_marks, int(escalated.sum())
+
+def latency_summary(samples):
+    """Thống kê độ trễ (ms) của 1 bước."""
+    ms = np.asarray(samples, dtype=np.float64) * 1000.0
+    if len(ms) == 0:
+        return {}
+    summary = {f"p{p}": round(float(np.percentile(ms, p)), 3) for p in PERCENTILES}
+    summary.update(mean=round(float(ms.mean()), 3), max=round(float(ms.max()), 3))
+    return summary
+
+
+# --- 3. CHẠY BENCHMARK ---
+def run_benchmark(num_sheets=DEFAULT_SHEETS, seed=0, template=None, classifier_mode=None,
+                  warmup_sheets=DEFAULT_WARMUP_SHEETS, **sheet_options):
+    """
+    Sinh `num_sheets` phiếu giả lập (sheet_options: fill, scale, skew, blur, noise, jpeg_quality
+    - xem synthetic_sheets.render_sheet), chấm từng phiếu và trả về báo cáo dạng dict.
+    Thời gian sinh phiếu không tính vào kết quả.
+    """
+    template = template or config.DEFAULT_TEMPLATE
+    key_marks = random_answer_marks(template, np.random.default_rng(seed + 1), "single")
+
+    # Khởi động: tải model + chạy vài phiếu để các thư viện khởi tạo xong (không tính vào kết quả)
+    warm_up()
+    for image_bytes, _ in generate_sheets(warmup_sheets, seed=seed + 2, template=template, **sheet_options):
+        try:
+            grade_timed(image_bytes, key_marks, template, classifier_mode)
+        except ValueError:
+            pass # Phiếu khởi động bị từ chối / không nắn được: vẫn đã khởi tạo xong các bước trước đó
+
+    timings = {stage: [] for stage in STAGES + ("total",)}
+    errors = []
+    bubbles_total = bubbles_correct = false_filled = missed_filled = 0
+    questions_correct = sheets_exact = test_id_correct = sbd_correct = 0
+    score_errors = []
+    escalated = rois_total = 0
+
+    for idx, (image_bytes, truth) in enumerate(generate_sheets(num_sheets, seed=seed, template=template,
+                                                               **sheet_options)):
+        try:
+            sheet_timings, test_id, sbd, answer_marks, num_escalated = grade_timed(
+                image_bytes, key_marks, template, classifier_mode)
+        except Exception as e:
+            errors.append({"sheet": idx, "error": str(e)})
+            continue
+        for stage, seconds in sheet_timings.items():
+            timings[stage].append(seconds)
+
+        expected = truth["answer_marks"]
+        bubbles_total += expected.size
+        bubbles_correct += int((answer_marks == expected).sum())
+        false_filled += int((answer_marks & ~expected).sum())
+        missed_filled += int((~answer_marks & expected).sum())
+        question_ok = (answer_marks == expected).all(axis=1)
+        questions_correct += int(question_ok.sum())
+        sheets_exact += int(question_ok.all())
+        test_id_correct += int(test_id == truth["test_id"])
+        sbd_correct += int(sbd == truth["sbd"])
+        score_errors.append(abs(float(score_marks(answer_marks, key_marks)["score_10"]) -
+                                float(score_marks(expected, key_marks)["score_10"])))
+        escalated += num_escalated
+        rois_total += len(template.sheet_xy)
+
+    graded = len(timings["total"])
+    total_seconds = float(np.sum(timings["total"])) if graded else 0.0
+    return {
+        "config": dict(sheet_options, sheets=num_sheets, seed=seed, template=template.name,
+                       classifier_mode=classifier_mode or config.CLASSIFIER_MODE, warmup_sheets=warmup_sheets),
+        "environment": environment_info(),
+        "throughput": {
+            "sheets_graded": graded,
+            "sheets_failed": len(errors),
+            "total_seconds": round(total_seconds, 4),
+            "sheets_per_second": round(graded / total_seconds, 2) if total_seconds > 0 else None,
+        },
+        "latency_ms": {stage: latency_summary(samples) for stage, samples in timings.items()},
+        "memory": {"peak_rss_mb": peak_rss_mb()},
+        "accuracy": {
+            "bubble_accuracy": round(bubbles_correct / bubbles_total, 6) if bubbles_total else None,
+            "false_filled_bubbles": false_filled,
+            "missed_filled_bubbles": missed_filled,
+            "question_accuracy": round(questions_correct / (graded * template.num_questions), 6) if graded else None,
+            "sheet_exact_match": round(sheets_exact / graded, 6) if graded else None,
+            "test_id_accuracy": round(test_id_correct / graded, 6) if graded else None,
+            "sbd_accuracy": round(sbd_correct / graded, 6) if graded else None,
+            "score_10_mean_abs_error": round(float(np.mean(score_errors)), 4) if score_errors else None,
+            "model_escalation_ratio": round(escalated / rois_total, 4) if rois_total else None,
+        },
+        "errors": errors[:20],
+    }
+
+
+# --- 4. DÒNG LỆNH ---
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark đường ống chấm bài trên phiếu giả lập.")
+    parser.add_argument("-n", "--sheets", type=int, default=DEFAULT_SHEETS, help="Số phiếu giả lập")
+    parser.add_argument("--seed", type=int, default=0, help="Seed sinh phiếu (cùng seed = cùng bộ phiếu)")
+    parser.add_argument("--warmup", type=int, default=DEFAULT_WARMUP_SHEETS, help="Số phiếu khởi động (không tính)")
+    parser.add_argument("-t", "--template", default=None, help="Tên mẫu phiếu (mặc định: mẫu mặc định)")
+    parser.add_argument("--classifier", choices=["cnn", "tiered"], default=None,
+                        help="Chế độ phân loại ô (mặc định: theo template_config.CLASSIFIER_MODE)")
+    parser.add_argument("--fill", choices=FILL_PATTERNS, default="mixed", help="Kiểu tô đáp án")
+    parser.add_argument("--scale", type=float, default=1.3, help="Độ phân giải ảnh so với ảnh chuẩn")
+    parser.add_argument("--skew", type=float, default=0.02, help="Độ nghiêng/phối cảnh (tỉ lệ cạnh)")
+    parser.add_argument("--blur", type=float, default=0.8, help="Sigma làm mờ Gaussian (px)")
+    parser.add_argument("--noise", type=float, default=6.0, help="Độ lệch chuẩn nhiễu (mức xám)")
+    parser.add_argument("--jpeg-quality", type=int, default=85, help="Chất lượng nén JPEG")
+    parser.add_argument("-o", "--output", default="-", help="File JSON kết quả (mặc định: stdout)")
+    args = parser.parse_args(argv)
+
+    from .template_registry import TemplateError, resolve_template
+    try:
+        template = resolve_template(args.template)
+    except TemplateError as e:
+        parser.error(str(e))
+
+    report = run_benchmark(args.sheets, seed=args.seed, template=template, classifier_mode=args.classifier,
+                           warmup_sheets=args.warmup, fill=args.fill, scale=args.scale, skew=args.skew,
+                           blur=args.blur, noise=args.noise, jpeg_quality=args.jpeg_quality)
+    text = json.dumps(report, ensure_ascii=False, indent=1)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+    throughput, accuracy = report["throughput"], report["accuracy"]
+    print(f"--- {throughput['sheets_graded']} phiếu: {throughput['sheets_per_second']} phiếu/giây, "
+          f"độ chính xác ô {accuracy['bubble_accuracy']}, RAM tối đa {report['memory']['peak_rss_mb']} MB ---",
+          file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
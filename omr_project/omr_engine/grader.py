@@ -1,38 +1,57 @@
-import cv2
 import numpy as np
 from . import template_config as config # Import cấu hình layout
-from .model_loader import bubble_model # Import "bộ não" AI
+from . import metrics # Đo thời gian từng bước (/metrics)
+from .image_io import decode_image, read_image
+from .model_loader import get_bubble_model # Import "bộ não" AI (chỉ tải khi cần dùng)
+from .preprocess import warp_sheet, crop_bubbles, fit_to_model_input, to_model_input
+from .roi_index import TEST_ID_XY, SBD_XY, ANSWER_XY, SHEET_XY
+from .quality_gate import assess_sheet_quality
+from .sheet_alignment import detect_template
+from .template_registry import AUTO_TEMPLATE, TemplateError, get_template, list_templates, resolve_template
+from .scoring import as_marks, render_answers, score_marks
 
 # --- 1. HÀM NẮN ẢNH ---
-def find_and_warp(image):
+def find_and_warp(image, template=None):
     """
-    (PHIÊN BẢN ĐƠN GIẢN)
-    Chỉ resize ảnh về kích thước chuẩn và chuyển sang ảnh xám.
-    Giống hệt logic trong 'prepare_data.py' (phiên bản đơn giản).
+    Nắn phối cảnh phiếu về kích thước chuẩn của mẫu phiếu (theo 4 ô mốc ở góc hoặc mép giấy)
+    và chuyển sang ảnh xám. Không tìm thấy mốc nào thì chỉ resize như phiên bản đơn giản cũ.
+    Nhận ảnh màu BGR hoặc ảnh xám.
     """
     try:
-        resized_img = cv2.resize(image, (config.WARPED_IMAGE_WIDTH, config.WARPED_IMAGE_HEIGHT))
-        warped_gray = cv2.cvtColor(resized_img, cv2.COLOR_BGR2GRAY)
-        # Trả về ảnh màu (để vẽ) và ảnh xám (để đọc)
-        return resized_img, warped_gray
+        # Trả về ảnh đã nắn (để vẽ) và ảnh xám (để đọc)
+        return warp_sheet(image, template)
     except Exception as e:
-        print(f"Lỗi khi resize ảnh: {e}")
+        print(f"Lỗi khi nắn ảnh: {e}")
         return None, None
 
+def select_template(image, template=None):
+    """
+    Chọn mẫu phiếu cho 1 ảnh: None = mẫu mặc định, tên / SheetTemplate = mẫu đó,
+    "auto" = nhận diện theo ô mốc (không nhận diện được thì dùng mẫu mặc định).
+    Ném TemplateError nếu không có mẫu phiếu được yêu cầu.
+    """
+    if template != AUTO_TEMPLATE:
+        return resolve_template(template)
+    candidates = []
+    for name in list_templates():
+        try:
+            candidates.append(get_template(name))
+        except TemplateError as e:
+            print(f"Cảnh báo: Bỏ qua mẫu phiếu lỗi: {e}")
+    detected = detect_template(image, candidates) if len(candidates) > 1 else None
+    return detected or config.DEFAULT_TEMPLATE
+
 # --- 2. HÀM DỰ ĐOÁN BONG BÓNG (ĐÃ SỬA) ---
 def predict_bubble(bubble_roi, is_id_bubble=False):
     """
     Nhận 1 ảnh bong bóng, dùng model AI để dự đoán 0 (trống) hay 1 (tô).
     is_id_bubble: Nếu là True, sẽ dùng ngưỡng thấp hơn (linh hoạt hơn).
     """
-    if bubble_model is None:
-        raise ValueError("Model chưa được tải! Hãy kiểm tra file model_loader.py")
-        
-    # Luôn resize về 28x28 (kích thước model mong đợi)
-    bubble_img_resized = cv2.resize(bubble_roi, config.MODEL_INPUT_IMG_SIZE)
-    
-    img_array = np.expand_dims(bubble_img_resized, axis=-1)
-    img_array = np.expand_dims(img_array, axis=0)
+    bubble_model = get_bubble_model()
+
+    # Cùng tiền xử lý với lúc huấn luyện (chỉ resize nếu ô khác kích thước model)
+    img_array = to_model_input(fit_to_model_input(bubble_roi[np.newaxis]))
+    metrics.record_model_call(1)
     
     prediction = bubble_model.predict(img_array, verbose=0)[0][0] # Lấy giá trị float (0.0 -> 1.0)
     
@@ -50,28 +69,20 @@ def predict_bubble(bubble_roi, is_id_bubble=False):
 # --- 3. HÀM ĐỌC CÁC KHU VỰC ---
 
 def get_bubble_coordinates(q_num, opt_idx):
-    """Lấy tọa độ từ file config (CHO CÂU HỎI)"""
-    col_idx = q_num // config.QUESTIONS_PER_COLUMN
-    row_idx = q_num % config.QUESTIONS_PER_COLUMN
-    if col_idx == 0: start_x = config.START_X_COL_1
-    elif col_idx == 1: start_x = config.START_X_COL_2
-    elif col_idx == 2: start_x = config.START_X_COL_3
-    elif col_idx == 3: start_x = config.START_X_COL_4
-    else: return 0, 0 
-    x = start_x + (opt_idx * config.OPTION_X_SPACING)
-    y = config.START_Y_ROWS + (row_idx * config.QUESTION_Y_SPACING)
+    """Lấy tọa độ từ bảng tính sẵn (CHO CÂU HỎI)"""
+    if not (0 <= q_num < config.NUM_QUESTIONS and 0 <= opt_idx < config.NUM_OPTIONS):
+        return 0, 0
+    x, y = ANSWER_XY[q_num * config.NUM_OPTIONS + opt_idx]
     return int(x), int(y)
 
 def get_test_id_bubble_coordinates(digit_idx, option_num):
-    """Lấy tọa độ từ file config (CHO MÃ ĐỀ)"""
-    x = config.TEST_ID_START_X + (digit_idx * config.TEST_ID_X_SPACING)
-    y = config.TEST_ID_START_Y + (option_num * config.TEST_ID_Y_SPACING)
+    """Lấy tọa độ từ bảng tính sẵn (CHO MÃ ĐỀ)"""
+    x, y = TEST_ID_XY[digit_idx * config.NUM_TEST_ID_OPTIONS + option_num]
     return int(x), int(y)
 
 def get_sbd_bubble_coordinates(digit_idx, option_num):
-    """Lấy tọa độ từ file config (CHO SỐ BÁO DANH)"""
-    x = config.SBD_START_X + (digit_idx * config.SBD_X_SPACING)
-    y = config.SBD_START_Y + (option_num * config.SBD_Y_SPACING)
+    """Lấy tọa độ từ bảng tính sẵn (CHO SỐ BÁO DANH)"""
+    x, y = SBD_XY[digit_idx * config.NUM_SBD_OPTIONS + option_num]
     return int(x), int(y)
 
 def read_id_grid(warped_gray, num_digits, num_options, coord_func):
@@ -111,91 +122,299 @@ def read_id_grid(warped_gray, num_digits, num_options, coord_func):
             
     return id_str
 
+# --- 3b. ĐỌC CẢ PHIẾU BẰNG 1 LẦN GỌI MODEL ---
+
+def collect_sheet_rois(warped_gray, template=None):
+    """
+    Cắt TẤT CẢ các ô trên phiếu theo thứ tự: Mã đề -> SBD -> Đáp án.
+    Dùng bảng tọa độ đã biên dịch của mẫu phiếu (1 phép toán mảng cho cả phiếu).
+    Trả về (rois, valid):
+      - rois: mảng uint8 (N, H, W) theo MODEL_INPUT_IMG_SIZE
+      - valid: mảng bool (N,), False nếu ô bị tràn ra ngoài ảnh (sẽ coi là trống)
+    """
+    if template is None:
+        with metrics.stage("crop"):
+            return crop_bubbles(warped_gray, SHEET_XY)
+    with metrics.stage("crop"):
+        return crop_bubbles(warped_gray, template.sheet_xy, template.bubble_size)
+
+def predict_bubbles_batch(bubble_rois):
+    """
+    Dự đoán nhiều ô cùng lúc: nhận mảng (N, H, W), trả về mảng xác suất (N,).
+    Chỉ gọi model ĐÚNG 1 LẦN cho cả lô (thay vì N lần như predict_bubble).
+    """
+    bubble_model = get_bubble_model()
+    if len(bubble_rois) == 0:
+        return np.zeros(0, dtype=np.float32)
+
+    batch = to_model_input(bubble_rois) # (N, H, W, 1)
+    metrics.record_model_call(len(batch))
+
+    predictions = bubble_model.predict(batch, batch_size=len(batch), verbose=0)
+    return predictions.reshape(-1)
+
+def fill_ratio_scores(bubble_rois):
+    """
+    Tính tỉ lệ điểm ảnh tối của từng ô (vector hóa cho cả lô): mảng (N,) trong [0, 1].
+    """
+    return (np.asarray(bubble_rois) < config.FAST_PATH_DARK_PIXEL_THRESHOLD).mean(axis=(1, 2))
+
+def classify_bubbles(bubble_rois, valid, mode=None):
+    """
+    Trả về (probs, escalated):
+      - probs: xác suất "đã tô" (N,); ô không hợp lệ (tràn ảnh) luôn = 0
+      - escalated: mảng bool (N,), True ở các ô phải gửi qua model
+    mode "cnn": mọi ô hợp lệ qua model (1 lần gọi).
+    mode "tiered": ô chắc chắn trống/tô quyết định bằng tỉ lệ điểm tối, chỉ ô không chắc chắn qua model.
+    """
+    mode = mode or config.CLASSIFIER_MODE
+    if mode not in ("cnn", "tiered"):
+        raise ValueError(f"Chế độ phân loại không hợp lệ: '{mode}' (chọn: cnn, tiered)")
+    with metrics.stage("classify"):
+        return _classify_bubbles(bubble_rois, valid, mode)
+
+def _classify_bubbles(bubble_rois, valid, mode):
+    probs = np.zeros(len(bubble_rois), dtype=np.float32)
+    if mode == "cnn":
+        escalate = np.asarray(valid, dtype=bool)
+    else:
+        ratios = fill_ratio_scores(bubble_rois)
+        confident_filled = ((ratios >= config.FAST_PATH_FILLED_MIN_RATIO) &
+                            (ratios <= config.FAST_PATH_FILLED_MAX_RATIO))
+        confident_empty = ratios <= config.FAST_PATH_EMPTY_MAX_RATIO
+        probs[valid & confident_filled] = 1.0
+        escalate = valid & ~confident_filled & ~confident_empty
+
+    if escalate.any():
+        probs[escalate] = predict_bubbles_batch(np.asarray(bubble_rois)[escalate])
+    return probs, escalate
+
+def decode_id_probs(probs, num_digits, num_options, threshold=0.3):
+    """
+    Giải mã SBD/Mã đề từ mảng xác suất (num_digits * num_options,).
+    Cùng logic với read_id_grid: mỗi cột chọn ô có độ tự tin cao nhất vượt ngưỡng.
+    """
+    grid = probs.reshape(num_digits, num_options)
+    id_str = ""
+    for digit_idx in range(num_digits):
+        option_num = int(np.argmax(grid[digit_idx]))
+        if grid[digit_idx, option_num] > threshold:
+            id_str += str(config.ID_BUBBLE_MAP[option_num])
+        else:
+            id_str += "X"
+    return id_str
+
+def decode_sheet_marks(probs, threshold=None, template=None):
+    """
+    Giải mã Mã đề, SBD và các ô đáp án được tô từ vector xác suất của collect_sheet_rois,
+    theo kế hoạch giải mã của mẫu phiếu (ngưỡng mặc định lấy từ file mẫu phiếu).
+    Trả về (test_id, sbd, answer_marks): answer_marks là mảng bool (số câu, số lựa chọn).
+    Phiếu không có trường Mã đề/SBD thì trả về chuỗi rỗng.
+    """
+    template = template or config.DEFAULT_TEMPLATE
+    ids = template.decode_ids(probs)
+    return ids.get("test_id", ""), ids.get("sbd", ""), template.answer_marks(probs, threshold)
+
+def decode_sheet_probs(probs, threshold=None, template=None):
+    """
+    Như decode_sheet_marks nhưng đáp án ở dạng chuỗi.
+    Trả về (test_id, sbd, student_answers).
+    """
+    template = template or config.DEFAULT_TEMPLATE
+    test_id, sbd, answer_marks = decode_sheet_marks(probs, threshold, template)
+    return test_id, sbd, render_answers(answer_marks, template.options)
+
 # --- 4. HÀM CHẤM ĐIỂM CHÍNH ---
 
-def grade_paper(image_path, answer_key=None):
+def decode_target_size(template=None):
     """
-    Hàm chính để xử lý một bài làm.
+    Kích thước (rộng, cao) tối thiểu cần giải mã cho mẫu phiếu `template`
+    ("auto": mẫu phiếu lớn nhất). None nếu không có mẫu phiếu đó (giải mã đầy đủ, lỗi được báo sau).
+    """
+    if template == AUTO_TEMPLATE:
+        templates = []
+        for name in list_templates():
+            try:
+                templates.append(get_template(name))
+            except TemplateError:
+                continue # Mẫu phiếu lỗi bị bỏ qua (select_template cũng bỏ qua và báo cảnh báo)
+        if not templates:
+            return None
+    else:
+        try:
+            templates = [resolve_template(template)]
+        except TemplateError:
+            return None
+    return max(t.width for t in templates), max(t.height for t in templates)
+
+def decode_image_bytes(buffer, template=None):
+    """
+    Giải mã ảnh trực tiếp từ bộ nhớ (bytes / bytearray / memoryview), không ghi ra đĩa.
+    Ảnh lớn được giải mã thu nhỏ, vừa đủ lớn hơn mẫu phiếu `template` (xem image_io.decode_image).
+    Trả về ảnh xám (hoặc BGR khi tắt OMR_REDUCED_DECODE), None nếu không giải mã được.
+    """
+    with metrics.stage("decode"):
+        return decode_image(buffer, decode_target_size(template))
+
+def prepare_sheet(image, template=None):
+    """
+    Chọn mẫu phiếu (xem select_template) và "nắn thẳng" 1 ảnh đã giải mã.
+    Trả về (warped_gray, template, error): error là None nếu thành công.
     """
-    
-    # 1. Tải ảnh và "nắn thẳng" (resize)
-    image = cv2.imread(image_path)
     if image is None:
-        return {"error": "Không thể đọc file ảnh."}
-    
-    warped_color, warped_gray = find_and_warp(image)
+        _count_failed_sheet("decode_error")
+        return None, None, "Không thể đọc file ảnh."
+
+    with metrics.stage("warp"):
+        try:
+            template = select_template(image, template)
+        except TemplateError as e:
+            _count_failed_sheet("template_error")
+            return None, None, str(e)
+        warped_color, warped_gray = find_and_warp(image, template)
     if warped_color is None:
-        return {"error": "Lỗi khi resize ảnh."}
+        _count_failed_sheet("warp_error")
+        return None, template, "Lỗi khi resize ảnh."
+    return warped_gray, template, None
 
-    # 2. Đọc Mã đề và SBD
-    try:
-        test_id = read_id_grid(warped_gray, 
-                               config.NUM_TEST_ID_DIGITS, 
-                               config.NUM_TEST_ID_OPTIONS, 
-                               get_test_id_bubble_coordinates)
-    except Exception as e:
-        print(f"Lỗi khi đọc mã đề: {e}")
-        test_id = "ERROR"
-        
-    try:
-        sbd = read_id_grid(warped_gray,
-                           config.NUM_SBD_DIGITS,
-                           config.NUM_SBD_OPTIONS,
-                           get_sbd_bubble_coordinates)
-    except Exception as e:
-        print(f"Lỗi khi đọc SBD: {e}")
-        sbd = "ERROR"
-    
-    # 3. Đọc đáp án câu hỏi
-    student_answers = {} 
-    
-    for q_num in range(config.NUM_QUESTIONS):
-        choices = [] 
-        for opt_idx in range(config.NUM_OPTIONS):
-            x, y = get_bubble_coordinates(q_num, opt_idx)
-            bubble_roi = warped_gray[y:y+config.BUBBLE_H, x:x+config.BUBBLE_W]
-            
-            if bubble_roi.shape[0] != config.BUBBLE_H or bubble_roi.shape[1] != config.BUBBLE_W:
-                continue
-            
-            # Gọi predict_bubble với ngưỡng chuẩn (is_id_bubble=False)
-            prediction, _ = predict_bubble(bubble_roi, is_id_bubble=False)
-            
-            if prediction == 1:
-                option_char = config.OPTIONS_MAP[opt_idx]
-                choices.append(option_char)
-                
-        if len(choices) == 0:
-            student_answers[q_num] = "X"
-        else:
-            student_answers[q_num] = "|".join(choices)
+def check_sheet_quality(warped_gray, template=None):
+    """
+    Kiểm tra nhanh chất lượng ảnh đã nắn TRƯỚC khi cắt ô và gọi model (xem quality_gate.py,
+    tắt bằng OMR_QUALITY_GATE=0). Trả về None nếu đạt, ngược lại kết quả lỗi
+    {"error": thông báo, "quality": {"reason", "metrics", ...}}.
+    """
+    if not config.QUALITY_GATE:
+        return None
+    with metrics.stage("quality"):
+        report = assess_sheet_quality(warped_gray, resolve_template(template))
+    if report["ok"]:
+        return None
+    _count_failed_sheet("quality_" + report["reason"])
+    return {"error": report["message"], "quality": report}
+
+def _count_failed_sheet(error_class):
+    metrics.record_error(error_class)
+    metrics.inc("omr_sheets_total", status="error")
+
+def load_sheet(image_path, template=None):
+    """
+    Đọc ảnh từ đĩa, chọn mẫu phiếu và "nắn thẳng".
+    Trả về (warped_gray, template, error): error là None nếu thành công.
+    """
+    with metrics.stage("decode"):
+        image = read_image(image_path, decode_target_size(template))
+    return prepare_sheet(image, template)
+
+def load_sheet_bytes(buffer, template=None):
+    """
+    Giải mã ảnh từ bộ nhớ (xem decode_image_bytes), chọn mẫu phiếu và "nắn thẳng".
+    Trả về (warped_gray, template, error): error là None nếu thành công.
+    """
+    return prepare_sheet(decode_image_bytes(buffer, template), template)
+
+def warp_image(image, template=None):
+    """
+    "Nắn thẳng" (resize) 1 ảnh đã giải mã.
+    Trả về (warped_gray, error): error là None nếu thành công.
+    """
+    warped_gray, _, error = prepare_sheet(image, template)
+    return warped_gray, error
+
+def load_and_warp(image_path, template=None):
+    """
+    Đọc ảnh từ đĩa và "nắn thẳng" (resize).
+    Trả về (warped_gray, error): error là None nếu thành công.
+    """
+    warped_gray, _, error = load_sheet(image_path, template)
+    return warped_gray, error
 
-    # 4. Chuẩn bị kết quả trả về
+def build_result(test_id, sbd, answer_marks, answer_key=None, template=None):
+    """
+    Đóng gói kết quả đọc phiếu và chấm điểm (nếu có answer_key).
+    answer_marks: mảng bool (số câu, số lựa chọn) từ decode_sheet_marks.
+    answer_key: mảng bool cùng kích thước (nên chuyển 1 lần cho cả lô) hoặc list chuỗi "A" / "A|C" / "X".
+    Đáp án chỉ được chuyển thành chuỗi ở bước cuối cùng.
+    """
+    template = template or config.DEFAULT_TEMPLATE
+    num_questions = template.num_questions
     result = {
         "status": "success",
+        "template": template.name,
         "sbd": sbd,
         "test_id": test_id,
-        "student_answers": student_answers
+        "student_answers": render_answers(answer_marks, template.options)
     }
 
-    # 5. So sánh với đáp án (NẾU CÓ)
+    # So sánh với đáp án (NẾU CÓ)
     if answer_key is not None:
-        if len(answer_key) != config.NUM_QUESTIONS:
-            return {"error": f"Lỗi đáp án: Cần 60 câu, nhưng file đáp án có {len(answer_key)} câu."}
-            
-        total_correct = 0
-        for q_num in range(config.NUM_QUESTIONS):
-            correct_answer = answer_key[q_num]
-            student_choice = student_answers[q_num]
-            
-            if correct_answer == student_choice:
-                total_correct += 1
-        
+        if len(answer_key) != num_questions:
+            _count_failed_sheet("answer_key_error")
+            return {"error": f"Lỗi đáp án: Mẫu phiếu '{template.name}' cần {num_questions} câu, "
+                             f"nhưng file đáp án có {len(answer_key)} câu."}
+        try:
+            scores = score_marks(answer_marks, as_marks(answer_key, template.options, num_questions))
+        except ValueError as e:
+            _count_failed_sheet("answer_key_error")
+            return {"error": f"Lỗi đáp án: {e}"}
+
         # Thêm thông tin điểm vào kết quả
-        score = (total_correct / config.NUM_QUESTIONS) * 10.0
-        result["total_questions"] = config.NUM_QUESTIONS
-        result["total_correct"] = total_correct
-        result["score_10"] = round(score, 2)
+        result["total_questions"] = num_questions
+        result["total_correct"] = int(scores["total_correct"])
+        result["total_blank"] = int(scores["total_blank"])
+        result["total_multi_marked"] = int(scores["total_multi"])
+        result["score_10"] = round(float(scores["score_10"]), 2)
+
+    metrics.inc("omr_sheets_total", status="success")
+    return result
+
+def grade_warped(warped_gray, answer_key=None, classifier_mode=None, template=None):
+    """
+    Đọc và chấm 1 phiếu đã được nắn thẳng (ảnh xám kích thước chuẩn của mẫu phiếu `template`).
+    Ảnh không đạt kiểm tra chất lượng bị từ chối ngay (xem check_sheet_quality), không gọi model.
+    """
+    rejection = check_sheet_quality(warped_gray, template)
+    if rejection is not None:
+        return rejection
+
+    # Cắt tất cả các ô và dự đoán (tối đa 1 lần gọi model)
+    rois, valid = collect_sheet_rois(warped_gray, template)
+    probs, escalated = classify_bubbles(rois, valid, classifier_mode)
+
+    with metrics.stage("score"):
+        # Giải mã Mã đề, SBD và các ô đáp án được tô từ vector xác suất
+        test_id, sbd, answer_marks = decode_sheet_marks(probs, template=template)
+
+        # Chuẩn bị kết quả trả về (và chấm điểm nếu có đáp án)
+        result = build_result(test_id, sbd, answer_marks, answer_key, template)
+    if result.get("status") == "success":
+        result["model_escalation_ratio"] = round(float(escalated.mean()), 4)
+    return result
+
+def grade_image(image, answer_key=None, classifier_mode=None, template=None):
+    """
+    Chấm 1 ảnh đã nằm trong bộ nhớ (mảng BGR như cv2.imread trả về, hoặc ảnh xám).
+    template: tên mẫu phiếu, "auto" (nhận diện theo ô mốc) hoặc None (mẫu mặc định).
+    """
+    warped_gray, template, error = prepare_sheet(image, template)
+    if error is not None:
+        return {"error": error}
+    return grade_warped(warped_gray, answer_key, classifier_mode, template)
+
+def grade_bytes(buffer, answer_key=None, classifier_mode=None, template=None):
+    """
+    Chấm 1 ảnh từ dữ liệu nhị phân của file (vd: file upload), không ghi ra đĩa.
+    """
+    return grade_image(decode_image_bytes(buffer, template), answer_key, classifier_mode, template)
+
+def grade_paper(image_path, answer_key=None, classifier_mode=None, template=None):
+    """
+    Hàm chính để xử lý một bài làm.
+    """
+    
+    # 1. Tải ảnh, chọn mẫu phiếu và "nắn thẳng" (resize)
+    warped_gray, template, error = load_sheet(image_path, template)
+    if error is not None:
+        return {"error": error}
 
-    # 6. Trả về kết quả
-    return result
\ No newline at end of file
+    # 2. Đọc và chấm điểm
+    return grade_warped(warped_gray, answer_key, classifier_mode, template)
@@ -0,0 +1,197 @@
+import os
+
+import numpy as np
+from . import template_config as config
+
+# --- GIẢI MÃ ẢNH Ở ĐỘ PHÂN GIẢI VỪA ĐỦ ---
+# Ảnh chụp điện thoại thường 12+ MP, nhưng phiếu chỉ được nắn về kích thước mẫu phiếu (vd: 793x1122)
+# và đọc ở ảnh xám. Với JPEG: đọc kích thước trong header (không giải mã), rồi để libjpeg thu nhỏ
+# ngay trong miền DCT (IMREAD_REDUCED_GRAYSCALE_2/4/8): chỉ giải mã 1/4, 1/16 hoặc 1/64 số điểm ảnh,
+# 1 kênh thay vì 3. Định dạng khác (PNG, BMP...) hoặc header không đọc được: giải mã đầy đủ ở ảnh xám.
+# File nhiều trang của máy scan (PDF, TIFF) được đọc lần lượt TỪNG TRANG (generator), mỗi trang được
+# vẽ / thu nhỏ đúng về kích thước mẫu phiếu; không ghi file tạm, không giữ cả tài liệu trong bộ nhớ.
+
+# Hệ số thu nhỏ -> tên cờ của cv2 (import cv2 lười, như các module khác)
+REDUCED_GRAYSCALE_FLAGS = {
+    8: "IMREAD_REDUCED_GRAYSCALE_8",
+    4: "IMREAD_REDUCED_GRAYSCALE_4",
+    2: "IMREAD_REDUCED_GRAYSCALE_2",
+}
+# Marker SOF (Start Of Frame) chứa kích thước ảnh: 0xC0 -> 0xCF trừ DHT (C4), JPG (C8), DAC (CC)
+_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Tài liệu nhiều trang: mỗi trang là 1 phiếu
+DOCUMENT_EXTENSIONS = ('.pdf', '.tif', '.tiff')
+# Độ phân giải vẽ trang PDF khi không biết mẫu phiếu (target_size=None)
+DEFAULT_PDF_DPI = 200
+PDF_POINTS_PER_INCH = 72
+# Marker không có trường độ dài: TEM và RST0 -> RST7
+_STANDALONE_MARKERS = frozenset([0x01] + list(range(0xD0, 0xD8)))
+
+
+# --- 1. ĐỌC KÍCH THƯỚC TỪ HEADER ---
+def jpeg_size(data):
+    """
+    (rộng, cao) đọc từ header JPEG (marker SOF), không giải mã ảnh.
+    Trả về None nếu không phải JPEG hoặc header hỏng. Kích thước là trước khi xoay theo EXIF.
+    """
+    data = memoryview(data)
+    length = len(data)
+    if length < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    pos = 2
+    while pos + 4 <= length:
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF: # Byte đệm
+            pos += 1
+            continue
+        if marker in _STANDALONE_MARKERS:
+            pos += 2
+            continue
+        if marker in (0xD9, 0xDA): # Hết ảnh / bắt đầu dữ liệu nén mà chưa thấy SOF
+            return None
+        if marker in _SOF_MARKERS:
+            if pos + 9 > length:
+                return None
+            height = (data[pos + 5] << 8) | data[pos + 6]
+            width = (data[pos + 7] << 8) | data[pos + 8]
+            return (width, height) if width and height else None
+        pos += 2 + ((data[pos + 2] << 8) | data[pos + 3])
+    return None
+
+def reduced_decode_factor(image_size, target_size, min_scale=None):
+    """
+    Hệ số thu nhỏ lớn nhất (8, 4, 2 hoặc 1) mà ảnh vẫn >= min_scale lần target_size theo cả 2 chiều.
+    So sánh cạnh ngắn với cạnh ngắn, cạnh dài với cạnh dài: không phụ thuộc ảnh bị xoay (EXIF).
+    """
+    min_scale = config.DECODE_MIN_SCALE if min_scale is None else min_scale
+    short_side, long_side = sorted(image_size)
+    target_short, target_long = sorted(target_size)
+    for factor in sorted(REDUCED_GRAYSCALE_FLAGS, reverse=True):
+        if short_side / factor >= target_short * min_scale and long_side / factor >= target_long * min_scale:
+            return factor
+    return 1
+
+def fit_scale(image_size, target_size, min_scale=None):
+    """
+    Tỉ lệ phóng/thu để ảnh kích thước image_size vừa đúng >= min_scale lần target_size theo cả 2 chiều
+    (so cạnh ngắn với cạnh ngắn, cạnh dài với cạnh dài, như reduced_decode_factor).
+    """
+    min_scale = config.DECODE_MIN_SCALE if min_scale is None else min_scale
+    short_side, long_side = sorted(image_size)
+    target_short, target_long = sorted(target_size)
+    return max(target_short * min_scale / short_side, target_long * min_scale / long_side)
+
+
+# --- 2. GIẢI MÃ ---
+def decode_image(buffer, target_size=None):
+    """
+    Giải mã ảnh từ bộ nhớ (bytes / bytearray / memoryview / mảng uint8).
+    target_size=(rộng, cao): kích thước tối thiểu cần dùng (kích thước mẫu phiếu) -> trả về ảnh XÁM,
+    JPEG được thu nhỏ 2/4/8 lần khi vẫn lớn hơn target_size.
+    target_size=None (hoặc OMR_REDUCED_DECODE=0): giải mã đầy đủ, ảnh màu BGR như cv2.imread.
+    Trả về None nếu không giải mã được.
+    """
+    import cv2
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if data.size == 0:
+        return None
+    if target_size is None or not config.REDUCED_DECODE:
+        return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+    size = jpeg_size(data)
+    factor = reduced_decode_factor(size, target_size) if size else 1
+    flag = getattr(cv2, REDUCED_GRAYSCALE_FLAGS[factor]) if factor > 1 else cv2.IMREAD_GRAYSCALE
+    return cv2.imdecode(data, flag)
+
+def read_image(path, target_size=None):
+    """Đọc + giải mã 1 file ảnh (xem decode_image). Trả về None nếu không đọc được."""
+    try:
+        data = np.fromfile(path, dtype=np.uint8)
+    except (OSError, ValueError):
+        return None
+    return decode_image(data, target_size)
+
+
+# --- 3. TÀI LIỆU NHIỀU TRANG (PDF / TIFF) ---
+def is_document(name):
+    """File có thể chứa nhiều trang (mỗi trang 1 phiếu)?"""
+    return str(name).lower().endswith(DOCUMENT_EXTENSIONS)
+
+def shrink_to_target(image, target_size):
+    """
+    Thu nhỏ 2/4/8 lần (INTER_AREA) ảnh đã giải mã, cùng hệ số như JPEG giải mã thu nhỏ
+    (reduced_decode_factor): cùng 1 phiếu cho cùng kết quả dù được scan ra TIFF hay JPEG.
+    """
+    import cv2
+    if target_size is None or not config.REDUCED_DECODE:
+        return image
+    height, width = image.shape[:2]
+    factor = reduced_decode_factor((width, height), target_size)
+    if factor == 1:
+        return image
+    size = (max(width // factor, 1), max(height // factor, 1))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+def iter_tiff_pages(source, target_size=None):
+    """
+    Đọc lần lượt từng trang của file TIFF (đường dẫn, hoặc dữ liệu nhị phân đã nằm trong bộ nhớ).
+    Mỗi lần chỉ giải mã 1 trang (ảnh xám), thu nhỏ nếu lớn hơn nhiều so với target_size (xem shrink_to_target).
+    Sinh ra (số trang bắt đầu từ 1, ảnh). Ném ValueError nếu không đọc được trang đầu tiên.
+    """
+    import cv2
+    if isinstance(source, (str, os.PathLike)):
+        num_pages = cv2.imcount(os.fspath(source), cv2.IMREAD_GRAYSCALE)
+        read_page = lambda index: cv2.imreadmulti(os.fspath(source), index, 1, flags=cv2.IMREAD_GRAYSCALE)
+    else:
+        data = np.frombuffer(source, dtype=np.uint8)
+        num_pages = None # Không đếm được trang khi chưa giải mã: đọc tới khi hết trang
+        read_page = lambda index: cv2.imdecodemulti(data, cv2.IMREAD_GRAYSCALE, range=(index, index + 1))
+
+    index = 0
+    while num_pages is None or index < num_pages:
+        ok, pages = read_page(index)
+        if not ok or not pages:
+            if index == 0:
+                raise ValueError("Không đọc được file TIFF.")
+            return
+        yield index + 1, shrink_to_target(pages[0], target_size)
+        index += 1
+
+def iter_pdf_pages(source, target_size=None):
+    """
+    Vẽ (rasterize) lần lượt từng trang PDF (đường dẫn, hoặc dữ liệu nhị phân) thành ảnh xám, ở đúng
+    độ phân giải để trang vừa bằng target_size x DECODE_MIN_SCALE (xem fit_scale); target_size=None: DEFAULT_PDF_DPI.
+    Cần PyMuPDF (pip install pymupdf), chỉ import khi thật sự có file PDF.
+    Sinh ra (số trang bắt đầu từ 1, ảnh). PyMuPDF không an toàn đa luồng: chỉ dùng ở 1 luồng.
+    """
+    try:
+        import pymupdf
+    except ImportError as e:
+        raise ImportError("Cần cài PyMuPDF để đọc file PDF: pip install pymupdf") from e
+
+    if isinstance(source, (str, os.PathLike)):
+        document = pymupdf.open(os.fspath(source))
+    else:
+        document = pymupdf.open(stream=bytes(source), filetype="pdf")
+    with document:
+        for index in range(document.page_count):
+            page = document.load_page(index)
+            if target_size is None:
+                zoom = DEFAULT_PDF_DPI / PDF_POINTS_PER_INCH
+            else:
+                zoom = fit_scale((page.rect.width, page.rect.height), target_size)
+            pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), colorspace=pymupdf.csGRAY, alpha=False)
+            # Mỗi dòng của pixmap có thể dài hơn chiều rộng (căn lề): cắt theo stride rồi copy ra khỏi bộ đệm
+            image = np.frombuffer(pixmap.samples_mv, dtype=np.uint8).reshape(pixmap.height, pixmap.stride)
+            yield index + 1, image[:, :pixmap.width].copy()
+
+def iter_document_pages(name, source, target_size=None):
+    """
+    Đọc lần lượt từng trang của 1 tài liệu PDF / TIFF (theo đuôi của `name`).
+    source: đường dẫn hoặc dữ liệu nhị phân của file. Sinh ra (số trang, ảnh xám).
+    """
+    if str(name).lower().endswith('.pdf'):
+        return iter_pdf_pages(source, target_size)
+    return iter_tiff_pages(source, target_size)
@@ -0,0 +1,214 @@
+import json
+import threading
+
+import numpy as np
+
+# Các "backend" suy luận cho model bong bóng.
+# Mọi backend đều có hàm predict(batch, batch_size=None, verbose=0) trả về mảng (N, 1)
+# giống hệt tf.keras.Model.predict, để grader không cần biết đang dùng backend nào.
+
+
+# --- 1. BACKEND NUMPY THUẦN (KHÔNG CẦN TENSORFLOW) ---
+def _conv2d(x, kernel, bias, padding, strides):
+    """Conv2D kiểu NHWC như Keras (chỉ hỗ trợ strides = 1)."""
+    if tuple(strides) != (1, 1):
+        raise ValueError(f"Backend NumPy chỉ hỗ trợ Conv2D strides=1, nhận: {strides}")
+    kh, kw, in_ch, out_ch = kernel.shape
+    if padding == "same":
+        pad_h, pad_w = kh - 1, kw - 1
+        x = np.pad(x, ((0, 0), (pad_h // 2, pad_h - pad_h // 2), (pad_w // 2, pad_w - pad_w // 2), (0, 0)))
+    n, h, w, _ = x.shape
+    h_out, w_out = h - kh + 1, w - kw + 1
+    # Cộng dồn kh*kw phép nhân ma trận (mỗi vị trí trong kernel 1 lần):
+    # nhanh hơn và tốn ít bộ nhớ hơn so với dựng ma trận im2col đầy đủ
+    out = np.zeros((n, h_out, w_out, out_ch), dtype=np.float32)
+    for i in range(kh):
+        for j in range(kw):
+            out += x[:, i:i + h_out, j:j + w_out, :] @ kernel[i, j]
+    return out + bias
+
+def _max_pool2d(x, pool_size, strides):
+    """MaxPooling2D padding='valid', pool_size == strides (trường hợp của model này)."""
+    ph, pw = pool_size
+    if tuple(strides) != (ph, pw):
+        raise ValueError(f"Backend NumPy chỉ hỗ trợ MaxPooling2D strides == pool_size, nhận: {strides}")
+    n, h, w, c = x.shape
+    h_out, w_out = h // ph, w // pw
+    x = x[:, :h_out * ph, :w_out * pw, :]
+    return x.reshape(n, h_out, ph, w_out, pw, c).max(axis=(2, 4))
+
+_ACTIVATIONS = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0.0),
+    "sigmoid": lambda x: 0.5 * (1.0 + np.tanh(0.5 * x)), # Dạng tanh: không bị tràn số với x âm lớn
+}
+
+class NumpyBubbleModel:
+    """
+    Chạy forward pass của CNN bằng NumPy từ file .npz do training/train_model.py xuất ra.
+    File .npz chứa:
+      - "architecture": chuỗi JSON mô tả danh sách các lớp
+      - "layer_{i}_kernel" / "layer_{i}_bias": trọng số của lớp thứ i
+    """
+
+    # Giới hạn số ô mỗi lần tính, để bộ nhớ tạm của Conv2D không phình to
+    MAX_CHUNK = 512
+
+    def __init__(self, npz_path):
+        with np.load(npz_path) as data:
+            self.layers = json.loads(str(data["architecture"]))
+            self.weights = {name: data[name].astype(np.float32) for name in data.files if name != "architecture"}
+        for layer in self.layers:
+            if layer["type"] in ("conv2d", "dense") and layer["activation"] not in _ACTIVATIONS:
+                raise ValueError(f"Backend NumPy không hỗ trợ activation '{layer['activation']}'")
+
+    def _forward(self, x):
+        for i, layer in enumerate(self.layers):
+            kind = layer["type"]
+            if kind == "rescaling":
+                x = x * np.float32(layer["scale"]) + np.float32(layer["offset"])
+            elif kind == "conv2d":
+                x = _conv2d(x, self.weights[f"layer_{i}_kernel"], self.weights[f"layer_{i}_bias"],
+                            layer["padding"], layer["strides"])
+                x = _ACTIVATIONS[layer["activation"]](x)
+            elif kind == "max_pooling2d":
+                x = _max_pool2d(x, layer["pool_size"], layer["strides"])
+            elif kind == "flatten":
+                x = x.reshape(len(x), -1)
+            elif kind == "dense":
+                x = x @ self.weights[f"layer_{i}_kernel"] + self.weights[f"layer_{i}_bias"]
+                x = _ACTIVATIONS[layer["activation"]](x)
+            else:
+                raise ValueError(f"Backend NumPy không hỗ trợ lớp '{kind}'")
+        return x
+
+    def predict(self, batch, batch_size=None, verbose=0):
+        batch = np.asarray(batch, dtype=np.float32)
+        chunk = min(batch_size or self.MAX_CHUNK, self.MAX_CHUNK)
+        outputs = [self._forward(batch[start:start + chunk]) for start in range(0, len(batch), chunk)]
+        if not outputs:
+            return np.zeros((0, 1), dtype=np.float32)
+        return np.concatenate(outputs).astype(np.float32)
+
+
+# --- 2. BACKEND TFLITE ---
+def _import_tflite_interpreter():
+    """Ưu tiên gói tflite_runtime nhỏ gọn; nếu không có thì dùng bản trong TensorFlow."""
+    try:
+        from tflite_runtime.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    import tensorflow as tf
+    return tf.lite.Interpreter
+
+class TFLiteBubbleModel:
+    """Chạy model .tflite bằng TFLite Interpreter (không cần tải cả Keras)."""
+
+    def __init__(self, tflite_path, num_threads=None):
+        Interpreter = _import_tflite_interpreter()
+        self._interpreter = Interpreter(model_path=tflite_path, num_threads=num_threads)
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        self._batch_size = None
+        # Interpreter không an toàn khi dùng từ nhiều luồng cùng lúc
+        self._lock = threading.Lock()
+
+    def _quantize_input(self, batch):
+        scale, zero_point = self._input["quantization"]
+        if self._input["dtype"] == np.float32 or scale == 0:
+            return batch.astype(self._input["dtype"])
+        return np.clip(np.round(batch / scale + zero_point),
+                       np.iinfo(self._input["dtype"]).min,
+                       np.iinfo(self._input["dtype"]).max).astype(self._input["dtype"])
+
+    def _dequantize_output(self, output):
+        scale, zero_point = self._output["quantization"]
+        if self._output["dtype"] == np.float32 or scale == 0:
+            return output.astype(np.float32)
+        return (output.astype(np.float32) - zero_point) * scale
+
+    def predict(self, batch, batch_size=None, verbose=0):
+        batch = np.asarray(batch, dtype=np.float32)
+        if len(batch) == 0:
+            return np.zeros((0, 1), dtype=np.float32)
+        with self._lock:
+            if self._batch_size != len(batch):
+                self._interpreter.resize_tensor_input(self._input["index"], batch.shape)
+                self._interpreter.allocate_tensors()
+                self._batch_size = len(batch)
+            self._interpreter.set_tensor(self._input["index"], self._quantize_input(batch))
+            self._interpreter.invoke()
+            output = self._interpreter.get_tensor(self._output["index"])
+        return self._dequantize_output(output).reshape(len(batch), -1)
+
+
+# --- 3. BACKEND KERAS (MẶC ĐỊNH, CẦN TENSORFLOW) ---
+# Kích thước lô được "làm tròn lên" (đệm ô trống) tới 1 trong các mức này, cách nhau ~√2 lần
+# (lãng phí tối đa ~1.5x, 1 phiếu 330 ô -> 384). Lô lớn hơn mức cuối được chia thành các lô 512 ô: trên ~256 ô
+# thời gian tăng tuyến tính theo số ô nên chia nhỏ không chậm hơn, mà bộ nhớ tạm của Conv2D nhỏ hơn nhiều.
+DEFAULT_BATCH_BUCKETS = (16, 32, 64, 128, 256, 384, 512)
+
+def load_keras_model(h5_path):
+    import tensorflow as tf
+    return tf.keras.models.load_model(h5_path)
+
+class CompiledKerasModel:
+    """
+    Chạy model Keras qua 1 tf.function có chữ ký đầu vào cố định (N, 20, 20, 1) float32, thay cho
+    model.predict (mỗi lần gọi dựng lại đường ống dữ liệu: ~70ms kể cả với 1 ô).
+      - Đồ thị chỉ được dựng (trace) 1 lần cho mọi kích thước lô
+      - Lô được đệm tới mức gần nhất trong `buckets`: chỉ có vài kích thước lô khác nhau,
+        nên bộ cấp phát bộ nhớ của TensorFlow / XLA không phải làm việc lại với từng kích thước mới
+      - jit_compile=True: biên dịch XLA (mỗi mức 1 lần); nhanh hơn hay chậm hơn tùy CPU, hãy đo trước
+    Gọi warm_up() lúc khởi động để mọi mức được chạy trước (không request nào phải chịu chi phí dựng đồ thị).
+    """
+
+    def __init__(self, model, buckets=DEFAULT_BATCH_BUCKETS, jit_compile=False):
+        import tensorflow as tf
+        self.model = model
+        self.buckets = tuple(sorted({int(b) for b in buckets if int(b) > 0}))
+        if not self.buckets:
+            raise ValueError("Cần ít nhất 1 mức kích thước lô > 0")
+        self.jit_compile = bool(jit_compile)
+        self._input_shape = tuple(model.input_shape[1:])
+        signature = [tf.TensorSpec((None,) + self._input_shape, tf.float32)]
+        self._function = tf.function(lambda batch: model(batch, training=False),
+                                     input_signature=signature, jit_compile=self.jit_compile)
+
+    def bucket_size(self, n):
+        """Mức kích thước lô nhỏ nhất >= n (n lớn hơn mức cuối: mức cuối)."""
+        for bucket in self.buckets:
+            if bucket >= n:
+                return bucket
+        return self.buckets[-1]
+
+    def tracing_count(self):
+        """Số lần đồ thị đã được dựng (phải giữ nguyên = 1 sau khi khởi động)."""
+        return self._function.experimental_get_tracing_count()
+
+    def _run_bucket(self, chunk):
+        bucket = self.bucket_size(len(chunk))
+        if bucket > len(chunk):
+            chunk = np.concatenate([chunk, np.zeros((bucket - len(chunk),) + chunk.shape[1:], dtype=np.float32)])
+        return self._function(chunk).numpy()
+
+    def predict(self, batch, batch_size=None, verbose=0):
+        batch = np.asarray(batch, dtype=np.float32)
+        if len(batch) == 0:
+            return np.zeros((0, 1), dtype=np.float32)
+        outputs = []
+        for start in range(0, len(batch), self.buckets[-1]):
+            chunk = batch[start:start + self.buckets[-1]]
+            outputs.append(self._run_bucket(chunk)[:len(chunk)])
+        return np.concatenate(outputs).reshape(len(batch), -1)
+
+    def warm_up(self):
+        """Chạy thử mọi mức kích thước lô (dựng đồ thị + biên dịch XLA + cấp phát bộ nhớ)."""
+        for bucket in self.buckets:
+            self._function(np.zeros((bucket,) + self._input_shape, dtype=np.float32))
@@ -0,0 +1,178 @@
+import bisect
+import contextvars
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+# --- ĐO THỜI GIAN TỪNG BƯỚC VÀ THỐNG KÊ (ĐỊNH DẠNG PROMETHEUS) ---
+# Các bước chấm bài trong grader.py được bọc bằng `with metrics.stage("warp"):`.
+#   - Tắt (OMR_METRICS=0): stage() trả về 1 context rỗng dùng chung, gần như không tốn gì
+#   - Bật: ghi vào histogram omr_stage_seconds{stage=...} và vào bảng thời gian của request hiện tại
+#     (để trả về header Server-Timing)
+# app/main.py xuất tất cả qua GET /metrics.
+
+ENABLED = os.environ.get('OMR_METRICS', '1') != '0'
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 10, 50, 100, 330, 1000, 2500, 5000, 10000, 25000)
+
+# tên -> (loại, mô tả, buckets)
+METRICS = {
+    "omr_stage_seconds": ("histogram", "Thời gian từng bước chấm bài (giây)", STAGE_BUCKETS),
+    "omr_http_request_seconds": ("histogram", "Thời gian xử lý request HTTP (giây)", STAGE_BUCKETS),
+    "omr_model_batch_size": ("histogram", "Số ô trong mỗi lần gọi model", BATCH_SIZE_BUCKETS),
+    "omr_model_calls_total": ("counter", "Số lần gọi model", None),
+    "omr_sheets_total": ("counter", "Số phiếu đã xử lý theo trạng thái", None),
+    "omr_errors_total": ("counter", "Số lỗi theo loại lỗi", None),
+    "omr_http_requests_total": ("counter", "Số request HTTP theo endpoint và mã trạng thái", None),
+}
+
+_lock = threading.Lock()
+_histograms = {} # (tên, nhãn) -> [số đếm từng bucket, tổng, số lần]
+_counters = {}   # (tên, nhãn) -> giá trị
+_gauges = {}     # tên -> (mô tả, hàm trả về giá trị hiện tại)
+# Bảng thời gian các bước của request hiện tại (None = không ghi)
+_request_timings = contextvars.ContextVar("omr_request_timings", default=None)
+_NULL_STAGE = nullcontext()
+
+
+def set_enabled(enabled):
+    """Bật/tắt đo lường lúc đang chạy (vd: trong benchmark)."""
+    global ENABLED
+    ENABLED = bool(enabled)
+
+
+# --- 1. GHI SỐ LIỆU ---
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def observe(name, value, **labels):
+    """Ghi 1 giá trị vào histogram `name`."""
+    if not ENABLED:
+        return
+    buckets = METRICS[name][2]
+    key = (name, _label_key(labels))
+    with _lock:
+        entry = _histograms.get(key)
+        if entry is None:
+            entry = _histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+def inc(name, amount=1, **labels):
+    """Tăng counter `name`."""
+    if not ENABLED:
+        return
+    key = (name, _label_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def record_error(error_class):
+    """Đếm 1 lỗi theo loại (vd: "decode_error", "warp_error", tên exception...)."""
+    inc("omr_errors_total", error_class=error_class)
+
+def record_model_call(batch_size):
+    """Đếm 1 lần gọi model và số ô trong lần gọi đó."""
+    if not ENABLED:
+        return
+    inc("omr_model_calls_total")
+    observe("omr_model_batch_size", batch_size)
+
+def register_gauge(name, func, description=""):
+    """Đăng ký 1 giá trị đọc tại thời điểm xuất /metrics (vd: độ dài hàng đợi)."""
+    with _lock:
+        _gauges[name] = (description, func)
+
+
+# --- 2. ĐO THỜI GIAN TỪNG BƯỚC ---
+class _StageTimer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        observe("omr_stage_seconds", elapsed, stage=self.name)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[self.name] = timings.get(self.name, 0.0) + elapsed
+        return False
+
+def stage(name):
+    """Context manager đo thời gian 1 bước (không làm gì khi đo lường bị tắt)."""
+    if not ENABLED:
+        return _NULL_STAGE
+    return _StageTimer(name)
+
+def start_request_timing():
+    """Bắt đầu ghi thời gian các bước cho request hiện tại (luồng/context hiện tại)."""
+    _request_timings.set({})
+
+def request_timings():
+    """Thời gian (giây) các bước đã chạy trong request hiện tại, None nếu chưa bắt đầu ghi."""
+    return _request_timings.get()
+
+def server_timing_header(timings):
+    """Giá trị header Server-Timing (mili giây), vd: "decode;dur=10.7, warp;dur=46.0"."""
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+
+# --- 3. XUẤT THEO ĐỊNH DẠNG PROMETHEUS ---
+def _format_labels(label_key, extra=()):
+    items = list(label_key) + list(extra)
+    if not items:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in items)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + "}"
+
+def render_prometheus():
+    """Toàn bộ số liệu theo định dạng văn bản của Prometheus (text/plain; version=0.0.4)."""
+    with _lock:
+        histograms = {key: (list(counts), total, count) for key, (counts, total, count) in _histograms.items()}
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+
+    lines = []
+    for name, (kind, description, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            for (metric, label_key), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(label_key)} {value}")
+            continue
+        for (metric, label_key), (counts, total, count) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(label_key, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(label_key)} {total}")
+            lines.append(f"{name}_count{_format_labels(label_key)} {count}")
+
+    for name, (description, func) in sorted(gauges.items()):
+        try:
+            value = func()
+        except Exception as e:
+            print(f"Cảnh báo: Không đọc được gauge {name}: {e}")
+            continue
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    lines.append("# TYPE omr_metrics_enabled gauge")
+    lines.append(f"omr_metrics_enabled {int(ENABLED)}")
+    return "\n".join(lines) + "\n"
+
+def reset():
+    """Xóa toàn bộ số liệu (giữ các gauge đã đăng ký)."""
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
@@ -1,22 +1,93 @@
-import tensorflow as tf
 import os
+import threading
+import numpy as np
+from .inference_backends import (DEFAULT_BATCH_BUCKETS, CompiledKerasModel, NumpyBubbleModel, TFLiteBubbleModel,
+                                 load_keras_model)
 
 # Đường dẫn tương đối đến file model
-MODEL_PATH = os.path.join(os.path.dirname(__file__), '..', 'data', 'saved_model', 'omr_bubble_model.h5')
+MODEL_DIR = os.path.join(os.path.dirname(__file__), '..', 'data', 'saved_model')
+MODEL_PATH = os.path.join(MODEL_DIR, 'omr_bubble_model.h5')
+TFLITE_MODEL_PATH = os.path.join(MODEL_DIR, 'omr_bubble_model.tflite')
+NUMPY_MODEL_PATH = os.path.join(MODEL_DIR, 'omr_bubble_model.npz')
 
-def load_bubble_model():
+# Backend suy luận: 'keras' (mặc định, cần TensorFlow), 'tflite' hoặc 'numpy' (không cần TensorFlow).
+# File .tflite/.npz được tạo bởi: python training/train_model.py --export-only
+MODEL_BACKEND = os.environ.get('OMR_MODEL_BACKEND', 'keras').lower()
+# Backend keras: các mức kích thước lô (vd: "16,64,256,1024") và bật biên dịch XLA (xem CompiledKerasModel)
+MODEL_BATCH_BUCKETS = tuple(int(size) for size in os.environ.get('OMR_MODEL_BATCH_BUCKETS', '').split(',')
+                            if size.strip()) or DEFAULT_BATCH_BUCKETS
+MODEL_JIT_COMPILE = os.environ.get('OMR_MODEL_JIT_COMPILE', '0') == '1'
+
+
+class ModelLoadError(RuntimeError):
+    """Không thể tải model nhận diện bong bóng."""
+
+
+def load_bubble_model(backend=None):
     """
-    Tải mô hình nhận diện bong bóng đã được huấn luyện.
+    Tải mô hình nhận diện bong bóng đã được huấn luyện, theo backend được cấu hình.
+    Ném ModelLoadError nếu thất bại.
     """
+    backend = backend or MODEL_BACKEND
+    loaders = {
+        'keras': (load_compiled_keras_model, MODEL_PATH),
+        'tflite': (TFLiteBubbleModel, TFLITE_MODEL_PATH),
+        'numpy': (NumpyBubbleModel, NUMPY_MODEL_PATH),
+    }
+    if backend not in loaders:
+        raise ModelLoadError(f"Backend model không hợp lệ: '{backend}' (chọn: {', '.join(loaders)})")
+
+    loader, path = loaders[backend]
     try:
-        model = tf.keras.models.load_model(MODEL_PATH)
-        print(f"--- Đã tải model thành công từ: {MODEL_PATH} ---")
-        return model
+        model = loader(path)
     except Exception as e:
-        print(f"LỖI NGHIÊM TRỌNG: Không thể tải model tại: {MODEL_PATH}")
-        print(f"Lỗi: {e}")
-        print("Hãy chắc chắn rằng bạn đã huấn luyện và lưu model thành công.")
-        return None
+        raise ModelLoadError(f"Không thể tải model ({backend}) tại: {path}. Lỗi: {e}. "
+                             "Hãy chắc chắn rằng bạn đã huấn luyện và lưu (xuất) model thành công.") from e
+    print(f"--- Đã tải model ({backend}) thành công từ: {path} ---")
+    return model
+
+
+def load_compiled_keras_model(h5_path):
+    return CompiledKerasModel(load_keras_model(h5_path), MODEL_BATCH_BUCKETS, MODEL_JIT_COMPILE)
+
+
+# --- TẢI MODEL "LƯỜI" (LAZY): CHỈ 1 LẦN / TIẾN TRÌNH, AN TOÀN VỚI NHIỀU LUỒNG ---
+# Import module này KHÔNG tải model (và không import TensorFlow).
+# Model được tải ở lần đầu gọi get_bubble_model() hoặc warm_up().
+_bubble_model = None
+_model_lock = threading.Lock()
+
+def get_bubble_model():
+    """Trả về model đã tải (tải ở lần gọi đầu tiên). Ném ModelLoadError nếu thất bại."""
+    global _bubble_model
+    model = _bubble_model
+    if model is None:
+        with _model_lock:
+            if _bubble_model is None:
+                _bubble_model = load_bubble_model()
+            model = _bubble_model
+    return model
+
+def is_model_loaded():
+    return _bubble_model is not None
+
+def warm_up():
+    """
+    Tải model và chạy thử dự đoán (backend keras: mọi mức kích thước lô), để request đầu tiên
+    không phải chờ. Nên gọi trong từng tiến trình worker SAU khi fork (vd: hook post_fork của gunicorn).
+    """
+    model = get_bubble_model()
+    if isinstance(model, CompiledKerasModel):
+        model.warm_up()
+    else:
+        model.predict(np.zeros((1, 20, 20, 1), dtype=np.float32), verbose=0)
+    return model
+
+def _reset_after_fork():
+    """Tiến trình con sau fork không dùng lại model/lock của tiến trình cha."""
+    global _bubble_model, _model_lock
+    _bubble_model = None
+    _model_lock = threading.Lock()
 
-# Tải model 1 lần duy nhất khi script bắt đầu
-bubble_model = load_bubble_model()
\ No newline at end of file
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
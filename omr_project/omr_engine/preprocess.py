@@ -0,0 +1,71 @@
+import numpy as np
+from . import template_config as config
+from .roi_index import SHEET_XY, extract_rois
+from .sheet_alignment import SheetAligner
+
+# --- TIỀN XỬ LÝ DÙNG CHUNG CHO HUẤN LUYỆN VÀ CHẤM BÀI ---
+# grader.py (lúc chấm) và training/prepare_data.py (lúc tạo dữ liệu huấn luyện) đều đi qua các hàm này:
+#   ảnh -> warp_sheet -> crop_bubbles -> to_model_input -> model
+# nên ô đưa vào model lúc huấn luyện giống hệt (từng điểm ảnh) ô lúc chấm.
+
+# Tăng số này khi đổi cách nắn/cắt ô: prepare_data.py sẽ tạo lại toàn bộ dữ liệu huấn luyện
+PREPROCESS_VERSION = 2
+
+# Dùng chung cho cả tiến trình (không dùng lại homography giữa các ảnh nên an toàn giữa các luồng)
+_sheet_aligner = SheetAligner()
+_template_aligners = {config.DEFAULT_TEMPLATE.fingerprint: _sheet_aligner} # fingerprint mẫu phiếu -> SheetAligner
+
+
+def _aligner_for(template):
+    """SheetAligner của mẫu phiếu `template` (tạo 1 lần cho mỗi mẫu)."""
+    if template is None:
+        return _sheet_aligner
+    aligner = _template_aligners.get(template.fingerprint)
+    if aligner is None:
+        aligner = _template_aligners.setdefault(template.fingerprint, SheetAligner(template))
+    return aligner
+
+def warp_sheet(image, template=None, aligner=None):
+    """
+    Nắn phối cảnh phiếu về kích thước chuẩn của mẫu phiếu `template` (mặc định: mẫu mặc định)
+    và chuyển sang ảnh xám. Nhận ảnh màu BGR hoặc ảnh xám.
+    aligner: SheetAligner riêng của người gọi (vd: để đọc aligner.last_method an toàn khi chạy nhiều luồng).
+    Trả về (ảnh đã nắn, ảnh xám đã nắn).
+    """
+    import cv2
+    warped_img = (aligner or _aligner_for(template)).warp(image)
+    if warped_img.ndim == 2:
+        return warped_img, warped_img
+    return warped_img, cv2.cvtColor(warped_img, cv2.COLOR_BGR2GRAY)
+
+def fit_to_model_input(rois):
+    """
+    Đưa các ô (N, H, W) về kích thước model (MODEL_INPUT_IMG_SIZE).
+    Khi BUBBLE_W/H đã bằng kích thước model (mặc định) thì trả nguyên mảng, không resize.
+    """
+    rois = np.asarray(rois)
+    width, height = config.MODEL_INPUT_IMG_SIZE
+    if rois.shape[1:3] == (height, width):
+        return rois
+    import cv2
+    resized = np.empty((len(rois), height, width), dtype=rois.dtype)
+    for i, roi in enumerate(rois):
+        resized[i] = cv2.resize(roi, (width, height))
+    return resized
+
+def crop_bubbles(warped_gray, coords=SHEET_XY, bubble_size=None):
+    """
+    Cắt các ô theo bảng tọa độ (cỡ ô bubble_size, mặc định BUBBLE_W x BUBBLE_H) và đưa về kích thước model.
+    Trả về (rois uint8 (N, H, W) theo MODEL_INPUT_IMG_SIZE, valid bool (N,)).
+    """
+    rois, valid = extract_rois(warped_gray, coords, bubble_size)
+    return fit_to_model_input(rois), valid
+
+def to_model_input(rois):
+    """Mảng ô uint8 (N, H, W) -> tensor float32 (N, H, W, 1) đưa thẳng vào model (model tự chia 255)."""
+    rois = np.asarray(rois)
+    width, height = config.MODEL_INPUT_IMG_SIZE
+    if rois.shape[1:3] != (height, width):
+        raise ValueError(f"Ô có kích thước {rois.shape[1:3]}, model cần {(height, width)}: "
+                         "hãy cắt ô bằng crop_bubbles()")
+    return rois.astype(np.float32)[..., np.newaxis]
@@ -0,0 +1,93 @@
+import numpy as np
+from . import template_config as config
+
+# --- KIỂM TRA CHẤT LƯỢNG ẢNH TRƯỚC KHI GỌI MODEL ---
+# Ảnh mờ, quá tối, bị lóa hoặc không phải phiếu trả lời vẫn đi qua đủ các bước cắt ô + model,
+# rồi mới hỏng ở cuối (điểm vô nghĩa, SBD toàn "X"). Ở đây ảnh đã nắn được đo vài chỉ số rẻ
+# trên ảnh thu nhỏ (vài ms) và bị từ chối ngay với lý do cụ thể. Ngưỡng nằm trong template_config (mục 8).
+#   - Độ tương phản: mức giấy (phân vị 95) - mức mực (phân vị 1)
+#   - Độ nét: độ lệch chuẩn của Laplacian CHIA cho độ tương phản (ảnh tối / nhạt không bị coi là mờ)
+#   - Ô mốc: số ô mốc của mẫu phiếu thấy được ở đúng vị trí sau khi nắn
+
+# Lý do từ chối -> thông báo
+REJECTION_MESSAGES = {
+    "low_contrast": "Ảnh gần như đồng màu (trang trắng/đen, hoặc không có phiếu).",
+    "too_dark": "Ảnh quá tối, hãy chụp lại ở nơi đủ sáng.",
+    "washed_out": "Ảnh bị lóa/quá nhạt: không thấy nét mực đậm.",
+    "blurry": "Ảnh bị mờ (rung tay hoặc sai nét), hãy chụp lại.",
+    "not_a_sheet": "Ảnh nhiễu hạt hoặc không giống phiếu trả lời.",
+    "markers_not_found": "Không thấy đủ ô mốc ở 4 góc phiếu (sai loại phiếu hoặc chụp thiếu góc).",
+}
+
+
+# --- 1. CÁC CHỈ SỐ ---
+def gray_levels(small_gray):
+    """(mức mực, mức giấy): phân vị QUALITY_INK_PERCENTILE / QUALITY_PAPER_PERCENTILE, tính qua histogram."""
+    cumulative = np.bincount(small_gray.ravel(), minlength=256).cumsum()
+    ink = int(np.searchsorted(cumulative, cumulative[-1] * config.QUALITY_INK_PERCENTILE / 100.0))
+    paper = int(np.searchsorted(cumulative, cumulative[-1] * config.QUALITY_PAPER_PERCENTILE / 100.0))
+    return ink, paper
+
+def sharpness(small_gray, contrast):
+    """Độ lệch chuẩn của Laplacian / độ tương phản: ảnh thật >= ~0.12, mờ không đọc được < ~0.035."""
+    import cv2
+    return float(cv2.Laplacian(small_gray, cv2.CV_32F).std()) / max(contrast, 1)
+
+def count_markers(warped_gray, template):
+    """
+    Số ô mốc (template.fiducial_centers) tối hơn hẳn vùng xung quanh, đúng vị trí trên ảnh đã nắn.
+    None nếu mẫu phiếu không có ô mốc.
+    """
+    if template.fiducial_centers is None:
+        return None
+    side = int(round(template.fiducial_side))
+    height, width = warped_gray.shape[:2]
+    found = 0
+    for cx, cy in template.fiducial_centers:
+        x0, y0 = int(round(cx - side / 2)), int(round(cy - side / 2))
+        if x0 < 0 or y0 < 0 or x0 + side > width or y0 + side > height:
+            continue
+        inner = warped_gray[y0:y0 + side, x0:x0 + side].astype(np.float32)
+        around = warped_gray[max(y0 - side, 0):y0 + 2 * side, max(x0 - side, 0):x0 + 2 * side].astype(np.float32)
+        ring_mean = (around.sum() - inner.sum()) / max(around.size - inner.size, 1)
+        if ring_mean - inner.mean() >= config.QUALITY_MARKER_MIN_CONTRAST:
+            found += 1
+    return found
+
+
+# --- 2. KIỂM TRA ---
+def assess_sheet_quality(warped_gray, template):
+    """
+    Đo chất lượng 1 ảnh phiếu đã nắn (ảnh xám kích thước chuẩn của mẫu phiếu).
+    Trả về dict {"ok", "reason" (None nếu đạt), "message", "metrics"}.
+    """
+    import cv2
+    factor = max(int(config.QUALITY_DOWNSAMPLE), 1)
+    height, width = warped_gray.shape[:2]
+    small = cv2.resize(warped_gray, (max(width // factor, 1), max(height // factor, 1)), interpolation=cv2.INTER_AREA)
+
+    ink, paper = gray_levels(small)
+    contrast = paper - ink
+    values = {
+        "ink_gray": ink,
+        "paper_gray": paper,
+        "contrast": contrast,
+        "sharpness": round(sharpness(small, contrast), 4),
+        "markers_found": count_markers(warped_gray, template),
+    }
+
+    reason = None
+    if contrast < config.QUALITY_MIN_CONTRAST:
+        reason = "low_contrast"
+    elif paper < config.QUALITY_MIN_PAPER_GRAY:
+        reason = "too_dark"
+    elif values["sharpness"] < config.QUALITY_MIN_SHARPNESS:
+        reason = "blurry" # Trước "washed_out": ảnh mờ nặng cũng làm nét mực nhạt đi
+    elif values["sharpness"] > config.QUALITY_MAX_SHARPNESS:
+        reason = "not_a_sheet"
+    elif ink > config.QUALITY_MAX_INK_GRAY:
+        reason = "washed_out"
+    elif (config.QUALITY_REQUIRE_MARKERS and values["markers_found"] is not None
+          and values["markers_found"] < config.QUALITY_MIN_MARKERS):
+        reason = "markers_not_found"
+    return {"ok": reason is None, "reason": reason, "message": REJECTION_MESSAGES.get(reason), "metrics": values}
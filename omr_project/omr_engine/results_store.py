@@ -0,0 +1,301 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from . import metrics
+from .scoring import BLANK_ANSWER, MULTI_ANSWER_SEPARATOR, answers_to_marks, item_analysis
+
+# --- KHO KẾT QUẢ CHẤM (SQLITE) ---
+# Mỗi phiếu đã chấm là 1 dòng trong bảng `sheets`, có chỉ mục theo kỳ thi (session), mã đề và SBD.
+# Bài làm được lưu gọn: mảng bool (số câu, số lựa chọn) nén bit (np.packbits), 30 byte cho phiếu 60 câu x 4
+# lựa chọn, thay cho dict {câu: "A"}. Đáp án của mỗi phiếu được lưu 1 lần trong bảng `answer_keys`.
+# Nhờ vậy thống kê / phân tích câu hỏi cho hàng chục nghìn phiếu chỉ cần đọc lại các mảng bit, không chấm lại.
+# Ghi theo lô: add() chỉ đưa kết quả vào hàng đợi; 1 luồng ghi gom nhiều phiếu vào 1 transaction.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS answer_keys (
+    key_hash      TEXT PRIMARY KEY,
+    test_id       TEXT,
+    template      TEXT NOT NULL,
+    options       TEXT NOT NULL,      -- Các lựa chọn, vd: "ABCD"
+    num_questions INTEGER NOT NULL,
+    answers       BLOB NOT NULL,      -- np.packbits(mảng bool (số câu, số lựa chọn))
+    created_at    REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sheets (
+    id                 INTEGER PRIMARY KEY,
+    session            TEXT NOT NULL,  -- Kỳ thi / buổi chấm
+    test_id            TEXT,
+    sbd                TEXT,
+    template           TEXT NOT NULL,
+    source             TEXT,           -- Tên file ảnh bài làm
+    key_hash           TEXT,           -- -> answer_keys.key_hash
+    num_questions      INTEGER NOT NULL,
+    num_options        INTEGER NOT NULL,
+    answers            BLOB NOT NULL,  -- np.packbits(mảng bool (số câu, số lựa chọn))
+    total_correct      INTEGER,
+    total_blank        INTEGER,
+    total_multi_marked INTEGER,
+    score_10           REAL,
+    test_id_mismatch   INTEGER NOT NULL DEFAULT 0,
+    graded_at          REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sheets_session_test_id ON sheets (session, test_id);
+CREATE INDEX IF NOT EXISTS idx_sheets_test_id ON sheets (test_id);
+CREATE INDEX IF NOT EXISTS idx_sheets_sbd ON sheets (sbd);
+"""
+
+SHEET_COLUMNS = ("session", "test_id", "sbd", "template", "source", "key_hash", "num_questions", "num_options",
+                 "answers", "total_correct", "total_blank", "total_multi_marked", "score_10", "test_id_mismatch",
+                 "graded_at")
+# Cột trả về khi xuất kết quả (answers được giải nén thành chuỗi "A,B,X,A|C,...")
+EXPORT_COLUMNS = ("id", "session", "test_id", "sbd", "template", "source", "total_correct", "num_questions",
+                  "total_blank", "total_multi_marked", "score_10", "test_id_mismatch", "graded_at", "answers")
+
+DEFAULT_SESSION = "default"
+WRITE_BATCH_SIZE = 500     # Số phiếu tối đa mỗi transaction
+WRITE_FLUSH_SECONDS = 0.5  # Phiếu chờ ghi lâu nhất chừng này giây (khi ít request)
+READ_CHUNK_ROWS = 5000     # Số dòng đọc mỗi lần khi xuất / phân tích
+
+
+# --- 1. NÉN / GIẢI NÉN BÀI LÀM ---
+def pack_marks(marks):
+    """Mảng bool (số câu, số lựa chọn) -> bytes (1 bit / ô)."""
+    return np.packbits(np.asarray(marks, dtype=bool)).tobytes()
+
+def unpack_marks(blobs, num_questions, num_options):
+    """Danh sách bytes (cùng kích thước) -> mảng bool (số phiếu, số câu, số lựa chọn)."""
+    bits = num_questions * num_options
+    packed = np.frombuffer(b"".join(blobs), dtype=np.uint8).reshape(len(blobs), -1)
+    return np.unpackbits(packed, axis=1, count=bits).astype(bool).reshape(len(blobs), num_questions, num_options)
+
+def marks_to_strings(marks, options):
+    """
+    Mảng bool (số phiếu, số câu, số lựa chọn) -> list chuỗi "A,B,X,A|C,..." (giống CSV của batch_grader).
+    Tra bảng theo mã bit của từng câu thay vì duyệt từng ô.
+    """
+    num_options = marks.shape[-1]
+    codes = (marks.astype(np.int64) << np.arange(num_options)).sum(axis=-1)
+    lookup = np.array([MULTI_ANSWER_SEPARATOR.join(option for bit, option in enumerate(options) if code >> bit & 1)
+                       or BLANK_ANSWER for code in range(1 << num_options)], dtype=object)
+    return [",".join(row) for row in lookup[codes]]
+
+
+# --- 2. KHO KẾT QUẢ ---
+class ResultsStore:
+    """
+    Kho kết quả chấm lưu trong 1 file SQLite (chế độ WAL: đọc không chặn ghi).
+      - add() / add_key(): đưa vào hàng đợi, luồng ghi gom thành transaction (tối đa WRITE_BATCH_SIZE phiếu)
+      - flush(): chờ mọi kết quả đã add() được ghi xong
+      - sessions() / query() / summary() / item_stats(): truy vấn theo kỳ thi, mã đề, SBD
+    """
+
+    def __init__(self, db_path, batch_size=WRITE_BATCH_SIZE, flush_seconds=WRITE_FLUSH_SECONDS):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._local = threading.local() # Mỗi luồng đọc 1 kết nối riêng
+        self._connect().executescript(SCHEMA)
+        self._queue = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # --- GHI ---
+    def _put(self, item):
+        """Đưa 1 thao tác vào hàng đợi ghi; luồng ghi chỉ được tạo ở lần ghi đầu tiên (an toàn khi fork)."""
+        if self._writer is None:
+            with self._writer_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._writer_loop, name="results-writer", daemon=True)
+                    self._writer.start()
+        self._queue.put(item)
+
+    def add_key(self, key_hash, key_marks, template, test_id=None):
+        """Lưu đáp án (1 lần / key_hash) để phân tích câu hỏi sau này."""
+        key_marks = np.asarray(key_marks, dtype=bool)
+        self._put(("key", (key_hash, test_id, template.name, "".join(template.options), key_marks.shape[0],
+                           pack_marks(key_marks), time.time())))
+
+    def add(self, result, session=DEFAULT_SESSION, source=None, key_hash=None, answer_marks=None, template=None):
+        """
+        Lưu 1 kết quả chấm thành công (dict như grader.build_result trả về).
+        answer_marks: mảng bool bài làm; bỏ trống thì chuyển lại từ "student_answers" (cần `template`).
+        """
+        if answer_marks is None:
+            answer_marks = answers_to_marks(result["student_answers"], template.options, template.num_questions)
+        marks = np.asarray(answer_marks, dtype=bool)
+        self._put(("sheet", (session or DEFAULT_SESSION, result.get("test_id"), result.get("sbd"),
+                             result.get("template"), source, key_hash, marks.shape[0], marks.shape[1],
+                             pack_marks(marks), result.get("total_correct"), result.get("total_blank"),
+                             result.get("total_multi_marked"), result.get("score_10"),
+                             int(bool(result.get("test_id_mismatch"))), time.time())))
+
+    def flush(self, timeout=None):
+        """Chờ tới khi mọi kết quả đã add() trước đó được ghi xuống đĩa."""
+        if self._writer is None:
+            return True
+        done = threading.Event()
+        self._queue.put(("flush", done))
+        return done.wait(timeout)
+
+    def pending(self):
+        """Số thao tác ghi đang chờ trong hàng đợi."""
+        return self._queue.qsize()
+
+    def _writer_loop(self):
+        keys, sheets = [], []
+        deadline = None # Thời điểm phải ghi phiếu đang chờ lâu nhất
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                kind, payload = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                kind, payload = None, None
+            if kind == "key":
+                keys.append(payload)
+            elif kind == "sheet":
+                sheets.append(payload)
+            if deadline is None and (keys or sheets):
+                deadline = time.monotonic() + self.flush_seconds
+
+            # Ghi khi đủ lô, khi hết thời gian chờ, hoặc khi có flush() (mọi thứ trước nó đã được lấy ra khỏi hàng đợi)
+            if len(sheets) >= self.batch_size or kind is None or kind == "flush":
+                self._write(keys, sheets)
+                keys, sheets, deadline = [], [], None
+                if kind == "flush":
+                    payload.set()
+
+    def _write(self, keys, sheets):
+        if not keys and not sheets:
+            return
+        conn = self._connect()
+        try:
+            with conn: # 1 transaction cho cả lô
+                conn.executemany("INSERT OR IGNORE INTO answer_keys (key_hash, test_id, template, options, "
+                                 "num_questions, answers, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)", keys)
+                conn.executemany(f"INSERT INTO sheets ({', '.join(SHEET_COLUMNS)}) "
+                                 f"VALUES ({', '.join('?' * len(SHEET_COLUMNS))})", sheets)
+        except sqlite3.Error as e:
+            print(f"Lỗi khi ghi {len(sheets)} kết quả vào kho: {e}")
+            metrics.record_error("results_store_error")
+
+    # --- ĐỌC ---
+    @staticmethod
+    def _where(session=None, test_id=None, sbd=None):
+        clauses, params = [], []
+        for column, value in (("session", session), ("test_id", test_id), ("sbd", sbd)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def sessions(self):
+        """Các kỳ thi đã lưu: số phiếu, số mã đề, thời gian chấm đầu / cuối."""
+        rows = self._connect().execute(
+            "SELECT session, COUNT(*), COUNT(DISTINCT test_id), MIN(graded_at), MAX(graded_at) "
+            "FROM sheets GROUP BY session ORDER BY MAX(graded_at) DESC").fetchall()
+        return [{"session": session, "num_sheets": count, "num_test_ids": num_test_ids,
+                 "first_graded_at": first, "last_graded_at": last}
+                for session, count, num_test_ids, first, last in rows]
+
+    def count(self, session=None, test_id=None, sbd=None):
+        where, params = self._where(session, test_id, sbd)
+        return self._connect().execute(f"SELECT COUNT(*) FROM sheets{where}", params).fetchone()[0]
+
+    def query(self, session=None, test_id=None, sbd=None, limit=None, offset=0):
+        """
+        Sinh lần lượt từng phiếu (dict theo EXPORT_COLUMNS), đọc theo từng khối READ_CHUNK_ROWS dòng
+        nên xuất được cả kho mà không phải giữ hết trong bộ nhớ.
+        """
+        where, params = self._where(session, test_id, sbd)
+        sql = (f"SELECT {', '.join(EXPORT_COLUMNS[:-1])}, num_options, answers FROM sheets{where} "
+               f"ORDER BY id LIMIT ? OFFSET ?")
+        cursor = self._connect().execute(sql, params + [-1 if limit is None else int(limit), int(offset)])
+        options_by_template = {}
+        while True:
+            rows = cursor.fetchmany(READ_CHUNK_ROWS)
+            if not rows:
+                return
+            # Giải nén + chuyển chuỗi theo nhóm cùng kích thước phiếu
+            groups = {}
+            for idx, row in enumerate(rows):
+                groups.setdefault((row[4], row[7], row[-2]), []).append(idx)
+            answers = [None] * len(rows)
+            for (template, num_questions, num_options), indices in groups.items():
+                if template not in options_by_template:
+                    options_by_template[template] = self._template_options(template, num_options)
+                marks = unpack_marks([rows[idx][-1] for idx in indices], num_questions, num_options)
+                for idx, text in zip(indices, marks_to_strings(marks, options_by_template[template])):
+                    answers[idx] = text
+            for row, text in zip(rows, answers):
+                record = dict(zip(EXPORT_COLUMNS[:-1], row[:-2]))
+                record["test_id_mismatch"] = bool(record["test_id_mismatch"])
+                record["answers"] = text
+                yield record
+
+    def _template_options(self, template, num_options):
+        """Các lựa chọn của mẫu phiếu (lấy từ đáp án đã lưu, không phụ thuộc mẫu phiếu còn tồn tại hay không)."""
+        row = self._connect().execute("SELECT options FROM answer_keys WHERE template = ? LIMIT 1",
+                                      (template,)).fetchone()
+        if row is not None and len(row[0]) == num_options:
+            return list(row[0])
+        return [chr(ord("A") + idx) for idx in range(num_options)]
+
+    def summary(self, session=None, test_id=None):
+        """Thống kê điểm theo từng mã đề (tính bằng SQL, không đọc bài làm)."""
+        where, params = self._where(session, test_id)
+        rows = self._connect().execute(
+            "SELECT test_id, template, COUNT(*), SUM(test_id_mismatch), "
+            "AVG(CASE WHEN test_id_mismatch = 0 THEN score_10 END), "
+            "MIN(CASE WHEN test_id_mismatch = 0 THEN score_10 END), "
+            "MAX(CASE WHEN test_id_mismatch = 0 THEN score_10 END), "
+            f"AVG(total_blank), AVG(total_multi_marked) FROM sheets{where} "
+            "GROUP BY test_id, template ORDER BY test_id", params).fetchall()
+        return [{"test_id": row_test_id, "template": template, "num_sheets": count, "num_test_id_mismatch": mismatch,
+                 "mean_score_10": None if mean is None else round(mean, 2), "min_score_10": low,
+                 "max_score_10": high, "mean_blank": None if blank is None else round(blank, 2),
+                 "mean_multi_marked": None if multi is None else round(multi, 2)}
+                for row_test_id, template, count, mismatch, mean, low, high, blank, multi in rows]
+
+    def item_stats(self, session=None, test_id=None):
+        """
+        Phân tích từng câu hỏi (scoring.item_analysis) cho mỗi đáp án trong kỳ thi / mã đề.
+        Bài làm sai mã đề không được tính (giống /grade_class).
+        """
+        where, params = self._where(session, test_id)
+        where += (" AND " if where else " WHERE ") + "test_id_mismatch = 0 AND key_hash IS NOT NULL"
+        conn = self._connect()
+        cursor = conn.execute(f"SELECT key_hash, answers FROM sheets{where} ORDER BY key_hash, id", params)
+        blobs_by_key = {}
+        while True:
+            rows = cursor.fetchmany(READ_CHUNK_ROWS)
+            if not rows:
+                break
+            for key_hash, blob in rows:
+                blobs_by_key.setdefault(key_hash, []).append(blob)
+
+        stats = []
+        for key_hash, blobs in blobs_by_key.items():
+            key = conn.execute("SELECT test_id, template, options, num_questions, answers FROM answer_keys "
+                               "WHERE key_hash = ?", (key_hash,)).fetchone()
+            if key is None:
+                continue
+            key_test_id, template, options, num_questions, key_blob = key
+            key_marks = unpack_marks([key_blob], num_questions, len(options))[0]
+            analysis = item_analysis(unpack_marks(blobs, num_questions, len(options)), key_marks, list(options))
+            stats.append(dict(analysis, key_hash=key_hash, test_id=key_test_id, template=template))
+        return stats
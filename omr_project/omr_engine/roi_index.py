@@ -0,0 +1,40 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from . import template_config as config
+
+# --- BẢNG TỌA ĐỘ CÁC Ô CỦA MẪU PHIẾU MẶC ĐỊNH ---
+# Bảng được biên dịch 1 lần từ file JSON mẫu phiếu (template_registry.SheetTemplate.sheet_xy).
+# Mỗi bảng là mảng int (N, 2) gồm các cặp (x, y) của góc trên-trái từng ô.
+# Thứ tự giống hệt các vòng lặp cũ: cột/câu trước, lựa chọn sau.
+
+# Toàn bộ phiếu theo thứ tự: Mã đề -> SBD -> Đáp án
+SHEET_XY = config.DEFAULT_TEMPLATE.sheet_xy
+TEST_ID_SLICE = config.DEFAULT_TEMPLATE.field_slice("test_id")
+SBD_SLICE = config.DEFAULT_TEMPLATE.field_slice("sbd")
+ANSWER_SLICE = config.DEFAULT_TEMPLATE.answer_slice
+
+TEST_ID_XY = SHEET_XY[TEST_ID_SLICE]
+SBD_XY = SHEET_XY[SBD_SLICE]
+ANSWER_XY = SHEET_XY[ANSWER_SLICE]
+
+
+# --- CẮT TẤT CẢ CÁC Ô BẰNG 1 PHÉP TOÁN MẢNG ---
+def extract_rois(gray, coords=SHEET_XY, bubble_size=None):
+    """
+    Cắt tất cả các ô của ảnh xám `gray` theo bảng tọa độ `coords` (N, 2).
+    bubble_size: (rộng, cao) của ô, mặc định (BUBBLE_W, BUBBLE_H).
+    Trả về (rois, valid):
+      - rois: mảng uint8 (N, cao, rộng)
+      - valid: mảng bool (N,), False nếu ô tràn ra ngoài ảnh (ô đó để toàn 0)
+    """
+    w, h = bubble_size or (config.BUBBLE_W, config.BUBBLE_H)
+    x = coords[:, 0]
+    y = coords[:, 1]
+    valid = (x >= 0) & (y >= 0) & (x + w <= gray.shape[1]) & (y + h <= gray.shape[0])
+
+    rois = np.zeros((len(coords), h, w), dtype=gray.dtype)
+    if gray.shape[0] >= h and gray.shape[1] >= w:
+        # View (H-h+1, W-w+1, h, w) không sao chép dữ liệu; fancy indexing chỉ copy N ô cần lấy
+        windows = sliding_window_view(gray, (h, w))
+        rois[valid] = windows[y[valid], x[valid]]
+    return rois, valid
@@ -0,0 +1,130 @@
+import numpy as np
+
+# --- CHẤM ĐIỂM VÀ PHÂN TÍCH CÂU HỎI BẰNG MẢNG ---
+# Bài làm và đáp án đều là mảng bool "ô được tô":
+#   1 phiếu : (số câu, số lựa chọn)
+#   cả lô   : (số phiếu, số câu, số lựa chọn)
+# Mọi phép chấm/thống kê là phép toán NumPy trên cả lô; chỉ chuyển sang chuỗi "A" / "A|C" / "X"
+# ở đầu ra (API, CSV) bằng render_answers.
+
+BLANK_ANSWER = "X"
+MULTI_ANSWER_SEPARATOR = "|"
+# Tỉ lệ phiếu điểm cao nhất / thấp nhất dùng để tính độ phân biệt (chỉ số Kelley 27%)
+DISCRIMINATION_GROUP_RATIO = 0.27
+
+
+# --- 1. CHUYỂN ĐỔI CHUỖI <-> MẢNG ---
+def answers_to_marks(answers, options, num_questions=None):
+    """
+    Chuỗi đáp án ("A", "A|C", "X") -> mảng bool (số câu, số lựa chọn).
+    answers: dict {câu: chuỗi} hoặc list; chỉ dùng cho dữ liệu cũ (đáp án đã lưu dạng chuỗi).
+    """
+    if isinstance(answers, dict):
+        answers = [answers[q] for q in sorted(answers)]
+    num_questions = len(answers) if num_questions is None else num_questions
+    option_index = {option: idx for idx, option in enumerate(options)}
+    marks = np.zeros((num_questions, len(options)), dtype=bool)
+    for q_num, answer in enumerate(answers[:num_questions]):
+        for choice in str(answer).split(MULTI_ANSWER_SEPARATOR):
+            if choice in option_index:
+                marks[q_num, option_index[choice]] = True
+    return marks
+
+def as_marks(answers, options, num_questions=None):
+    """Nhận mảng bool hoặc chuỗi đáp án, luôn trả về mảng bool."""
+    if isinstance(answers, np.ndarray) and answers.dtype == bool:
+        return answers
+    return answers_to_marks(answers, options, num_questions)
+
+def render_answers(marks, options):
+    """Mảng bool (số câu, số lựa chọn) của 1 phiếu -> dict {câu (từ 0): "A" / "A|C" / "X"}."""
+    options = np.asarray(options)
+    return {q_num: MULTI_ANSWER_SEPARATOR.join(options[row]) if row.any() else BLANK_ANSWER
+            for q_num, row in enumerate(np.asarray(marks, dtype=bool))}
+
+
+# --- 2. CHẤM ĐIỂM CẢ LÔ ---
+def score_marks(marks, key_marks):
+    """
+    Chấm 1 phiếu (Q, O) hoặc cả lô (S, Q, O) với đáp án (Q, O).
+    1 câu đúng khi tập ô được tô trùng khít với đáp án (giống so sánh chuỗi trước đây).
+    Trả về dict các mảng: correct / blank / multi (..., Q) và total_correct / total_blank /
+    total_multi / score_10 (...,).
+    """
+    marks = np.asarray(marks, dtype=bool)
+    key_marks = np.asarray(key_marks, dtype=bool)
+    if marks.shape[-2:] != key_marks.shape:
+        raise ValueError(f"Bài làm có kích thước {marks.shape[-2:]}, đáp án có kích thước {key_marks.shape}")
+
+    num_questions = key_marks.shape[0]
+    correct = (marks == key_marks).all(axis=-1)
+    num_marked = marks.sum(axis=-1)
+    blank = num_marked == 0
+    multi = num_marked > 1
+    total_correct = correct.sum(axis=-1)
+    return {
+        "correct": correct,
+        "blank": blank,
+        "multi": multi,
+        "total_correct": total_correct,
+        "total_blank": blank.sum(axis=-1),
+        "total_multi": multi.sum(axis=-1),
+        "score_10": total_correct * (10.0 / num_questions) if num_questions else np.zeros_like(total_correct, float),
+    }
+
+
+# --- 3. PHÂN TÍCH CÂU HỎI CẢ LỚP ---
+def item_analysis(marks, key_marks, options):
+    """
+    Thống kê cả lô bài làm (S, Q, O) theo đáp án (Q, O). Trả về dict (dùng được với json.dumps):
+      - difficulty: tỉ lệ phiếu làm đúng từng câu (càng nhỏ càng khó)
+      - discrimination: tỉ lệ đúng nhóm 27% điểm cao trừ nhóm 27% điểm thấp
+      - option_rates: tỉ lệ phiếu tô từng lựa chọn; distractor = lựa chọn sai được tô nhiều nhất
+    """
+    marks = np.asarray(marks, dtype=bool)
+    key_marks = np.asarray(key_marks, dtype=bool)
+    scores = score_marks(marks, key_marks)
+    num_sheets = len(marks)
+    if num_sheets == 0:
+        return {"num_sheets": 0, "questions": []}
+
+    difficulty = scores["correct"].mean(axis=0)
+    blank_rate = scores["blank"].mean(axis=0)
+    multi_rate = scores["multi"].mean(axis=0)
+    option_rates = marks.mean(axis=0)                            # (Q, O)
+    distractor_rates = np.where(key_marks, -1.0, option_rates)   # Bỏ qua lựa chọn đúng
+    top_distractor = distractor_rates.argmax(axis=1)
+    has_distractor = distractor_rates.max(axis=1) > 0
+
+    # Độ phân biệt: nhóm điểm cao và nhóm điểm thấp (sắp xếp ổn định để kết quả lặp lại được)
+    group_size = max(1, int(round(num_sheets * DISCRIMINATION_GROUP_RATIO)))
+    order = np.argsort(scores["total_correct"], kind="stable")
+    discrimination = (scores["correct"][order[-group_size:]].mean(axis=0) -
+                      scores["correct"][order[:group_size]].mean(axis=0))
+
+    total_correct = scores["total_correct"]
+    options = list(options)
+    key_strings = render_answers(key_marks, options)
+    questions = []
+    for q_num in range(key_marks.shape[0]):
+        questions.append({
+            "question": q_num,
+            "key": key_strings[q_num],
+            "difficulty": round(float(difficulty[q_num]), 4),
+            "discrimination": round(float(discrimination[q_num]), 4),
+            "blank_rate": round(float(blank_rate[q_num]), 4),
+            "multi_rate": round(float(multi_rate[q_num]), 4),
+            "option_rates": {option: round(float(rate), 4) for option, rate in zip(options, option_rates[q_num])},
+            "top_distractor": options[top_distractor[q_num]] if has_distractor[q_num] else None,
+        })
+
+    return {
+        "num_sheets": num_sheets,
+        "num_questions": int(key_marks.shape[0]),
+        "mean_correct": round(float(total_correct.mean()), 4),
+        "std_correct": round(float(total_correct.std()), 4),
+        "min_correct": int(total_correct.min()),
+        "max_correct": int(total_correct.max()),
+        "mean_score_10": round(float(scores["score_10"].mean()), 4),
+        "questions": questions,
+    }
@@ -0,0 +1,260 @@
+import numpy as np
+from . import template_config as config
+
+# --- NẮN PHỐI CẢNH PHIẾU TRẢ LỜI ---
+# 1. Tìm 4 ô vuông đen ở 4 góc phiếu (fiducials của mẫu phiếu) trên ảnh đã thu nhỏ (pyrDown) nếu ảnh quá lớn
+# 2. Nếu không thấy: tìm mép tờ giấy trên nền tối và nắn về DST_RECT
+# 3. Nếu vẫn không thấy: chỉ resize như phiên bản đơn giản trước đây
+# Ma trận homography ánh xạ thẳng ảnh GỐC -> ảnh chuẩn, nên resize + nắn chỉ tốn 1 lần remap.
+
+
+def _pyramid_level(gray):
+    """
+    Thu nhỏ ảnh bằng pyrDown, nhưng không để cạnh dài nhỏ hơn ALIGN_DETECT_MIN_SIDE
+    (ô mốc chỉ rộng ~7px trên ảnh chuẩn, thu nhỏ quá sẽ mất). Trả về (ảnh nhỏ, hệ số).
+    """
+    import cv2
+    scale = 1.0
+    while max(gray.shape[:2]) // 2 >= config.ALIGN_DETECT_MIN_SIDE:
+        gray = cv2.pyrDown(gray)
+        scale *= 0.5
+    return gray, scale
+
+def _order_corners(points):
+    """Sắp xếp 4 điểm theo thứ tự: trên-trái, trên-phải, dưới-phải, dưới-trái."""
+    points = np.asarray(points, dtype=np.float32)
+    s = points.sum(axis=1)
+    d = points[:, 0] - points[:, 1]
+    return np.array([points[np.argmin(s)], points[np.argmax(d)],
+                     points[np.argmax(s)], points[np.argmin(d)]], dtype=np.float32)
+
+def _plausible_quad(quad, image_shape, expected_aspect, min_area_ratio):
+    """Kiểm tra tứ giác có lồi, đủ lớn và có tỉ lệ cạnh gần đúng với mong đợi không."""
+    import cv2
+    if not cv2.isContourConvex(quad.reshape(-1, 1, 2)):
+        return False
+    area = cv2.contourArea(quad)
+    if area < min_area_ratio * image_shape[0] * image_shape[1]:
+        return False
+    top, right = np.linalg.norm(quad[1] - quad[0]), np.linalg.norm(quad[2] - quad[1])
+    bottom, left = np.linalg.norm(quad[2] - quad[3]), np.linalg.norm(quad[3] - quad[0])
+    if min(top, bottom) < 0.7 * max(top, bottom) or min(left, right) < 0.7 * max(left, right):
+        return False
+    aspect = (top + bottom) / (left + right)
+    return abs(aspect - expected_aspect) <= config.ALIGN_ASPECT_TOLERANCE * expected_aspect
+
+def _quad_aspect(quad):
+    """Tỉ lệ rộng/cao trung bình của tứ giác (TL, TR, BR, BL)."""
+    return ((quad[1, 0] - quad[0, 0]) + (quad[2, 0] - quad[3, 0])) / \
+           ((quad[3, 1] - quad[0, 1]) + (quad[2, 1] - quad[1, 1]))
+
+def detect_fiducials(small_gray, fiducial_centers=None, fiducial_side=None):
+    """
+    Tìm 4 ô vuông đen ở 4 góc phiếu trên ảnh xám đã thu nhỏ.
+    fiducial_centers / fiducial_side: vị trí và cỡ ô mốc trên ảnh chuẩn (mặc định: mẫu phiếu mặc định).
+    Trả về mảng (4, 2) tâm các ô (thứ tự TL, TR, BR, BL) hoặc None.
+    """
+    import cv2
+    expected = config.FIDUCIAL_CENTERS if fiducial_centers is None else fiducial_centers
+    fiducial_side = config.FIDUCIAL_SIDE if fiducial_side is None else fiducial_side
+    h, w = small_gray.shape[:2]
+    # Ô mốc đen đặc (tối hơn nền giấy rất nhiều); khung kẻ màu xám nhạt sát bên cạnh bị loại nhờ ngưỡng cao
+    block = max(3, (w // 20) | 1)
+    binary = cv2.adaptiveThreshold(small_gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV,
+                                   block, config.ALIGN_MARKER_MIN_CONTRAST)
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(binary)
+    # Độ sáng trung bình của từng thành phần: mốc thật là mực đen đặc, cụm nhiễu/nét chữ thì xám hơn
+    mean_gray = np.bincount(labels.ravel(), weights=small_gray.ravel(), minlength=num_labels)[1:] / \
+                np.maximum(stats[1:, cv2.CC_STAT_AREA], 1)
+
+    # Ô vuông mốc rộng ~7/793 bề ngang phiếu; chấp nhận kích thước trong một khoảng rộng
+    min_side = max(2, int(w * config.ALIGN_MARKER_MIN_SIDE_RATIO))
+    max_side = max(min_side + 1, int(w * config.ALIGN_MARKER_MAX_SIDE_RATIO))
+    bw, bh, area = stats[1:, cv2.CC_STAT_WIDTH], stats[1:, cv2.CC_STAT_HEIGHT], stats[1:, cv2.CC_STAT_AREA]
+    is_marker = ((bw >= min_side) & (bw <= max_side) & (bh >= min_side) & (bh <= max_side) &
+                 (np.minimum(bw, bh) >= 0.6 * np.maximum(bw, bh)) & (area >= 0.6 * bw * bh) &
+                 (mean_gray <= config.ALIGN_MARKER_MAX_GRAY))
+    candidates = centroids[1:][is_marker]
+    sides = np.sqrt(area[is_marker].astype(np.float32))
+    if len(candidates) < 4:
+        return None
+
+    # Mỗi góc ảnh chọn ứng viên gần góc đó nhất (nằm trong đúng góc phần tư)
+    image_corners = np.array([[0, 0], [w, 0], [w, h], [0, h]], dtype=np.float32)
+    in_left, in_top = candidates[:, 0] < w / 2, candidates[:, 1] < h / 2
+    quadrant_masks = [in_left & in_top, ~in_left & in_top, ~in_left & ~in_top, in_left & ~in_top]
+    corners, corner_sides = [], []
+    for corner, mask in zip(image_corners, quadrant_masks):
+        if not mask.any():
+            return None
+        best = np.flatnonzero(mask)[np.argmin(np.linalg.norm(candidates[mask] - corner, axis=1))]
+        corners.append(candidates[best])
+        corner_sides.append(sides[best])
+    quad = np.array(corners, dtype=np.float32)
+
+    # Kích thước 4 ô phải khớp với kích thước mốc suy ra từ khoảng cách giữa chúng
+    # (loại trường hợp mốc thật nằm ngoài ảnh và bong bóng đã tô bị chọn nhầm)
+    quad_width = (np.linalg.norm(quad[1] - quad[0]) + np.linalg.norm(quad[2] - quad[3])) / 2
+    expected_side = quad_width * fiducial_side / np.linalg.norm(expected[1] - expected[0])
+    ratio = np.array(corner_sides) / expected_side
+    tolerance = config.ALIGN_MARKER_SIZE_TOLERANCE
+    if (ratio < 1 / tolerance).any() or (ratio > tolerance).any():
+        return None
+
+    if not _plausible_quad(quad, small_gray.shape, _quad_aspect(expected), config.ALIGN_MIN_AREA_RATIO):
+        return None
+    return quad
+
+def detect_page_quad(small_gray, expected_aspect=None):
+    """
+    Tìm mép tờ giấy (sáng) trên nền tối. expected_aspect: tỉ lệ rộng/cao của phiếu (mặc định: mẫu phiếu mặc định).
+    Trả về mảng (4, 2) các góc (TL, TR, BR, BL) hoặc None.
+    """
+    import cv2
+    _, binary = cv2.threshold(cv2.GaussianBlur(small_gray, (5, 5), 0), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    page = max(contours, key=cv2.contourArea)
+    approx = cv2.approxPolyDP(page, 0.02 * cv2.arcLength(page, True), True)
+    if len(approx) != 4:
+        return None
+    quad = _order_corners(approx.reshape(4, 2))
+    # Góc chạm mép ảnh: tờ giấy bị cắt mất một phần, mép tìm được không phải mép thật
+    h, w = small_gray.shape[:2]
+    margin = 2
+    if ((quad[:, 0] <= margin) | (quad[:, 0] >= w - 1 - margin) |
+            (quad[:, 1] <= margin) | (quad[:, 1] >= h - 1 - margin)).any():
+        return None
+
+    if expected_aspect is None:
+        expected_aspect = config.WARPED_IMAGE_WIDTH / config.WARPED_IMAGE_HEIGHT
+    if not _plausible_quad(quad, small_gray.shape, expected_aspect, config.ALIGN_MIN_AREA_RATIO):
+        return None
+    # Chỉ tin mép giấy khi nền bên ngoài thực sự tối hơn tờ giấy
+    mask = np.zeros(small_gray.shape[:2], dtype=np.uint8)
+    cv2.fillConvexPoly(mask, quad.astype(np.int32), 255)
+    if mask.all():
+        return None
+    inside = small_gray[mask > 0].mean()
+    outside = small_gray[mask == 0].mean()
+    if inside - outside < config.ALIGN_PAGE_MIN_CONTRAST:
+        return None
+    return quad
+
+def detect_template(image, templates):
+    """
+    Nhận diện loại phiếu theo vị trí 4 ô mốc: thử hình học ô mốc của từng mẫu phiếu có mốc,
+    chọn mẫu có tỉ lệ khung mốc khớp nhất với ảnh. Trả về SheetTemplate hoặc None.
+    """
+    import cv2
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small, _ = _pyramid_level(gray)
+    best, best_error = None, None
+    for template in templates:
+        if template.fiducial_centers is None:
+            continue
+        quad = detect_fiducials(small, template.fiducial_centers, template.fiducial_side)
+        if quad is None:
+            continue
+        expected_aspect = _quad_aspect(template.fiducial_centers)
+        error = abs(_quad_aspect(quad) - expected_aspect) / expected_aspect
+        if best_error is None or error < best_error:
+            best, best_error = template, error
+    return best
+
+
+class SheetAligner:
+    """
+    Nắn ảnh phiếu về kích thước chuẩn của mẫu phiếu `template` (mặc định: mẫu phiếu mặc định).
+    reuse_homography=True: dùng cho camera tài liệu cố định (nhiều khung hình liên tiếp cùng vị trí):
+    bảng remap được tính 1 lần và dùng lại, chỉ dò lại mốc sau mỗi `redetect_every` khung hình,
+    hoặc ngay khi các ô mốc không còn nằm đúng chỗ trên ảnh đã nắn (phiếu bị xê dịch).
+    """
+
+    def __init__(self, template=None, reuse_homography=False, redetect_every=30):
+        self.template = template or config.DEFAULT_TEMPLATE
+        self.reuse_homography = reuse_homography
+        self.redetect_every = redetect_every
+        self.last_method = None
+        self._cached = None # (kích thước ảnh vào, homography, map1, map2, phương pháp)
+        self._frames_since_detect = 0
+
+    def find_homography(self, image):
+        """
+        Tìm homography ảnh gốc -> ảnh chuẩn. Trả về (H, phương pháp):
+        phương pháp là "fiducials", "page" hoặc "resize" (không tìm thấy gì, chỉ co giãn).
+        """
+        import cv2
+        template = self.template
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if config.ENABLE_PERSPECTIVE_WARP:
+            small, scale = _pyramid_level(gray)
+            if template.fiducial_centers is not None:
+                quad = detect_fiducials(small, template.fiducial_centers, template.fiducial_side)
+                if quad is not None:
+                    return cv2.getPerspectiveTransform(quad / scale, template.fiducial_centers), "fiducials"
+            quad = detect_page_quad(small, template.width / template.height)
+            if quad is not None:
+                return cv2.getPerspectiveTransform(quad / scale, template.dst_rect), "page"
+
+        h, w = gray.shape[:2]
+        src = np.array([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]], dtype=np.float32)
+        return cv2.getPerspectiveTransform(src, template.dst_rect), "resize"
+
+    def _markers_in_place(self, warped):
+        """
+        Ảnh nắn bằng homography cũ còn đúng không: trong ô cửa sổ nhỏ quanh vị trí chuẩn của mỗi ô mốc,
+        tâm các điểm mực đậm phải lệch không quá ALIGN_REUSE_MAX_DRIFT cạnh ô mốc (rẻ hơn nhiều so với dò lại
+        mốc trên cả ảnh). Mẫu phiếu không có ô mốc: không kiểm được.
+        """
+        template = self.template
+        if template.fiducial_centers is None:
+            return True
+        side = template.fiducial_side
+        max_drift = side * config.ALIGN_REUSE_MAX_DRIFT
+        radius = int(round(side * 2))
+        for cx, cy in template.fiducial_centers:
+            x0, y0 = max(int(round(cx)) - radius, 0), max(int(round(cy)) - radius, 0)
+            window = warped[y0:int(round(cy)) + radius + 1, x0:int(round(cx)) + radius + 1]
+            if window.ndim == 3:
+                window = window.min(axis=2)
+            ys, xs = np.nonzero(window <= config.ALIGN_MARKER_MAX_GRAY)
+            if len(xs) == 0 or abs(x0 + xs.mean() - cx) > max_drift or abs(y0 + ys.mean() - cy) > max_drift:
+                return False
+        return True
+
+    def warp(self, image):
+        """Trả về ảnh đã nắn (cùng số kênh với ảnh vào)."""
+        import cv2
+        size = (self.template.width, self.template.height)
+
+        if self.reuse_homography:
+            cached = self._cached
+            if (cached is not None and cached[0] == image.shape[:2]
+                    and self._frames_since_detect < self.redetect_every):
+                warped = cv2.remap(image, cached[2], cached[3], cv2.INTER_LINEAR,
+                                   borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255))
+                if self._markers_in_place(warped):
+                    self._frames_since_detect += 1
+                    self.last_method = cached[4]
+                    return warped
+                # Phiếu đã bị xê dịch: dò lại mốc ngay
+
+        H, method = self.find_homography(image)
+        self.last_method = method
+        if method == "resize":
+            # Không nắn được: giữ đúng hành vi cũ (cv2.resize)
+            return cv2.resize(image, size)
+        if not self.reuse_homography:
+            return cv2.warpPerspective(image, H, size, flags=cv2.INTER_LINEAR, borderValue=(255, 255, 255))
+
+        # Tính sẵn bảng remap (dạng số nguyên cố định, remap nhanh hơn) để dùng lại cho các khung sau
+        grid_x, grid_y = np.meshgrid(np.arange(size[0], dtype=np.float32), np.arange(size[1], dtype=np.float32))
+        dst = np.stack([grid_x, grid_y], axis=-1).reshape(-1, 1, 2)
+        src = cv2.perspectiveTransform(dst, np.linalg.inv(H)).reshape(size[1], size[0], 2)
+        map1, map2 = cv2.convertMaps(src[..., 0], src[..., 1], cv2.CV_16SC2)
+        self._cached = (image.shape[:2], H, map1, map2, method)
+        self._frames_since_detect = 0
+        return cv2.remap(image, map1, map2, cv2.INTER_LINEAR,
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255))
@@ -0,0 +1,302 @@
+import argparse
+import json
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from . import metrics
+from .grader import (select_template, check_sheet_quality, collect_sheet_rois, classify_bubbles,
+                     decode_sheet_marks, build_result, grade_paper)
+from .preprocess import warp_sheet
+from .scoring import answers_to_marks
+from .sheet_alignment import SheetAligner
+from .template_registry import TemplateError, get_template, resolve_template, AUTO_TEMPLATE
+
+# --- CHẤM PHIẾU TỪ VIDEO / CAMERA ---
+# Luồng chính đọc khung hình (cv2.VideoCapture) và chỉ làm việc rất rẻ: băm cảm nhận (dHash) khung hình
+# thu nhỏ để biết khi nào cảnh đã đứng yên. Mỗi lần cảnh đứng yên đủ lâu thì gửi ĐÚNG 1 khung hình
+# sang luồng nền để nắn + chấm; các khung gần giống nhau sau đó bị bỏ qua.
+# Luồng nền bỏ các khung không có phiếu (không thấy ô mốc / mép giấy) và các phiếu đã chấm rồi, nên mỗi phiếu
+# chỉ được chấm 1 lần. Phiếu trùng = cùng mẫu phiếu + SBD + mã đề (KHÔNG so các ô đáp án: đọc lại cùng 1 phiếu
+# có thể lật 1 ô tô mờ). Nếu SBD/mã đề đọc không đủ ('X'), cần thêm: khung giống nhau (dHash) và gần như
+# cùng các ô tô, để 2 phiếu khác nhau cùng bỏ trống SBD không bị coi là trùng.
+
+HASH_SIZE = 8                # dHash 8x8 = 64 bit
+MOTION_THRESHOLD = 6         # Khác nhau <= số bit này giữa 2 khung liên tiếp = cảnh đứng yên
+DEFAULT_STABLE_FRAMES = 5    # Số khung đứng yên liên tiếp trước khi chấm
+DEFAULT_QUEUE_SIZE = 4       # Số khung chờ chấm tối đa (camera: đầy thì bỏ khung, không làm chậm việc đọc)
+SEEN_SHEETS_LIMIT = 1024     # Số phiếu đã chấm được nhớ để chống chấm trùng
+DUPLICATE_HASH_DISTANCE = MOTION_THRESHOLD # SBD/mã đề đọc không đủ: khung cách nhau <= số bit này ...
+DUPLICATE_MAX_CHANGED_MARKS = 2            # ... và khác nhau <= số ô tô này thì là cùng 1 phiếu
+DEFAULT_REDETECT_EVERY = 30  # --fixed-camera: dò lại mốc sau số khung này (dùng lại phép nắn ở giữa)
+
+
+# --- 1. BĂM CẢM NHẬN KHUNG HÌNH ---
+def dhash(image, hash_size=HASH_SIZE):
+    """
+    Difference hash: thu nhỏ về (hash_size+1) x hash_size, so sánh độ sáng các điểm ảnh kề nhau.
+    Trả về số nguyên hash_size*hash_size bit. Tốn < 1ms kể cả với khung Full HD.
+    """
+    import cv2
+    small = cv2.resize(image, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def hamming(hash_a, hash_b):
+    """Số bit khác nhau giữa 2 mã băm."""
+    return (hash_a ^ hash_b).bit_count()
+
+
+class StableFrameDetector:
+    """
+    Phát hiện thời điểm cảnh vừa đứng yên: update() trả về True đúng 1 lần cho mỗi đoạn đứng yên
+    (sau `stable_frames` khung liên tiếp gần giống nhau). Khi cảnh chuyển động (tay đưa phiếu mới vào)
+    thì bắt đầu đếm lại.
+    """
+
+    def __init__(self, stable_frames=DEFAULT_STABLE_FRAMES, motion_threshold=MOTION_THRESHOLD):
+        self.stable_frames = stable_frames
+        self.motion_threshold = motion_threshold
+        self._previous = None
+        self._stable_count = 0
+
+    def update(self, frame):
+        current = dhash(frame)
+        if self._previous is not None and hamming(current, self._previous) <= self.motion_threshold:
+            self._stable_count += 1
+        else:
+            self._stable_count = 0
+        self._previous = current
+        return self._stable_count == self.stable_frames
+
+
+# --- 2. CHẤM Ở LUỒNG NỀN ---
+class StreamGrader:
+    """
+    Luồng nền chấm các khung hình được gửi tới bằng submit().
+    on_result(result) được gọi (từ luồng nền) cho mỗi phiếu MỚI đã chấm; result có thêm "frame" và "time_ms"
+    (vị trí trong file video, hoặc thời điểm Unix tính bằng ms với camera).
+    drop_when_busy=True (camera): hàng đợi đầy thì bỏ khung, không bao giờ làm chậm việc đọc camera.
+    drop_when_busy=False (file video): chờ chỗ trống, không bỏ phiếu nào.
+    fixed_camera=True (camera tài liệu gắn cố định): dùng lại homography giữa các khung
+    (SheetAligner reuse_homography), chỉ dò lại mốc sau mỗi `redetect_every` khung.
+    """
+
+    def __init__(self, on_result, answer_key=None, template=None, classifier_mode=None,
+                 queue_size=DEFAULT_QUEUE_SIZE, drop_when_busy=True, fixed_camera=False,
+                 redetect_every=DEFAULT_REDETECT_EVERY):
+        self.on_result = on_result
+        self.answer_key = answer_key
+        self.template = template
+        self.classifier_mode = classifier_mode
+        self.drop_when_busy = drop_when_busy
+        self.fixed_camera = fixed_camera
+        self.redetect_every = redetect_every
+        self.stats = {"submitted": 0, "dropped": 0, "no_sheet": 0, "rejected": 0, "duplicates": 0, "graded": 0,
+                      "errors": 0}
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._aligners = {} # Tên mẫu phiếu -> SheetAligner riêng của luồng nền
+        self._seen = OrderedDict() # (mẫu phiếu, mã đề, SBD) -> [(dHash khung, các ô tô)] của phiếu đã chấm (LRU)
+        self._worker = threading.Thread(target=self._worker_loop, name="stream-grader", daemon=True)
+        self._worker.start()
+
+    def submit(self, frame, frame_index, time_ms):
+        """Gửi 1 khung hình đi chấm. Trả về False nếu khung bị bỏ (hàng đợi đầy)."""
+        try:
+            self._queue.put((frame, frame_index, time_ms), block=not self.drop_when_busy)
+        except queue.Full:
+            self.stats["dropped"] += 1
+            return False
+        self.stats["submitted"] += 1
+        return True
+
+    def close(self):
+        """Chờ chấm xong các khung còn trong hàng đợi rồi dừng luồng nền."""
+        self._queue.put(None)
+        self._worker.join()
+
+    def _aligner(self, template):
+        aligner = self._aligners.get(template.name)
+        if aligner is None:
+            aligner = self._aligners[template.name] = SheetAligner(
+                template, reuse_homography=self.fixed_camera, redetect_every=self.redetect_every)
+        return aligner
+
+    def _worker_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            frame, frame_index, time_ms = item
+            try:
+                result = self._grade_frame(frame)
+            except Exception as e:
+                print(f"Lỗi khi chấm khung hình {frame_index}: {e}", file=sys.stderr)
+                metrics.record_error(type(e).__name__)
+                self.stats["errors"] += 1
+                continue
+            if result is not None:
+                result["frame"] = frame_index
+                result["time_ms"] = round(time_ms, 1)
+                self.on_result(result)
+
+    def _grade_frame(self, frame):
+        """Chấm 1 khung hình; None nếu không có phiếu hoặc phiếu đã được chấm."""
+        template = select_template(frame, self.template)
+        aligner = self._aligner(template)
+        with metrics.stage("warp"):
+            _, warped_gray = warp_sheet(frame, template, aligner)
+        if aligner.last_method == "resize":
+            # Không thấy ô mốc / mép giấy: trong khung không có phiếu
+            self.stats["no_sheet"] += 1
+            return None
+        if check_sheet_quality(warped_gray, template) is not None:
+            # Khung mờ (đang di chuyển), lóa...: bỏ qua, chờ khung đứng yên tiếp theo
+            self.stats["rejected"] += 1
+            return None
+
+        rois, valid = collect_sheet_rois(warped_gray, template)
+        probs, _ = classify_bubbles(rois, valid, self.classifier_mode)
+        test_id, sbd, answer_marks = decode_sheet_marks(probs, template=template)
+
+        if self._is_duplicate((template.name, test_id, sbd), dhash(frame), answer_marks):
+            self.stats["duplicates"] += 1
+            return None
+
+        self.stats["graded"] += 1
+        return build_result(test_id, sbd, answer_marks, self.answer_key, template)
+
+
+    def _is_duplicate(self, signature, frame_hash, answer_marks):
+        """Phiếu đã chấm chưa (xem đầu file); nếu chưa thì ghi nhớ lại."""
+        test_id, sbd = signature[1], signature[2]
+        ids_readable = "X" not in test_id and "X" not in sbd
+        seen = self._seen.get(signature)
+        if seen is not None:
+            self._seen.move_to_end(signature)
+            if ids_readable or any(hamming(frame_hash, seen_hash) <= DUPLICATE_HASH_DISTANCE and
+                                   int((seen_marks != answer_marks).sum()) <= DUPLICATE_MAX_CHANGED_MARKS
+                                   for seen_hash, seen_marks in seen):
+                return True
+            seen.append((frame_hash, answer_marks))
+            return False
+        self._seen[signature] = [(frame_hash, answer_marks)]
+        if len(self._seen) > SEEN_SHEETS_LIMIT:
+            self._seen.popitem(last=False)
+        return False
+
+
+# --- 3. ĐỌC VIDEO / CAMERA ---
+def open_capture(source):
+    """Mở file video hoặc thiết bị camera (số thứ tự, vd: "0"). Trả về (capture, là_camera)."""
+    import cv2
+    is_device = str(source).isdigit()
+    capture = cv2.VideoCapture(int(source) if is_device else source)
+    if not capture.isOpened():
+        raise IOError(f"Không mở được nguồn video: {source}")
+    return capture, is_device
+
+def grade_stream(source, on_result, answer_key=None, template=None, classifier_mode=None,
+                 stable_frames=DEFAULT_STABLE_FRAMES, max_frames=None, drop_when_busy=None,
+                 fixed_camera=False, redetect_every=DEFAULT_REDETECT_EVERY):
+    """
+    Đọc khung hình từ `source` và chấm từng phiếu khác nhau đúng 1 lần (xem StreamGrader).
+    drop_when_busy mặc định: True với camera, False với file video.
+    fixed_camera / redetect_every: xem StreamGrader.
+    Trả về thống kê (dict).
+    """
+    import cv2
+    capture, is_device = open_capture(source)
+    grader = StreamGrader(on_result, answer_key, template, classifier_mode,
+                          drop_when_busy=is_device if drop_when_busy is None else drop_when_busy,
+                          fixed_camera=fixed_camera, redetect_every=redetect_every)
+    detector = StableFrameDetector(stable_frames)
+    frames = 0
+    start = time.perf_counter()
+    try:
+        while max_frames is None or frames < max_frames:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            frames += 1
+            if detector.update(frame):
+                # Camera không có "vị trí trong video" (CAP_PROP_POS_MSEC trả về 0 / giá trị rác)
+                time_ms = time.time() * 1000.0 if is_device else capture.get(cv2.CAP_PROP_POS_MSEC)
+                grader.submit(frame, frames - 1, time_ms)
+    finally:
+        capture.release()
+        grader.close()
+
+    elapsed = time.perf_counter() - start
+    stats = dict(grader.stats, frames=frames, seconds=round(elapsed, 3),
+                 frames_per_second=round(frames / elapsed, 1) if elapsed > 0 else None)
+    return stats
+
+
+# --- 4. DÒNG LỆNH ---
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chấm phiếu trả lời từ file video hoặc camera.")
+    parser.add_argument("source", help="File video, hoặc số thứ tự camera (vd: 0)")
+    parser.add_argument("-o", "--output", default="-", help="File kết quả JSONL (mặc định: stdout)")
+    parser.add_argument("-k", "--answer-key", default=None, help="Ảnh phiếu đáp án để chấm điểm")
+    parser.add_argument("-t", "--template", default=None,
+                        help="Tên mẫu phiếu, hoặc 'auto' để nhận diện từng phiếu (mặc định: mẫu mặc định)")
+    parser.add_argument("--classifier", choices=["cnn", "tiered"], default=None,
+                        help="Chế độ phân loại ô (mặc định: theo template_config.CLASSIFIER_MODE)")
+    parser.add_argument("--stable-frames", type=int, default=DEFAULT_STABLE_FRAMES,
+                        help="Số khung đứng yên liên tiếp trước khi chấm")
+    parser.add_argument("--max-frames", type=int, default=None, help="Dừng sau số khung này")
+    parser.add_argument("--fixed-camera", action="store_true",
+                        help="Camera gắn cố định: dùng lại phép nắn phiếu giữa các khung thay vì dò mốc mỗi khung")
+    parser.add_argument("--redetect-every", type=int, default=DEFAULT_REDETECT_EVERY,
+                        help="Với --fixed-camera: dò lại mốc sau số khung đã chấm này")
+    args = parser.parse_args(argv)
+
+    template = args.template
+    if template not in (None, AUTO_TEMPLATE):
+        try:
+            template = resolve_template(template)
+        except TemplateError as e:
+            parser.error(str(e))
+
+    answer_key = None
+    if args.answer_key:
+        key_result = grade_paper(args.answer_key, classifier_mode=args.classifier, template=template)
+        if key_result.get("status") != "success":
+            print(f"Không thể đọc file đáp án: {key_result.get('error')}", file=sys.stderr)
+            return 1
+        key_template = get_template(key_result["template"])
+        answer_key = answers_to_marks(key_result["student_answers"], key_template.options, key_template.num_questions)
+        template = key_template # Bài làm đọc theo đúng mẫu phiếu của đáp án
+
+    output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    def write_result(result):
+        output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output.flush()
+
+    try:
+        stats = grade_stream(args.source, write_result, answer_key=answer_key, template=template,
+                             classifier_mode=args.classifier, stable_frames=args.stable_frames,
+                             max_frames=args.max_frames, fixed_camera=args.fixed_camera,
+                             redetect_every=args.redetect_every)
+    except IOError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print(f"--- Đã đọc {stats['frames']} khung ({stats['frames_per_second']} khung/giây): "
+          f"chấm {stats['graded']} phiếu, bỏ {stats['duplicates']} phiếu trùng, "
+          f"{stats['no_sheet']} khung không có phiếu, {stats['rejected']} khung chất lượng kém, "
+          f"{stats['dropped']} khung bị bỏ do bận ---", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
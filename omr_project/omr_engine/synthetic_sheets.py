@@ -0,0 +1,139 @@
+import numpy as np
+from . import template_config as config
+from .template_registry import resolve_template
+
+# --- SINH PHIẾU TRẢ LỜI GIẢ LẬP (CÓ ĐÁP ÁN ĐÚNG) ---
+# Vẽ phiếu theo bảng tọa độ của mẫu phiếu (ô mốc + các ô tròn), tô ngẫu nhiên theo `fill`,
+# rồi làm "bẩn" ảnh như ảnh chụp thật: nghiêng/phối cảnh, mờ, nhiễu, nén JPEG.
+# Dùng cho benchmark.py (đo tốc độ + độ chính xác khi không có ảnh thật được gán nhãn).
+
+FILL_PATTERNS = ("single", "mixed", "dense")
+# "mixed": tỉ lệ câu bỏ trống / tô nhiều ô
+MIXED_BLANK_RATE = 0.1
+MIXED_MULTI_RATE = 0.05
+# Bán kính ô tô (theo cạnh ô) và độ lệch tâm ngẫu nhiên tối đa (px trên ảnh chuẩn), đo từ phiếu thật
+FILL_RADIUS_RATIO = 0.36
+FILL_POSITION_JITTER = 1.5
+OUTLINE_GRAY = 150
+BACKGROUND_GRAY = 60 # Nền tối quanh tờ giấy (khi có nghiêng)
+
+
+# --- 1. ĐÁP ÁN ĐÚNG NGẪU NHIÊN ---
+def random_answer_marks(template, rng, fill="single"):
+    """Mảng bool (số câu, số lựa chọn) các ô được tô theo kiểu `fill`."""
+    if fill not in FILL_PATTERNS:
+        raise ValueError(f"Kiểu tô không hợp lệ: '{fill}' (chọn: {', '.join(FILL_PATTERNS)})")
+    shape = (template.num_questions, template.num_options)
+    if fill == "dense":
+        return rng.random(shape) < 0.5
+
+    marks = np.zeros(shape, dtype=bool)
+    marks[np.arange(shape[0]), rng.integers(0, shape[1], shape[0])] = True
+    if fill == "mixed":
+        roll = rng.random(shape[0])
+        marks[roll < MIXED_BLANK_RATE] = False
+        multi = roll > 1 - MIXED_MULTI_RATE
+        marks[multi, rng.integers(0, shape[1], int(multi.sum()))] = True
+    return marks
+
+def random_ids(template, rng):
+    """Chỉ số ô được tô của từng cột chữ số, cho mỗi trường ID: dict tên -> mảng (num_digits,)."""
+    return {field["name"]: rng.integers(0, field["num_options"], field["num_digits"])
+            for field in template.id_fields}
+
+
+# --- 2. VẼ PHIẾU ---
+def draw_sheet(template, answer_marks, id_choices, rng, scale=1.0, ink=(10, 60)):
+    """
+    Vẽ phiếu "sạch" (ảnh xám, kích thước chuẩn x scale).
+    ink: khoảng độ đậm của mực tô (0 = đen tuyệt đối).
+    """
+    import cv2
+    width, height = int(round(template.width * scale)), int(round(template.height * scale))
+    sheet = np.full((height, width), 255, dtype=np.uint8)
+
+    if template.fiducial_centers is not None:
+        half = template.fiducial_side * scale / 2
+        for cx, cy in template.fiducial_centers * scale:
+            cv2.rectangle(sheet, (int(round(cx - half)), int(round(cy - half))),
+                          (int(round(cx + half)), int(round(cy + half))), 0, -1)
+
+    # Ô được tô: ID (1 ô mỗi cột) + đáp án, theo đúng thứ tự của sheet_xy
+    filled = np.zeros(len(template.sheet_xy), dtype=bool)
+    for field in template.id_fields:
+        choices = id_choices[field["name"]]
+        filled[field["slice"].start + np.arange(len(choices)) * field["num_options"] + choices] = True
+    filled[template.answer_slice] = answer_marks.ravel()
+
+    centers = (template.sheet_xy + np.array(template.bubble_size) / 2.0) * scale
+    radius = FILL_RADIUS_RATIO * min(template.bubble_size) * scale
+    jitter = rng.uniform(-FILL_POSITION_JITTER, FILL_POSITION_JITTER, centers.shape) * scale
+    darkness = rng.integers(ink[0], ink[1] + 1, len(centers))
+    shift = 4 # Vẽ với độ chính xác 1/16 px
+    for (cx, cy), (jx, jy), is_filled, gray in zip(centers, jitter, filled, darkness):
+        center = (int(round(cx * (1 << shift))), int(round(cy * (1 << shift))))
+        r = int(round(radius * (1 << shift)))
+        cv2.circle(sheet, center, r, OUTLINE_GRAY, 1, cv2.LINE_AA, shift)
+        if is_filled:
+            fill_center = (int(round((cx + jx) * (1 << shift))), int(round((cy + jy) * (1 << shift))))
+            cv2.circle(sheet, fill_center, r, int(gray), -1, cv2.LINE_AA, shift)
+    return sheet
+
+
+# --- 3. LÀM "BẨN" ẢNH NHƯ ẢNH CHỤP ---
+def degrade(sheet, rng, skew=0.0, blur=0.0, noise=0.0, margin=0.06):
+    """
+    skew: độ xê dịch ngẫu nhiên tối đa của 4 góc giấy (tỉ lệ theo cạnh) -> phối cảnh + xoay nhẹ.
+    blur: sigma Gaussian (px); noise: độ lệch chuẩn nhiễu Gaussian (mức xám).
+    Khi skew > 0, tờ giấy được đặt trên nền tối có lề `margin`.
+    """
+    import cv2
+    image = sheet
+    if skew > 0:
+        h, w = sheet.shape[:2]
+        pad_x, pad_y = int(w * margin), int(h * margin)
+        src = np.array([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]], dtype=np.float32)
+        jitter = rng.uniform(-skew, skew, (4, 2)) * np.array([w, h])
+        dst = (src + np.array([pad_x, pad_y]) + jitter).astype(np.float32)
+        H = cv2.getPerspectiveTransform(src, dst)
+        image = cv2.warpPerspective(sheet, H, (w + 2 * pad_x, h + 2 * pad_y),
+                                    flags=cv2.INTER_LINEAR, borderValue=BACKGROUND_GRAY)
+    if blur > 0:
+        image = cv2.GaussianBlur(image, (0, 0), blur)
+    if noise > 0:
+        image = np.clip(image + rng.normal(0, noise, image.shape), 0, 255).astype(np.uint8)
+    return image
+
+def render_sheet(template=None, rng=None, fill="single", scale=1.3, skew=0.0, blur=0.0, noise=0.0,
+                 jpeg_quality=90):
+    """
+    Sinh 1 phiếu giả lập. Trả về (dữ liệu ảnh JPEG (bytes), đáp án đúng):
+    đáp án đúng là dict {"test_id", "sbd" (chuỗi), "answer_marks" (mảng bool), "template" (tên)}.
+    jpeg_quality=None: trả về ảnh xám chưa nén (mảng) thay cho bytes.
+    """
+    import cv2
+    template = resolve_template(template)
+    rng = rng if rng is not None else np.random.default_rng()
+    answer_marks = random_answer_marks(template, rng, fill)
+    id_choices = random_ids(template, rng)
+    image = degrade(draw_sheet(template, answer_marks, id_choices, rng, scale), rng, skew, blur, noise)
+
+    truth = {"template": template.name, "answer_marks": answer_marks}
+    for field in template.id_fields:
+        truth[field["name"]] = "".join(field["digit_values"][id_choices[field["name"]]])
+    truth.setdefault("test_id", "")
+    truth.setdefault("sbd", "")
+
+    if jpeg_quality is None:
+        return image, truth
+    ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)])
+    if not ok:
+        raise RuntimeError("Không nén được ảnh JPEG")
+    return encoded.tobytes(), truth
+
+def generate_sheets(count, seed=0, template=None, **options):
+    """Sinh lần lượt `count` phiếu (lặp lại được với cùng seed). Sinh ra (bytes, đáp án đúng)."""
+    rng = np.random.default_rng(seed)
+    template = resolve_template(template if template is not None else config.DEFAULT_TEMPLATE)
+    for _ in range(count):
+        yield render_sheet(template, rng, **options)
@@ -1,52 +1,85 @@
+import os
 import numpy as np
+from .template_registry import get_template
 
 # --- 1.CẤU HÌNH LAYOUT PHIẾU TRẢ LỜI ---
+# Layout các loại phiếu được khai báo trong omr_engine/sheet_templates/*.json (xem template_registry.py).
+# Các hằng số dưới đây lấy từ mẫu phiếu MẶC ĐỊNH (OMR_DEFAULT_TEMPLATE), dành cho những chỗ
+# chỉ làm việc với 1 loại phiếu (vd: training/prepare_data.py).
+DEFAULT_TEMPLATE = get_template()
 
 # Kích thước ảnh chuẩn sau khi nắn thẳng
-WARPED_IMAGE_WIDTH = 793 
-WARPED_IMAGE_HEIGHT = 1122 
-
-# --- TỌA ĐỘ CÁC Ô ĐÁP ÁN ---
-# (Các giá trị này của bạn đã đúng)
-START_X_COL_1 = 138
-START_X_COL_2 = 290
-START_X_COL_3 = 444
-START_X_COL_4 = 598
-START_Y_ROWS = 466
-OPTION_X_SPACING = 20 
-QUESTION_Y_SPACING = 38 
-BUBBLE_W = 20 
-BUBBLE_H = 20
-MODEL_INPUT_IMG_SIZE = (20, 20)
-
-NUM_QUESTIONS = 60
-NUM_OPTIONS = 4 # A, B, C, D
-QUESTIONS_PER_COLUMN = 15
-OPTIONS_MAP = {0: 'A', 1: 'B', 2: 'C', 3: 'D'}
+WARPED_IMAGE_WIDTH = DEFAULT_TEMPLATE.width
+WARPED_IMAGE_HEIGHT = DEFAULT_TEMPLATE.height
+
+BUBBLE_W = DEFAULT_TEMPLATE.bubble_w
+BUBBLE_H = DEFAULT_TEMPLATE.bubble_h
+MODEL_INPUT_IMG_SIZE = (20, 20) # Kích thước đầu vào của model (không phụ thuộc loại phiếu)
+
+NUM_QUESTIONS = DEFAULT_TEMPLATE.num_questions
+NUM_OPTIONS = DEFAULT_TEMPLATE.num_options # A, B, C, D
+OPTIONS_MAP = DEFAULT_TEMPLATE.options_map
 
 # --- 2.CẤU HÌNH LAYOUT MÃ ĐỀ (TEST ID) ---
-NUM_TEST_ID_DIGITS = 3
-NUM_TEST_ID_OPTIONS = 10 # (0-9)
-TEST_ID_START_X = 294 
-TEST_ID_START_Y = 218 
-TEST_ID_X_SPACING = 20
-TEST_ID_Y_SPACING = 20
+NUM_TEST_ID_DIGITS = DEFAULT_TEMPLATE.field("test_id")["num_digits"]
+NUM_TEST_ID_OPTIONS = DEFAULT_TEMPLATE.field("test_id")["num_options"] # (0-9)
 
-ID_BUBBLE_MAP = [1, 2, 3, 4, 5, 6, 7, 8, 9, 0]
+# Giá trị của từng ô trong 1 cột SBD/Mã đề, từ trên xuống (phiếu in 1, 2, ..., 9, 0)
+ID_BUBBLE_MAP = [int(v) for v in DEFAULT_TEMPLATE.field("test_id")["digit_values"]]
 
 # --- 3.CẤU HÌNH LAYOUT SỐ BÁO DANH (SBD) ---
-NUM_SBD_DIGITS = 6
-NUM_SBD_OPTIONS = 10 # (0-9)
-SBD_START_X = 63 
-SBD_START_Y = 218
-SBD_X_SPACING = 20
-SBD_Y_SPACING = 20
-
-ID_BUBBLE_MAP = [1, 2, 3, 4, 5, 6, 7, 8, 9, 0]
+NUM_SBD_DIGITS = DEFAULT_TEMPLATE.field("sbd")["num_digits"]
+NUM_SBD_OPTIONS = DEFAULT_TEMPLATE.field("sbd")["num_options"] # (0-9)
 
 # --- 4.CẤU HÌNH HỆ THỐNG ---
-DST_RECT = np.array([
-    [0, 0],
-    [WARPED_IMAGE_WIDTH - 1, 0],
-    [WARPED_IMAGE_WIDTH - 1, WARPED_IMAGE_HEIGHT - 1],
-    [0, WARPED_IMAGE_HEIGHT - 1]], dtype="float32")
\ No newline at end of file
+DST_RECT = DEFAULT_TEMPLATE.dst_rect
+
+# --- 5.CẤU HÌNH PHÂN LOẠI NHANH (TIERED) ---
+# "cnn": mọi ô đều qua model (mặc định)
+# "tiered": tính tỉ lệ điểm ảnh tối của từng ô; ô chắc chắn trống/tô được quyết định ngay,
+#           chỉ những ô nằm trong "vùng không chắc chắn" mới gửi qua model
+CLASSIFIER_MODE = os.environ.get('OMR_CLASSIFIER_MODE', 'cnn').lower()
+FAST_PATH_DARK_PIXEL_THRESHOLD = 128 # Điểm ảnh có giá trị < ngưỡng này được coi là "tối"
+FAST_PATH_EMPTY_MAX_RATIO = 0.05     # Tỉ lệ tối <= giá trị này -> chắc chắn TRỐNG
+FAST_PATH_FILLED_MIN_RATIO = 0.30    # Tỉ lệ tối trong [MIN, MAX] -> chắc chắn ĐÃ TÔ
+FAST_PATH_FILLED_MAX_RATIO = 0.50    # (ô tô kín chỉ chiếm ~40% khung 20x20; cao hơn là ảnh tối/bất thường)
+
+# --- 6.CẤU HÌNH NẮN PHỐI CẢNH ---
+ENABLE_PERSPECTIVE_WARP = True
+# Tâm 4 ô vuông mốc ở 4 góc phiếu và cạnh ô mốc: khai báo trong file mẫu phiếu ("fiducials")
+FIDUCIAL_CENTERS = DEFAULT_TEMPLATE.fiducial_centers
+FIDUCIAL_SIDE = DEFAULT_TEMPLATE.fiducial_side
+ALIGN_DETECT_MIN_SIDE = 1100        # Ảnh lớn được thu nhỏ (pyrDown) để dò mốc, nhưng cạnh dài không nhỏ hơn giá trị này
+ALIGN_MARKER_MIN_SIDE_RATIO = 0.004 # Kích thước ô mốc (so với bề ngang ảnh)
+ALIGN_MARKER_MAX_SIDE_RATIO = 0.02
+ALIGN_MARKER_SIZE_TOLERANCE = 1.6   # Ô mốc được chọn phải có cạnh trong khoảng [1/1.6, 1.6] lần cạnh mong đợi
+ALIGN_MARKER_MIN_CONTRAST = 90      # Ô mốc phải tối hơn trung bình vùng lân cận ít nhất chừng này
+ALIGN_MARKER_MAX_GRAY = 90          # ... và bản thân phải đủ tối (mực đen đặc)
+ALIGN_MIN_AREA_RATIO = 0.25         # Tứ giác tìm được phải chiếm ít nhất 25% diện tích ảnh
+ALIGN_ASPECT_TOLERANCE = 0.2        # Sai lệch cho phép của tỉ lệ ngang/dọc
+ALIGN_PAGE_MIN_CONTRAST = 40        # Tờ giấy phải sáng hơn nền xung quanh ít nhất chừng này
+ALIGN_REUSE_MAX_DRIFT = 0.3         # Camera cố định: ô mốc lệch quá 0.3 cạnh ô mốc so với vị trí chuẩn thì dò lại homography
+
+# --- 7.CẤU HÌNH GIẢI MÃ ẢNH ---
+# Ảnh JPEG lớn (ảnh chụp điện thoại) được giải mã thẳng ở ảnh xám, thu nhỏ 2/4/8 lần trong miền DCT
+# (xem image_io.py), miễn là ảnh thu được vẫn lớn hơn DECODE_MIN_SCALE lần kích thước mẫu phiếu.
+# Tăng DECODE_MIN_SCALE nếu tờ phiếu thường chỉ chiếm 1 phần nhỏ của ảnh chụp.
+REDUCED_DECODE = os.environ.get('OMR_REDUCED_DECODE', '1') != '0'
+DECODE_MIN_SCALE = 1.0
+
+# --- 8.CẤU HÌNH KIỂM TRA CHẤT LƯỢNG ẢNH (TRƯỚC KHI GỌI MODEL) ---
+# Ảnh đã nắn được đo trên bản thu nhỏ (xem quality_gate.py); ảnh không đạt bị từ chối ngay, không qua model.
+# Ngưỡng đo trên 523 ảnh thật trong training/Dataset và các bản làm mờ / làm tối / làm nhạt của chúng.
+QUALITY_GATE = os.environ.get('OMR_QUALITY_GATE', '1') != '0'
+QUALITY_DOWNSAMPLE = 2           # Đo trên ảnh thu nhỏ 2 lần (~400x560)
+QUALITY_INK_PERCENTILE = 1       # Mức "mực" = phân vị 1 độ sáng, mức "giấy" = phân vị 95
+QUALITY_PAPER_PERCENTILE = 95
+QUALITY_MIN_CONTRAST = 25        # Giấy - mực; ảnh thật >= 98, ảnh tối x0.15 (vẫn chấm đúng) = 35
+QUALITY_MIN_PAPER_GRAY = 30      # Ảnh thật >= 153; model vẫn đọc đúng ảnh tối x0.15 (giấy = 38)
+QUALITY_MAX_INK_GRAY = 125       # Ảnh thật <= 67; ảnh lóa có mực ~120 còn đọc được 98%, mực ~140 chỉ còn 41%
+QUALITY_MIN_SHARPNESS = 0.038    # Ảnh thật >= 0.116; mờ sigma 3 = 0.041 (đọc đúng 99%), sigma 3.5 = 0.035 (90%)
+QUALITY_MAX_SHARPNESS = 0.8      # Ảnh thật <= 0.37; nhiễu hạt / không phải giấy ~1.1
+# Ô mốc: chỉ bắt buộc khi bật (phần lớn ảnh scan đã cắt sát mép trong dữ liệu không thấy rõ ô mốc)
+QUALITY_REQUIRE_MARKERS = os.environ.get('OMR_QUALITY_REQUIRE_MARKERS', '0') == '1'
+QUALITY_MARKER_MIN_CONTRAST = 30 # Ô mốc phải tối hơn vùng quanh nó ít nhất chừng này
+QUALITY_MIN_MARKERS = 3          # Số ô mốc tối thiểu phải thấy (trên 4)
@@ -0,0 +1,265 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from .scoring import render_answers
+
+# --- KHO MẪU PHIẾU (TEMPLATE) ---
+# Mỗi loại phiếu được khai báo trong 1 file JSON (xem sheet_templates/standard_60.json).
+# File được "biên dịch" 1 lần thành bảng tọa độ NumPy + kế hoạch giải mã, rồi giữ trong bộ nhớ:
+# 1 tiến trình có thể chấm nhiều loại phiếu mà không phải tải lại gì.
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sheet_templates')
+# Thêm thư mục chứa mẫu phiếu riêng (nhiều thư mục cách nhau bởi os.pathsep)
+EXTRA_TEMPLATE_DIRS = [d for d in os.environ.get('OMR_TEMPLATE_DIRS', '').split(os.pathsep) if d]
+DEFAULT_TEMPLATE_NAME = os.environ.get('OMR_DEFAULT_TEMPLATE', 'standard_60')
+# Tên đặc biệt: tự nhận diện loại phiếu theo ô mốc (xem sheet_alignment.detect_template)
+AUTO_TEMPLATE = "auto"
+
+
+class TemplateError(ValueError):
+    """Mẫu phiếu không tồn tại hoặc file khai báo không hợp lệ."""
+
+
+# --- 1. TÍNH BẢNG TỌA ĐỘ ---
+def _grid_coordinates(origin, spacing, num_digits, num_options):
+    """Tọa độ lưới SBD/Mã đề: duyệt từng cột chữ số, trong mỗi cột duyệt các ô từ trên xuống."""
+    digit_idx, option_num = np.meshgrid(np.arange(num_digits), np.arange(num_options), indexing="ij")
+    x = origin[0] + digit_idx * spacing[0]
+    y = origin[1] + option_num * spacing[1]
+    return np.stack([x.ravel(), y.ravel()], axis=1).astype(np.intp)
+
+def _answer_coordinates(spec, num_options):
+    """Tọa độ các ô đáp án: duyệt từng câu, trong mỗi câu duyệt các lựa chọn. Số cột tùy ý."""
+    col_start_x = np.asarray(spec["columns_x"])
+    q_num, opt_idx = np.meshgrid(np.arange(spec["num_questions"]), np.arange(num_options), indexing="ij")
+    x = col_start_x[q_num // spec["questions_per_column"]] + opt_idx * spec["option_spacing"]
+    y = spec["start_y"] + (q_num % spec["questions_per_column"]) * spec["question_spacing"]
+    return np.stack([x.ravel(), y.ravel()], axis=1).astype(np.intp)
+
+def _require(layout, path, kind):
+    """Lấy layout[a][b]... (khóa số = chỉ số trong list) và kiểm tra kiểu; báo lỗi rõ ràng nếu thiếu."""
+    value = layout
+    for key in path:
+        if isinstance(key, int):
+            found = isinstance(value, list) and 0 <= key < len(value)
+        else:
+            found = isinstance(value, dict) and key in value
+        if not found:
+            raise TemplateError(f"Thiếu trường '{'.'.join(map(str, path))}'")
+        value = value[key]
+    if not isinstance(value, kind) or isinstance(value, bool):
+        raise TemplateError(f"Trường '{'.'.join(map(str, path))}' có kiểu không hợp lệ")
+    return value
+
+def _require_pair(layout, path):
+    """Lấy 1 cặp số [a, b] (kích thước, tọa độ, khoảng cách). Trả về tuple."""
+    value = _require(layout, path, list)
+    if len(value) != 2 or not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in value):
+        raise TemplateError(f"Trường '{'.'.join(map(str, path))}' phải gồm đúng 2 số")
+    return tuple(value)
+
+
+# --- 2. MẪU PHIẾU ĐÃ BIÊN DỊCH ---
+class SheetTemplate:
+    """
+    1 loại phiếu đã biên dịch:
+      - sheet_xy: bảng tọa độ (N, 2) của TẤT CẢ các ô, theo thứ tự: các trường ID (theo khai báo) -> đáp án
+      - id_fields / answer_slice: vị trí từng phần trong sheet_xy (kế hoạch giải mã)
+    Mọi mảng đều chỉ đọc: dùng chung an toàn giữa các luồng.
+    """
+
+    def __init__(self, layout, source=None):
+        self.source = source
+        self.name = _require(layout, ("name",), str)
+        try:
+            self._compile(layout)
+        except TemplateError as e:
+            raise TemplateError(f"Mẫu phiếu '{self.name}' không hợp lệ: {e}") from None
+        canonical = json.dumps(layout, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        self.fingerprint = hashlib.sha256(canonical).hexdigest()
+
+    def _compile(self, layout):
+        self.description = layout.get("description", "")
+        self.width, self.height = _require_pair(layout, ("image_size",))
+        self.bubble_w, self.bubble_h = _require_pair(layout, ("bubble_size",))
+        self.dst_rect = np.array([[0, 0], [self.width - 1, 0],
+                                  [self.width - 1, self.height - 1], [0, self.height - 1]], dtype=np.float32)
+
+        fiducials = layout.get("fiducials")
+        if fiducials:
+            self.fiducial_centers = np.array(_require(layout, ("fiducials", "centers"), list), dtype=np.float32)
+            self.fiducial_side = _require(layout, ("fiducials", "side"), (int, float))
+            if self.fiducial_centers.shape != (4, 2):
+                raise TemplateError("'fiducials.centers' phải gồm đúng 4 điểm (TL, TR, BR, BL)")
+        else:
+            self.fiducial_centers = None # Không có ô mốc: chỉ nắn theo mép giấy / resize
+            self.fiducial_side = None
+
+        answers = _require(layout, ("answers",), dict)
+        self.options = list(_require(layout, ("answers", "options"), list))
+        self.options_map = dict(enumerate(self.options))
+        self.num_options = len(self.options)
+        self.num_questions = _require(layout, ("answers", "num_questions"), int)
+        self.answer_threshold = float(answers.get("threshold", 0.5))
+        columns_needed = -(-self.num_questions // _require(layout, ("answers", "questions_per_column"), int))
+        if len(_require(layout, ("answers", "columns_x"), list)) < columns_needed:
+            raise TemplateError(f"'answers.columns_x' cần ít nhất {columns_needed} cột")
+        for key in ("start_y", "option_spacing", "question_spacing"):
+            _require(layout, ("answers", key), (int, float))
+
+        tables = []
+        self.id_fields = []
+        offset = 0
+        if not isinstance(layout.get("id_fields", []), list):
+            raise TemplateError("Trường 'id_fields' có kiểu không hợp lệ")
+        for i, field in enumerate(layout.get("id_fields", [])):
+            path = ("id_fields", i)
+            digit_values = [str(v) for v in _require(layout, path + ("digit_values",), list)]
+            num_digits = _require(layout, path + ("num_digits",), int)
+            xy = _grid_coordinates(_require_pair(layout, path + ("origin",)), _require_pair(layout, path + ("spacing",)),
+                                   num_digits, len(digit_values))
+            self.id_fields.append({
+                "name": _require(layout, path + ("name",), str),
+                "num_digits": num_digits,
+                "num_options": len(digit_values),
+                "digit_values": np.array(digit_values),
+                "threshold": float(field.get("threshold", 0.3)),
+                "slice": slice(offset, offset + len(xy)),
+            })
+            tables.append(xy)
+            offset += len(xy)
+
+        answer_xy = _answer_coordinates(answers, self.num_options)
+        self.answer_slice = slice(offset, offset + len(answer_xy))
+        tables.append(answer_xy)
+
+        self.sheet_xy = np.concatenate(tables)
+        self.sheet_xy.setflags(write=False)
+        if (self.sheet_xy < 0).any() or (self.sheet_xy[:, 0] + self.bubble_w > self.width).any() or \
+                (self.sheet_xy[:, 1] + self.bubble_h > self.height).any():
+            raise TemplateError("Có ô nằm ngoài khung ảnh chuẩn 'image_size'")
+
+    @property
+    def bubble_size(self):
+        return (self.bubble_w, self.bubble_h)
+
+    def field(self, name):
+        """Thông tin trường ID `name` (None nếu phiếu không có trường này)."""
+        for field in self.id_fields:
+            if field["name"] == name:
+                return field
+        return None
+
+    def field_slice(self, name):
+        """Vị trí của trường ID `name` trong sheet_xy (slice rỗng nếu phiếu không có trường này)."""
+        field = self.field(name)
+        return field["slice"] if field else slice(0, 0)
+
+    def decode_ids(self, probs):
+        """Giải mã các trường ID (mỗi cột chọn ô có xác suất cao nhất vượt ngưỡng). Trả về dict tên -> chuỗi."""
+        ids = {}
+        for field in self.id_fields:
+            grid = probs[field["slice"]].reshape(field["num_digits"], field["num_options"])
+            best = grid.argmax(axis=1)
+            marked = grid[np.arange(len(best)), best] > field["threshold"]
+            ids[field["name"]] = "".join(np.where(marked, field["digit_values"][best], "X"))
+        return ids
+
+    def answer_marks(self, probs, threshold=None):
+        """Mảng bool (số câu, số lựa chọn): ô đáp án nào được tô."""
+        threshold = self.answer_threshold if threshold is None else threshold
+        return probs[self.answer_slice].reshape(self.num_questions, self.num_options) > threshold
+
+    def decode_answers(self, probs, threshold=None):
+        """Giải mã đáp án: dict {câu (từ 0): "A" / "A|C" / "X" (bỏ trống)}."""
+        return render_answers(self.answer_marks(probs, threshold), self.options)
+
+    def describe(self):
+        """Thông tin tóm tắt (để trả về qua API)."""
+        return {
+            "name": self.name,
+            "description": self.description,
+            "num_questions": self.num_questions,
+            "options": self.options,
+            "id_fields": {field["name"]: field["num_digits"] for field in self.id_fields},
+            "has_fiducials": self.fiducial_centers is not None,
+        }
+
+
+# --- 3. TÌM, TẢI VÀ LƯU CACHE CÁC MẪU PHIẾU ---
+_templates = {} # tên -> SheetTemplate (đã biên dịch)
+_template_paths = None # tên -> đường dẫn file JSON (quét thư mục 1 lần)
+_registry_lock = threading.Lock()
+
+def load_template_file(path):
+    """Đọc và biên dịch 1 file JSON mẫu phiếu."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            layout = json.load(f)
+    except (OSError, ValueError) as e:
+        raise TemplateError(f"Không đọc được file mẫu phiếu {path}: {e}") from None
+    return SheetTemplate(layout, source=path)
+
+def _discover_templates():
+    """Quét các thư mục mẫu phiếu: tên mẫu = tên file (bỏ .json). Thư mục thêm sau ghi đè thư mục trước."""
+    paths = {}
+    for directory in [TEMPLATE_DIR] + EXTRA_TEMPLATE_DIRS:
+        if not os.path.isdir(directory):
+            print(f"Cảnh báo: Không tìm thấy thư mục mẫu phiếu: {directory}")
+            continue
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.json'):
+                paths[name[:-len('.json')]] = os.path.join(directory, name)
+    return paths
+
+def list_templates():
+    """Tên tất cả các mẫu phiếu có thể dùng."""
+    global _template_paths
+    with _registry_lock:
+        if _template_paths is None:
+            _template_paths = _discover_templates()
+        return sorted(set(_template_paths) | set(_templates))
+
+def get_template(name=None):
+    """
+    Lấy mẫu phiếu đã biên dịch theo tên (None = mẫu mặc định). Chỉ biên dịch lần đầu, sau đó dùng cache.
+    Ném TemplateError nếu không có mẫu này.
+    """
+    name = name or DEFAULT_TEMPLATE_NAME
+    template = _templates.get(name)
+    if template is not None:
+        return template
+
+    list_templates() # Đảm bảo đã quét thư mục
+    with _registry_lock:
+        template = _templates.get(name)
+        if template is None:
+            path = _template_paths.get(name)
+            if path is None:
+                available = ", ".join(sorted(set(_template_paths) | set(_templates)))
+                raise TemplateError(f"Không có mẫu phiếu '{name}' (có: {available})")
+            template = load_template_file(path)
+            if template.name != name:
+                raise TemplateError(f"File {path} khai báo tên '{template.name}', cần trùng tên file '{name}'")
+            _templates[name] = template
+    return template
+
+def register_template(template):
+    """Đăng ký thêm 1 mẫu phiếu (SheetTemplate hoặc dict layout) lúc đang chạy."""
+    if isinstance(template, dict):
+        template = SheetTemplate(template)
+    with _registry_lock:
+        _templates[template.name] = template
+    return template
+
+def resolve_template(template=None):
+    """Nhận None / tên / SheetTemplate, trả về SheetTemplate (không xử lý "auto": cần ảnh để dò)."""
+    if isinstance(template, SheetTemplate):
+        return template
+    if template == AUTO_TEMPLATE:
+        raise TemplateError("Chế độ 'auto' cần ảnh phiếu để nhận diện mẫu")
+    return get_template(template)
@@ -0,0 +1,75 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+# --- ĐỊNH DẠNG "SHARD" CHO DỮ LIỆU Ô ĐÃ CẮT ---
+# Thay cho hàng chục nghìn file PNG nhỏ. Mỗi bộ (train/valid) là 1 thư mục:
+#   packed/<bộ>/index.json          : danh sách phiếu nguồn + danh sách shard + kích thước ô
+#   packed/<bộ>/<shard>/crops.npy   : uint8 (N, H, W)   ảnh ô
+#   packed/<bộ>/<shard>/labels.npy  : uint8 (N,)        0 = trống, 1 = đã tô
+#   packed/<bộ>/<shard>/sheet.npy   : int32 (N,)        chỉ số phiếu trong index.json["sheets"]
+#   packed/<bộ>/<shard>/question.npy: int16 (N,)        số thứ tự câu (bắt đầu từ 0)
+#   packed/<bộ>/<shard>/option.npy  : int8  (N,)        lựa chọn (0 = A, 1 = B, ...)
+# File .npy đọc được bằng np.load(..., mmap_mode='r'): không phải giải mã, không sao chép cả file vào RAM.
+
+FIELDS = {
+    'crops': np.uint8,
+    'labels': np.uint8,
+    'sheet': np.int32,
+    'question': np.int16,
+    'option': np.int8,
+}
+INDEX_FILENAME = 'index.json'
+SHARD_MAX_CROPS = 65536 # ~26MB mỗi shard với ô 20x20
+
+
+def write_packed_split(split_dir, sheets, arrays, extra_index=None, shard_max_crops=SHARD_MAX_CROPS):
+    """
+    Ghi 1 bộ dữ liệu thành các shard.
+    sheets: danh sách tên phiếu nguồn; arrays: dict tên trường -> mảng (N, ...) theo FIELDS.
+    Ghi vào thư mục tạm rồi mới thay thế thư mục cũ: không bao giờ để lại bộ dữ liệu dở dang.
+    """
+    total = len(arrays['crops'])
+    tmp_dir = split_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    shards = []
+    for shard_idx, start in enumerate(range(0, max(total, 1), shard_max_crops)):
+        stop = min(start + shard_max_crops, total)
+        name = f"{shard_idx:05d}"
+        os.makedirs(os.path.join(tmp_dir, name))
+        for field, dtype in FIELDS.items():
+            np.save(os.path.join(tmp_dir, name, f"{field}.npy"), np.ascontiguousarray(arrays[field][start:stop], dtype=dtype))
+        shards.append({'name': name, 'count': stop - start})
+
+    index = {
+        'sheets': list(sheets),
+        'shards': shards,
+        'count': total,
+        'crop_shape': list(arrays['crops'].shape[1:]),
+    }
+    index.update(extra_index or {})
+    with open(os.path.join(tmp_dir, INDEX_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, indent=1)
+
+    shutil.rmtree(split_dir, ignore_errors=True)
+    os.replace(tmp_dir, split_dir)
+    return index
+
+def load_packed_split(split_dir, fields=tuple(FIELDS)):
+    """
+    Mở 1 bộ dữ liệu đã đóng gói (memory-map, không sao chép).
+    Trả về (index, shards): shards là danh sách dict tên trường -> np.memmap.
+    """
+    with open(os.path.join(split_dir, INDEX_FILENAME), 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    shards = []
+    for shard in index['shards']:
+        if shard['count'] == 0:
+            continue
+        shards.append({field: np.load(os.path.join(split_dir, shard['name'], f"{field}.npy"), mmap_mode='r')
+                       for field in fields})
+    return index, shards
@@ -1,11 +1,17 @@
 import cv2
 import numpy as np
 import pandas as pd
+import argparse
+import hashlib
+import json
 import os
+import sys
+import time
+from multiprocessing import Pool
 from tqdm import tqdm
 
 # --- 1. CẤU HÌNH ĐƯỜNG DẪN ---
-SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__)) 
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 # Giả sử cấu trúc là: training/Dataset/train/train_001.jpg
 RAW_DATA_DIR = os.path.join(SCRIPT_DIR, 'Dataset')
 PROCESSED_DATA_DIR = os.path.join(SCRIPT_DIR, 'processed_data')
@@ -13,153 +19,402 @@ LABEL_FILES = {
     'train': os.path.join(SCRIPT_DIR, 'train_labels.csv'),
     'valid': os.path.join(SCRIPT_DIR, 'valid_labels.csv')
 }
+# Ghi lại nguồn (mtime/kích thước/mã băm) + nhãn của từng phiếu đã xử lý, để lần chạy sau bỏ qua
+MANIFEST_PATH = os.path.join(PROCESSED_DATA_DIR, 'manifest.json')
+MANIFEST_SAVE_EVERY = 50 # Lưu manifest sau mỗi N phiếu -> dừng giữa chừng vẫn chạy tiếp được
+# Kết quả cắt của từng phiếu (1 file .npz / phiếu, dùng để chạy tiếp) và dữ liệu đã đóng gói cho train_model.py
+SHEET_CACHE_DIR = os.path.join(PROCESSED_DATA_DIR, 'sheets')
+PACKED_DATA_DIR = os.path.join(PROCESSED_DATA_DIR, 'packed')
+# Ảnh PNG từng ô (processed_data/<bộ>/{0,1}) KHÔNG có sẵn trong repo: chạy `python prepare_data.py --png`
+# để xuất ra (cùng kích thước ô với model hiện tại) khi cần xem bằng mắt hoặc dùng load_data_from_folders.
 # -----------------------------------------------------
 
-# --- 2. CẤU HÌNH LAYOUT (CỦA BẠN) ---
-WARPED_IMAGE_WIDTH = 793 
-WARPED_IMAGE_HEIGHT = 1122 
-START_X_COL_1 = 138
-START_X_COL_2 = 290
-START_X_COL_3 = 444
-START_X_COL_4 = 598
-START_Y_ROWS = 466
-OPTION_X_SPACING = 20
-QUESTION_Y_SPACING = 38
-BUBBLE_W = 20 
-BUBBLE_H = 20
-
-NUM_QUESTIONS = 60
-NUM_OPTIONS = 4 
-QUESTIONS_PER_COLUMN = 15 
-OPTIONS_MAP = {0: 'A', 1: 'B', 2: 'C', 3: 'D'}
+# --- 2. CẤU HÌNH LAYOUT ---
+# Dùng chung layout và bảng tọa độ với omr_engine để dữ liệu huấn luyện
+# được cắt GIỐNG HỆT lúc chấm bài.
+BASE_DIR = os.path.dirname(SCRIPT_DIR)
+sys.path.append(BASE_DIR)
+
+from omr_engine import template_config as config
+from omr_engine.roi_index import ANSWER_XY, ANSWER_SLICE
+from omr_engine.preprocess import PREPROCESS_VERSION, warp_sheet, crop_bubbles, to_model_input
+from crop_shards import load_packed_split, write_packed_split
+
+WARPED_IMAGE_WIDTH = config.WARPED_IMAGE_WIDTH
+WARPED_IMAGE_HEIGHT = config.WARPED_IMAGE_HEIGHT
+NUM_QUESTIONS = config.NUM_QUESTIONS
+NUM_OPTIONS = config.NUM_OPTIONS
+OPTIONS_MAP = config.OPTIONS_MAP
+CROP_SIZE = config.MODEL_INPUT_IMG_SIZE # Ô được lưu đúng kích thước model, lúc huấn luyện không resize nữa
 # -----------------------------------------------------
 
+STAGES = ('decode', 'warp', 'crop', 'write', 'pack')
 
-def get_bubble_coordinates(q_num, opt_idx):
-    """Tính tọa độ (x, y) của 1 ô bong bóng"""
-    col_idx = q_num // QUESTIONS_PER_COLUMN
-    row_idx = q_num % QUESTIONS_PER_COLUMN
-    
-    if col_idx == 0: start_x = START_X_COL_1
-    elif col_idx == 1: start_x = START_X_COL_2
-    elif col_idx == 2: start_x = START_X_COL_3
-    elif col_idx == 3: start_x = START_X_COL_4
-    else:
-        print(f"Lỗi: Chỉ số cột không hợp lệ: {col_idx} cho câu {q_num}")
-        return 0, 0 
-        
-    x = start_x + (opt_idx * OPTION_X_SPACING)
-    y = START_Y_ROWS + (row_idx * QUESTION_Y_SPACING)
-    
-    return int(x), int(y)
-
-def process_data(data_type, label_file_path):
+
+def layout_fingerprint():
     """
-    Hàm chính: Đọc CSV, resize ảnh (KHÔNG NẮN), cắt và lưu.
+    Mã băm của mọi thứ ảnh hưởng tới ô được cắt (tọa độ, kích thước ảnh chuẩn, kích thước ô lưu,
+    phiên bản tiền xử lý, cấu hình nắn ảnh).
+    Đổi layout -> mã băm đổi -> tất cả phiếu được xử lý lại.
     """
-    print(f"\n--- Bắt đầu xử lý bộ: {data_type} ---")
-    
-    output_dir_0 = os.path.join(PROCESSED_DATA_DIR, data_type, '0')
-    output_dir_1 = os.path.join(PROCESSED_DATA_DIR, data_type, '1')
-    os.makedirs(output_dir_0, exist_ok=True)
-    os.makedirs(output_dir_1, exist_ok=True)
-    
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(ANSWER_XY).tobytes())
+    h.update(json.dumps([WARPED_IMAGE_WIDTH, WARPED_IMAGE_HEIGHT, config.BUBBLE_W, config.BUBBLE_H,
+                         list(CROP_SIZE), OPTIONS_MAP, PREPROCESS_VERSION, config.ENABLE_PERSPECTIVE_WARP,
+                         config.FIDUCIAL_CENTERS.tolist()]).encode('utf-8'))
+    return h.hexdigest()
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# --- 3. MANIFEST (CHẠY TIẾP / BỎ QUA PHIẾU ĐÃ XỬ LÝ) ---
+def load_manifest():
+    try:
+        with open(MANIFEST_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(manifest):
+    os.makedirs(PROCESSED_DATA_DIR, exist_ok=True)
+    tmp_path = MANIFEST_PATH + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, MANIFEST_PATH) # Ghi nguyên tử
+
+def is_up_to_date(entry, img_path, answers_str, fingerprint, export_png=False):
+    """
+    Phiếu được coi là đã xử lý nếu nhãn + layout không đổi, file nguồn không đổi và các file đầu ra còn đủ.
+    So mtime/kích thước trước; chỉ tính lại mã băm khi mtime đổi (ví dụ file được copy lại).
+    """
+    if entry is None or entry.get('answers') != answers_str or entry.get('layout') != fingerprint:
+        return False
+    if export_png and not entry.get('png'):
+        return False
+    if not all(os.path.exists(os.path.join(PROCESSED_DATA_DIR, out)) for out in entry['outputs']):
+        return False
+    stat = os.stat(img_path)
+    if stat.st_size != entry['size']:
+        return False
+    if stat.st_mtime != entry['mtime']:
+        if file_hash(img_path) != entry['sha256']:
+            return False
+        entry['mtime'] = stat.st_mtime # Nội dung không đổi -> chỉ cập nhật mtime
+    return True
+
+# --- 4. XỬ LÝ 1 PHIẾU (CHẠY TRONG TIẾN TRÌNH CON) ---
+def read_label_rows(label_file_path):
+    """Đọc file nhãn CSV. Trả về danh sách dict {filename, answers_string, line} hoặc None nếu không có file."""
     try:
         with open(label_file_path, 'r', encoding='utf-8-sig') as f:
             lines = f.readlines()
     except FileNotFoundError:
         print(f"LỖI: Không tìm thấy file {label_file_path}. Bỏ qua...")
-        return
-    
+        return None
+
     data_rows = []
     line_number = 1
-    for line in lines[1:]: 
+    for line in lines[1:]:
         line_number += 1
         line = line.strip()
         if not line:
             continue
         try:
-            filename, answers_str = line.split(';', 1) 
+            filename, answers_str = line.split(';', 1)
             data_rows.append({'filename': filename.strip(), 'answers_string': answers_str.strip(), 'line': line_number})
         except ValueError:
             print(f"Cảnh báo (Dòng {line_number}): Dòng lỗi định dạng (không có dấu chấm phẩy?). Bỏ qua. Dòng: {line}")
             continue
-            
-    for index, row in enumerate(tqdm(data_rows, desc=f"Xử lý {data_type}")):
-        filename = row['filename']
-        answers_str = row['answers_string']
-        line_num = row['line']
-        
-        img_path = os.path.join(RAW_DATA_DIR, data_type, filename)
-        if not os.path.exists(img_path):
-            print(f"\nCảnh báo (Dòng {line_num}): Không tìm thấy file {img_path}. Bỏ qua.")
-            continue
-            
-        image = cv2.imread(img_path)
-        if image is None:
-            print(f"\nCảnh báo (Dòng {line_num}): Không thể đọc file {img_path}. Bỏ qua.")
-            continue
-            
-        # Resize ảnh về đúng kích thước bạn đã đo tọa độ
+    return data_rows
+
+def sheet_cache_path(data_type, filename):
+    """Đường dẫn (tương đối so với PROCESSED_DATA_DIR) của file .npz chứa các ô đã cắt của 1 phiếu."""
+    return os.path.join(os.path.relpath(SHEET_CACHE_DIR, PROCESSED_DATA_DIR), data_type,
+                        f"{os.path.splitext(filename)[0]}.npz")
+
+def process_sheet(task):
+    """
+    Đọc 1 phiếu, nắn và cắt các ô đáp án (cùng hàm với lúc chấm bài) rồi lưu vào 1 file .npz
+    (và thành từng file PNG nếu export_png, để xem bằng mắt khi gỡ lỗi).
+    Trả về dict: key, answers, warning (None nếu thành công), outputs (đường dẫn tương đối),
+    timings (giây mỗi công đoạn).
+    """
+    data_type, row, old_outputs, export_png = task
+    filename = row['filename']
+    answers_str = row['answers_string']
+    line_num = row['line']
+    key = f"{data_type}/{filename}"
+    timings = dict.fromkeys(STAGES, 0.0)
+    result = {'key': key, 'answers': answers_str, 'warning': None, 'outputs': [], 'timings': timings}
+
+    img_path = os.path.join(RAW_DATA_DIR, data_type, filename)
+    if not os.path.exists(img_path):
+        result['warning'] = f"Cảnh báo (Dòng {line_num}): Không tìm thấy file {img_path}. Bỏ qua."
+        return result
+
+    # Lấy chuỗi đáp án
+    student_answers = answers_str.split(',')
+    if len(student_answers) != NUM_QUESTIONS:
+        result['warning'] = (f"Cảnh báo (Dòng {line_num}): Ảnh {filename} có {len(student_answers)} đáp án, "
+                             f"mong đợi {NUM_QUESTIONS}. Bỏ qua.")
+        return result
+
+    t = time.perf_counter()
+    image = cv2.imread(img_path)
+    timings['decode'] = time.perf_counter() - t
+    if image is None:
+        result['warning'] = f"Cảnh báo (Dòng {line_num}): Không thể đọc file {img_path}. Bỏ qua."
+        return result
+
+    # Nắn ảnh về đúng kích thước đã đo tọa độ (giống hệt grader.find_and_warp)
+    t = time.perf_counter()
+    try:
+        _, warped_img = warp_sheet(image)
+    except Exception as e:
+        result['warning'] = f"Lỗi khi nắn ảnh {filename}: {e}. Bỏ qua."
+        return result
+    timings['warp'] = time.perf_counter() - t
+
+    # Cắt tất cả các ô đáp án bằng 1 phép toán mảng (đã đúng kích thước model)
+    t = time.perf_counter()
+    bubble_rois, valid = crop_bubbles(warped_img, ANSWER_XY)
+    crops, labels, questions, options, png_paths = [], [], [], [], []
+    for q_num in range(NUM_QUESTIONS):
+        correct_answers_list = student_answers[q_num].split('|')
+        for opt_idx in range(NUM_OPTIONS):
+            roi_idx = q_num * NUM_OPTIONS + opt_idx
+            if not valid[roi_idx]:
+                continue
+            crops.append(bubble_rois[roi_idx])
+            option_char = OPTIONS_MAP[opt_idx]
+            label = 1 if option_char in correct_answers_list else 0
+            labels.append(label)
+            questions.append(q_num)
+            options.append(opt_idx)
+            out_filename = f"{os.path.splitext(filename)[0]}_q{q_num+1}_opt{option_char}.png"
+            png_paths.append(os.path.join(data_type, str(label), out_filename))
+    timings['crop'] = time.perf_counter() - t
+
+    # Ghi file .npz của phiếu (+ PNG nếu cần), xóa file cũ không còn dùng
+    # (ví dụ nhãn đổi: ô chuyển từ thư mục 0 sang 1)
+    t = time.perf_counter()
+    cache_path = sheet_cache_path(data_type, filename)
+    os.makedirs(os.path.dirname(os.path.join(PROCESSED_DATA_DIR, cache_path)), exist_ok=True)
+    np.savez(os.path.join(PROCESSED_DATA_DIR, cache_path),
+             crops=np.array(crops, dtype=np.uint8).reshape(-1, CROP_SIZE[1], CROP_SIZE[0]),
+             labels=np.array(labels, dtype=np.uint8),
+             question=np.array(questions, dtype=np.int16),
+             option=np.array(options, dtype=np.int8))
+    new_outputs = [cache_path] + (png_paths if export_png else [])
+    for rel_path in set(old_outputs) - set(new_outputs):
         try:
-            resized_img = cv2.resize(image, (WARPED_IMAGE_WIDTH, WARPED_IMAGE_HEIGHT))
-            warped_img = cv2.cvtColor(resized_img, cv2.COLOR_BGR2GRAY)
-        except Exception as e:
-            print(f"\nLỗi khi resize ảnh {filename}: {e}. Bỏ qua.")
+            os.remove(os.path.join(PROCESSED_DATA_DIR, rel_path))
+        except FileNotFoundError:
+            pass
+    if export_png:
+        for rel_path, bubble_img in zip(png_paths, crops):
+            cv2.imwrite(os.path.join(PROCESSED_DATA_DIR, rel_path), bubble_img)
+    timings['write'] = time.perf_counter() - t
+
+    stat = os.stat(img_path)
+    result.update({
+        'outputs': new_outputs,
+        'png': export_png,
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+        'sha256': file_hash(img_path),
+    })
+    return result
+
+# --- 5. XỬ LÝ CẢ BỘ DỮ LIỆU (CHIA CHO NHIỀU TIẾN TRÌNH) ---
+def pack_data(data_type, data_rows, manifest):
+    """
+    Gộp file .npz của các phiếu (theo thứ tự trong CSV) thành shard cho train_model.py.
+    Trả về số ô đã đóng gói.
+    """
+    sheets, parts = [], []
+    for row in data_rows:
+        entry = manifest.get(f"{data_type}/{row['filename']}")
+        if entry is None:
+            continue # Phiếu lỗi / bị bỏ qua
+        with np.load(os.path.join(PROCESSED_DATA_DIR, sheet_cache_path(data_type, row['filename']))) as data:
+            part = {field: data[field] for field in ('crops', 'labels', 'question', 'option')}
+        part['sheet'] = np.full(len(part['labels']), len(sheets), dtype=np.int32)
+        sheets.append(row['filename'])
+        parts.append(part)
+
+    if parts:
+        arrays = {field: np.concatenate([part[field] for part in parts]) for field in parts[0]}
+    else:
+        arrays = {'crops': np.zeros((0, CROP_SIZE[1], CROP_SIZE[0]), dtype=np.uint8),
+                  'labels': np.zeros(0, dtype=np.uint8), 'question': np.zeros(0, dtype=np.int16),
+                  'option': np.zeros(0, dtype=np.int8), 'sheet': np.zeros(0, dtype=np.int32)}
+    index = write_packed_split(os.path.join(PACKED_DATA_DIR, data_type), sheets, arrays,
+                               extra_index={'layout': layout_fingerprint(), 'options': OPTIONS_MAP})
+    print(f"Đã đóng gói {index['count']} ô từ {len(sheets)} phiếu vào: {os.path.join(PACKED_DATA_DIR, data_type)}")
+    return index['count']
+
+def process_data(data_type, label_file_path, manifest, pool=None, force=False, export_png=False):
+    """
+    Hàm chính: Đọc CSV, bỏ qua các phiếu đã xử lý (theo manifest), chia các phiếu còn lại cho các tiến trình con,
+    rồi đóng gói thành shard. Trả về tổng thời gian từng công đoạn (cộng dồn trên mọi tiến trình).
+    """
+    print(f"\n--- Bắt đầu xử lý bộ: {data_type} ---")
+    totals = dict.fromkeys(STAGES, 0.0)
+
+    if export_png:
+        os.makedirs(os.path.join(PROCESSED_DATA_DIR, data_type, '0'), exist_ok=True)
+        os.makedirs(os.path.join(PROCESSED_DATA_DIR, data_type, '1'), exist_ok=True)
+
+    data_rows = read_label_rows(label_file_path)
+    if data_rows is None:
+        return totals
+
+    fingerprint = layout_fingerprint()
+    tasks = []
+    num_skipped = 0
+    for row in data_rows:
+        key = f"{data_type}/{row['filename']}"
+        entry = manifest.get(key)
+        img_path = os.path.join(RAW_DATA_DIR, data_type, row['filename'])
+        if (not force and os.path.exists(img_path)
+                and is_up_to_date(entry, img_path, row['answers_string'], fingerprint, export_png)):
+            num_skipped += 1
             continue
-            
-        # 5. Lấy chuỗi đáp án
-        try:
-            student_answers = answers_str.split(',')
-            if len(student_answers) != NUM_QUESTIONS:
-                 print(f"\nCảnh báo (Dòng {line_num}): Ảnh {filename} có {len(student_answers)} đáp án, mong đợi {NUM_QUESTIONS}. Bỏ qua.")
-                 continue
-        except Exception as e:
-            print(f"Lỗi xử lý đáp án cho {filename}: {e}. Bỏ qua.")
+        # Phiếu phải xử lý lại: bỏ khỏi manifest cho tới khi xử lý xong (lỗi -> không đóng gói dữ liệu cũ)
+        manifest.pop(key, None)
+        tasks.append((data_type, row, entry['outputs'] if entry else [], export_png))
+    print(f"Bỏ qua {num_skipped} phiếu đã xử lý, cần xử lý {len(tasks)} phiếu.")
+
+    results = pool.imap_unordered(process_sheet, tasks) if pool else map(process_sheet, tasks)
+    for done, result in enumerate(tqdm(results, total=len(tasks), desc=f"Xử lý {data_type}"), 1):
+        for stage in STAGES:
+            totals[stage] += result['timings'][stage]
+        if result['warning']:
+            print(f"\n{result['warning']}")
             continue
+        manifest[result['key']] = {
+            'mtime': result['mtime'],
+            'size': result['size'],
+            'sha256': result['sha256'],
+            'answers': result['answers'],
+            'layout': fingerprint,
+            'outputs': result['outputs'],
+            'png': result['png'],
+        }
+        if done % MANIFEST_SAVE_EVERY == 0:
+            save_manifest(manifest)
+    save_manifest(manifest)
 
-        # 6. Lặp qua từng câu hỏi
-        for q_num in range(NUM_QUESTIONS):
-            correct_answers_str = student_answers[q_num]
-            correct_answers_list = correct_answers_str.split('|') 
-            
-            for opt_idx in range(NUM_OPTIONS):
-                x, y = get_bubble_coordinates(q_num, opt_idx)
-                
-                # Cắt ảnh bong bóng từ ảnh đã resize
-                bubble_roi = warped_img[y:y+BUBBLE_H, x:x+BUBBLE_W]
-                
-                if bubble_roi.shape[0] != BUBBLE_H or bubble_roi.shape[1] != BUBBLE_W:
-                    continue
-                
-                # Resize về kích thước chuẩn (28x28) cho model
-                bubble_img = cv2.resize(bubble_roi, (28, 28))
-                
-                option_char = OPTIONS_MAP[opt_idx] 
-                
-                if option_char in correct_answers_list:
-                    save_dir = output_dir_1
-                else:
-                    save_dir = output_dir_0
-                    
-                out_filename = f"{os.path.splitext(filename)[0]}_q{q_num+1}_opt{option_char}.png"
-                save_path = os.path.join(save_dir, out_filename)
-                cv2.imwrite(save_path, bubble_img)
+    t = time.perf_counter()
+    pack_data(data_type, data_rows, manifest)
+    totals['pack'] = time.perf_counter() - t
 
     print(f"Hoàn tất xử lý bộ: {data_type}!")
-    
+    return totals
+
+# --- 6. KIỂM TRA Ô HUẤN LUYỆN == Ô LÚC CHẤM BÀI ---
+def verify_consistency(data_type, max_sheets=None):
+    """
+    Đưa lại các phiếu nguồn qua đường chấm bài của grader (đọc file -> nắn -> cắt -> tensor cho model)
+    và so sánh với tensor tạo từ dữ liệu đóng gói (đầu vào của train_model.py). Phải giống hệt từng giá trị.
+    Trả về số phiếu không khớp.
+    """
+    from omr_engine.grader import load_and_warp, collect_sheet_rois
+
+    index, shards = load_packed_split(os.path.join(PACKED_DATA_DIR, data_type))
+    if not shards:
+        print(f"Bộ {data_type}: không có dữ liệu đóng gói để kiểm tra.")
+        return 0
+    packed = {field: np.concatenate([shard[field] for shard in shards]) for field in shards[0]}
+
+    sheets = index['sheets'][:max_sheets] if max_sheets else index['sheets']
+    num_mismatched = 0
+    for sheet_idx, filename in enumerate(tqdm(sheets, desc=f"Kiểm tra {data_type}")):
+        rows = packed['sheet'] == sheet_idx
+        train_tensor = to_model_input(packed['crops'][rows])
+        roi_idx = packed['question'][rows].astype(np.intp) * NUM_OPTIONS + packed['option'][rows]
+
+        warped_gray, error = load_and_warp(os.path.join(RAW_DATA_DIR, data_type, filename))
+        if error is not None:
+            print(f"\nKHÔNG KHỚP {data_type}/{filename}: lúc chấm bài báo lỗi '{error}'")
+            num_mismatched += 1
+            continue
+        rois, valid = collect_sheet_rois(warped_gray)
+        serve_rois = rois[ANSWER_SLICE][roi_idx]
+        serve_tensor = to_model_input(serve_rois)
+
+        if not valid[ANSWER_SLICE][roi_idx].all() or not np.array_equal(train_tensor, serve_tensor):
+            diff = np.abs(train_tensor - serve_tensor) if train_tensor.shape == serve_tensor.shape else None
+            detail = f"lệch tối đa {diff.max():.0f}" if diff is not None else \
+                     f"kích thước {train_tensor.shape} != {serve_tensor.shape}"
+            print(f"\nKHÔNG KHỚP {data_type}/{filename}: {detail}")
+            num_mismatched += 1
+
+    print(f"Bộ {data_type}: {len(sheets) - num_mismatched}/{len(sheets)} phiếu khớp từng điểm ảnh.")
+    return num_mismatched
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Cắt các ô đáp án từ phiếu đã gán nhãn để huấn luyện model.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="Số tiến trình xử lý song song (mặc định: số lõi CPU)")
+    parser.add_argument('--force', action='store_true',
+                        help="Xử lý lại tất cả phiếu, bỏ qua manifest")
+    parser.add_argument('--png', action='store_true',
+                        help="Xuất thêm từng ô ra file PNG trong processed_data/<bộ>/{0,1} (để xem khi gỡ lỗi)")
+    parser.add_argument('--verify', action='store_true',
+                        help="Sau khi chuẩn bị xong, kiểm tra ô huấn luyện giống hệt ô lúc chấm bài")
+    parser.add_argument('--verify-sheets', type=int, default=None,
+                        help="Chỉ kiểm tra N phiếu đầu tiên của mỗi bộ (mặc định: tất cả)")
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
+    args = parse_args()
     print("Bắt đầu script chuẩn bị dữ liệu...")
     print(f"Script đang chạy từ: {SCRIPT_DIR}")
     print(f"Sẽ đọc dữ liệu thô từ: {RAW_DATA_DIR}")
     print(f"Sẽ lưu dữ liệu đã xử lý vào: {PROCESSED_DATA_DIR}")
-    
-    for data_type, label_file_path in LABEL_FILES.items():
-        process_data(data_type, label_file_path)
-        
+    print(f"Số tiến trình: {args.workers}")
+
+    start = time.perf_counter()
+    manifest = load_manifest()
+    stage_totals = dict.fromkeys(STAGES, 0.0)
+    pool = Pool(args.workers) if args.workers > 1 else None
+    try:
+        for data_type, label_file_path in LABEL_FILES.items():
+            totals = process_data(data_type, label_file_path, manifest, pool=pool,
+                                  force=args.force, export_png=args.png)
+            for stage in STAGES:
+                stage_totals[stage] += totals[stage]
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    wall_time = time.perf_counter() - start
+
     print("\n--- HOÀN TẤT TẤT CẢ --- 🚀")
-    print("Bạn có thể kiểm tra các thư mục sau:")
-    print(f"- {PROCESSED_DATA_DIR}/train/0")
-    print(f"- {PROCESSED_DATA_DIR}/train/1")
-    print(f"- {PROCESSED_DATA_DIR}/valid/0")
-    print(f"- {PROCESSED_DATA_DIR}/valid/1")
\ No newline at end of file
+    print("Thời gian từng công đoạn (cộng dồn trên mọi tiến trình):")
+    for stage in STAGES:
+        print(f"- {stage:<7}: {stage_totals[stage]:.2f}s")
+    print(f"Tổng thời gian thực: {wall_time:.2f}s")
+    print("Dữ liệu cho train_model.py nằm trong các thư mục sau:")
+    print(f"- {PACKED_DATA_DIR}/train")
+    print(f"- {PACKED_DATA_DIR}/valid")
+    if args.png:
+        print("Ảnh PNG từng ô (để gỡ lỗi):")
+        print(f"- {PROCESSED_DATA_DIR}/train/0")
+        print(f"- {PROCESSED_DATA_DIR}/train/1")
+        print(f"- {PROCESSED_DATA_DIR}/valid/0")
+        print(f"- {PROCESSED_DATA_DIR}/valid/1")
+
+    if args.verify:
+        print("\n--- KIỂM TRA TIỀN XỬ LÝ: HUẤN LUYỆN vs CHẤM BÀI ---")
+        num_mismatched = sum(verify_consistency(data_type, args.verify_sheets) for data_type in LABEL_FILES)
+        if num_mismatched:
+            print(f"LỖI: {num_mismatched} phiếu có ô huấn luyện khác ô lúc chấm bài!")
+            sys.exit(1)
+        print("✅ Ô huấn luyện giống hệt ô lúc chấm bài.")
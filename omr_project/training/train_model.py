@@ -1,7 +1,15 @@
 import tensorflow as tf
 from tensorflow.keras.layers import Input, Conv2D, MaxPooling2D, Flatten, Dense, Dropout, Rescaling
 from tensorflow.keras.models import Model
+import argparse
+import json
 import os
+import shutil
+import time
+import zlib
+import numpy as np
+import sys
+from crop_shards import load_packed_split
 
 # --- 1. CẤU HÌNH ---
 # Lấy đường dẫn của thư mục 'training/' hiện tại
@@ -9,22 +17,102 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # Đường dẫn đến dữ liệu đã xử lý 
 PROCESSED_DATA_DIR = os.path.join(SCRIPT_DIR, 'processed_data')
+# Dữ liệu đóng gói (shard .npy) do prepare_data.py tạo ra
+PACKED_TRAIN_DIR = os.path.join(PROCESSED_DATA_DIR, 'packed', 'train')
+PACKED_VALID_DIR = os.path.join(PROCESSED_DATA_DIR, 'packed', 'valid')
+# Cây thư mục PNG (chỉ có khi chạy prepare_data.py --png)
 TRAIN_DIR = os.path.join(PROCESSED_DATA_DIR, 'train')
 VALID_DIR = os.path.join(PROCESSED_DATA_DIR, 'valid')
 
 # Đường dẫn để lưu model sau khi huấn luyện
 MODEL_SAVE_PATH = os.path.join(SCRIPT_DIR, '..', 'data', 'saved_model', 'omr_bubble_model.h5')
+# Các bản xuất gọn nhẹ cho server (không cần TensorFlow khi chấm bài)
+TFLITE_SAVE_PATH = os.path.join(SCRIPT_DIR, '..', 'data', 'saved_model', 'omr_bubble_model.tflite')
+NUMPY_SAVE_PATH = os.path.join(SCRIPT_DIR, '..', 'data', 'saved_model', 'omr_bubble_model.npz')
 
-# Thông số hình ảnh 
-IMG_HEIGHT = 20
-IMG_WIDTH = 20
+# Thông số hình ảnh (lấy từ omr_engine: cùng kích thước với lúc chấm bài)
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+from omr_engine import template_config as omr_config
+from omr_engine.preprocess import to_model_input
+IMG_WIDTH, IMG_HEIGHT = omr_config.MODEL_INPUT_IMG_SIZE
 IMG_CHANNELS = 1 # 1 cho ảnh xám (grayscale)
 
 # Thông số huấn luyện
 BATCH_SIZE = 64
 EPOCHS = 15 
 
+# Các kiến trúc CNN: (số filter của từng lớp Conv, số nơ-ron lớp Dense)
+ARCHITECTURES = {
+    'standard': ((32, 64, 128), 128), # Model gốc (~158k tham số)
+    'slim': ((8, 16, 32), 32),        # ~10k tham số
+    'tiny': ((4, 8), 16),             # ~3.6k tham số
+}
+DEFAULT_ARCHITECTURE = 'standard'
+
+# Tỉa trọng số (pruning): đặt về 0 các trọng số có |w| nhỏ nhất rồi huấn luyện lại vài epoch
+PRUNE_FINE_TUNE_EPOCHS = 3
+# Lượng tử hóa int8: số ô mẫu (từ bộ train) để TFLite đo khoảng giá trị của từng lớp
+REPRESENTATIVE_SAMPLES = 500
+
+# So sánh các biến thể model (--report)
+VARIANTS_DIR = os.path.join(SCRIPT_DIR, '..', 'data', 'saved_model', 'variants')
+REPORT_SPARSITIES = (0.5, 0.8)
+ACCURACY_TOLERANCE = 0.002 # Độ chính xác (valid) được phép giảm tối đa so với model gốc
+ANSWER_THRESHOLD = 0.5     # Giống ngưỡng ô đáp án trong omr_engine/grader.py
+# Đo độ trễ: 1 phiếu (tất cả các ô của mẫu phiếu mặc định) và 1 lô lớn
+LATENCY_BATCH_SIZES = (len(omr_config.DEFAULT_TEMPLATE.sheet_xy), 4096)
+LATENCY_REPEATS = 10
+
 # --- 2. HÀM TẢI DỮ LIỆU ---
+def packed_batches(split_dir, batch_size, shuffle, seed=None):
+    """
+    Sinh các batch (ảnh, nhãn) từ các shard đã memory-map.
+    Chỉ các ô của batch hiện tại được đọc/sao chép; cả bộ dữ liệu không bao giờ phải nằm trọn trong RAM.
+    """
+    index, shards = load_packed_split(split_dir, fields=('crops', 'labels'))
+    rng = np.random.default_rng(seed)
+
+    def generator():
+        shard_order = rng.permutation(len(shards)) if shuffle else range(len(shards))
+        for shard_idx in shard_order:
+            crops, labels = shards[shard_idx]['crops'], shards[shard_idx]['labels']
+            order = rng.permutation(len(labels)) if shuffle else np.arange(len(labels))
+            for start in range(0, len(order), batch_size):
+                rows = order[start:start + batch_size]
+                if not shuffle:
+                    rows = slice(rows[0], rows[-1] + 1) # Đọc liền mạch: view của memmap, không sao chép
+                yield crops[rows], labels[rows]
+
+    crop_height, crop_width = index['crop_shape']
+    output_signature = (tf.TensorSpec(shape=(None, crop_height, crop_width), dtype=tf.uint8),
+                        tf.TensorSpec(shape=(None,), dtype=tf.uint8))
+    dataset = tf.data.Dataset.from_generator(generator, output_signature=output_signature)
+    # Báo trước số batch cho Keras (generator không tự biết độ dài)
+    num_batches = sum(-(-len(shard['labels']) // batch_size) for shard in shards)
+    return index, dataset.apply(tf.data.experimental.assert_cardinality(num_batches))
+
+def load_packed_data(train_dir, valid_dir):
+    """
+    Tải dữ liệu từ các shard đã đóng gói (processed_data/packed/train, processed_data/packed/valid).
+    """
+    print(f"Đang tải dữ liệu huấn luyện từ: {train_dir}")
+    print(f"Đang tải dữ liệu kiểm thử từ: {valid_dir}")
+
+    def to_model_input(images, labels):
+        # Giống omr_engine.preprocess.to_model_input: float32 (N, H, W, 1), KHÔNG resize
+        return tf.cast(images[..., tf.newaxis], tf.float32), tf.cast(labels, tf.int32)
+
+    datasets = []
+    for split_dir, shuffle in ((train_dir, True), (valid_dir, False)):
+        index, dataset = packed_batches(split_dir, BATCH_SIZE, shuffle)
+        print(f"Tìm thấy {index['count']} ô từ {len(index['sheets'])} phiếu ({len(index['shards'])} shard).")
+        if tuple(index['crop_shape']) != (IMG_HEIGHT, IMG_WIDTH):
+            raise ValueError(f"Ô trong {split_dir} có kích thước {tuple(index['crop_shape'])}, model cần "
+                             f"{(IMG_HEIGHT, IMG_WIDTH)}. Hãy chạy lại 'python prepare_data.py'.")
+        dataset = dataset.map(to_model_input, num_parallel_calls=tf.data.AUTOTUNE)
+        datasets.append(dataset.prefetch(buffer_size=tf.data.AUTOTUNE))
+    return tuple(datasets)
+
 def load_data_from_folders(train_dir, valid_dir):
     """
     Sử dụng tiện ích của Keras để tải dữ liệu từ các thư mục
@@ -57,38 +145,35 @@ def load_data_from_folders(train_dir, valid_dir):
     return train_dataset, validation_dataset
 
 # --- 3. HÀM XÂY DỰNG MODEL (CNN) ---
-def build_model(input_shape):
-    """Xây dựng một mô hình CNN đơn giản."""
+def build_model(input_shape, architecture=DEFAULT_ARCHITECTURE):
+    """
+    Xây dựng một mô hình CNN đơn giản theo kiến trúc `architecture` (xem ARCHITECTURES).
+    Chỉ dùng các lớp mà backend NumPy/TFLite hỗ trợ (Rescaling, Conv2D, MaxPooling2D, Flatten, Dense).
+    """
+    conv_filters, dense_units = ARCHITECTURES[architecture]
     
     inputs = Input(shape=input_shape)
     
     # Chuẩn hóa giá trị pixel từ [0, 255] về [0, 1]
     x = Rescaling(1./255)(inputs)
     
-    # Lớp Conv 1
-    x = Conv2D(32, (3, 3), activation='relu', padding='same')(x)
-    x = MaxPooling2D((2, 2))(x)
-    
-    # Lớp Conv 2
-    x = Conv2D(64, (3, 3), activation='relu', padding='same')(x)
-    x = MaxPooling2D((2, 2))(x)
-    
-    # Lớp Conv 3
-    x = Conv2D(128, (3, 3), activation='relu', padding='same')(x)
-    x = MaxPooling2D((2, 2))(x)
+    # Các lớp Conv (mỗi lớp giảm kích thước ảnh đi 1 nửa)
+    for filters in conv_filters:
+        x = Conv2D(filters, (3, 3), activation='relu', padding='same')(x)
+        x = MaxPooling2D((2, 2))(x)
     
     # Làm phẳng (Flatten)
     x = Flatten()(x)
     
     # Lớp Fully Connected
-    x = Dense(128, activation='relu')(x)
+    x = Dense(dense_units, activation='relu')(x)
     x = Dropout(0.5)(x) # Dropout để chống overfitting 
     
     # Lớp Output
     # Dùng 'sigmoid' vì đây là bài toán phân loại nhị phân (0 hoặc 1)
     outputs = Dense(1, activation='sigmoid')(x) 
     
-    model = Model(inputs=inputs, outputs=outputs)
+    model = Model(inputs=inputs, outputs=outputs, name=f"omr_bubble_{architecture}")
     
     # Biên dịch model
     # Dùng 'binary_crossentropy' vì đây là bài toán phân loại nhị phân
@@ -98,25 +183,381 @@ def build_model(input_shape):
     
     return model
 
-# --- 4. HÀM CHẠY CHÍNH ---
+# --- 4. TỈA TRỌNG SỐ (PRUNING) ---
+# Tự cài đặt thay cho tensorflow_model_optimization (gói này không hỗ trợ Keras 3).
+# Mỗi lớp Conv/Dense giữ lại (1 - sparsity) trọng số có |w| lớn nhất; các trọng số bị tỉa được giữ bằng 0
+# trong suốt quá trình huấn luyện lại. Model tỉa vẫn là model "dày" (cùng kiến trúc, cùng tốc độ),
+# nhưng file nén lại nhỏ hơn nhiều.
+def prunable_layers(model):
+    """Các lớp Conv2D/Dense trừ lớp đầu ra (lớp đầu ra rất nhỏ và nhạy)."""
+    return [layer for layer in model.layers if isinstance(layer, (Conv2D, Dense))][:-1]
+
+def magnitude_masks(model, sparsity):
+    """Mặt nạ 0/1 cho kernel của từng lớp: 0 ở `sparsity` phần trọng số có |w| nhỏ nhất."""
+    masks = []
+    for layer in prunable_layers(model):
+        kernel = np.abs(layer.kernel.numpy())
+        cutoff = np.quantile(kernel, sparsity)
+        masks.append((layer, (kernel > cutoff).astype(np.float32)))
+    return masks
+
+def apply_masks(masks):
+    for layer, mask in masks:
+        layer.kernel.assign(layer.kernel.numpy() * mask)
+
+class KeepPrunedWeights(tf.keras.callbacks.Callback):
+    """Sau mỗi batch, đặt lại về 0 các trọng số đã bị tỉa (optimizer sẽ cập nhật chúng)."""
+
+    def __init__(self, masks):
+        super().__init__()
+        self.masks = masks
+
+    def on_train_batch_end(self, batch, logs=None):
+        apply_masks(self.masks)
+
+def model_sparsity(model):
+    """Tỉ lệ trọng số bằng 0 trong các lớp có thể tỉa."""
+    kernels = [layer.kernel.numpy() for layer in prunable_layers(model)]
+    total = sum(kernel.size for kernel in kernels)
+    return sum(int((kernel == 0).sum()) for kernel in kernels) / total if total else 0.0
+
+def prune_model(model, sparsity, train_dataset, val_dataset=None, epochs=PRUNE_FINE_TUNE_EPOCHS):
+    """Tỉa `model` (tại chỗ) tới độ thưa `sparsity` (0 -> 1) rồi huấn luyện lại `epochs` epoch."""
+    if not 0 < sparsity < 1:
+        raise ValueError(f"Độ thưa phải nằm trong khoảng (0, 1), nhận: {sparsity}")
+    masks = magnitude_masks(model, sparsity)
+    apply_masks(masks)
+    print(f"\n--- TỈA TRỌNG SỐ: độ thưa {sparsity:.0%}, huấn luyện lại {epochs} epoch ---")
+    model.fit(train_dataset, epochs=epochs, validation_data=val_dataset, callbacks=[KeepPrunedWeights(masks)])
+    print(f"Độ thưa thực tế: {model_sparsity(model):.1%}")
+    return model
+
+# --- 5. HÀM XUẤT MODEL CHO SERVER ---
+def describe_layers(model):
+    """
+    Chuyển các lớp Keras thành mô tả JSON + trọng số cho backend NumPy
+    (omr_engine/inference_backends.py). Bỏ qua InputLayer và Dropout (không dùng khi suy luận).
+    """
+    architecture = []
+    weights = {}
+    for layer in model.layers:
+        if isinstance(layer, (tf.keras.layers.InputLayer, Dropout)):
+            continue
+        config = layer.get_config()
+        idx = len(architecture)
+        if isinstance(layer, Rescaling):
+            architecture.append({"type": "rescaling", "scale": float(config["scale"]), "offset": float(config["offset"])})
+        elif isinstance(layer, Conv2D):
+            architecture.append({"type": "conv2d", "activation": config["activation"],
+                                 "padding": config["padding"], "strides": list(config["strides"])})
+        elif isinstance(layer, MaxPooling2D):
+            if config["padding"] != "valid":
+                raise ValueError(f"Không xuất được lớp {layer.name}: chỉ hỗ trợ MaxPooling2D padding='valid'")
+            architecture.append({"type": "max_pooling2d", "pool_size": list(config["pool_size"]),
+                                 "strides": list(config["strides"])})
+        elif isinstance(layer, Flatten):
+            architecture.append({"type": "flatten"})
+        elif isinstance(layer, Dense):
+            architecture.append({"type": "dense", "activation": config["activation"]})
+        else:
+            raise ValueError(f"Không xuất được lớp {layer.name} ({type(layer).__name__}) sang backend NumPy")
+
+        if architecture[-1]["type"] in ("conv2d", "dense"):
+            kernel, bias = layer.get_weights()
+            weights[f"layer_{idx}_kernel"] = kernel.astype(np.float32)
+            weights[f"layer_{idx}_bias"] = bias.astype(np.float32)
+    return architecture, weights
+
+def export_numpy_model(model, save_path=NUMPY_SAVE_PATH):
+    """Xuất trọng số + kiến trúc ra file .npz cho backend NumPy."""
+    architecture, weights = describe_layers(model)
+    np.savez(save_path, architecture=np.array(json.dumps(architecture)), **weights)
+    print(f"✅ Đã xuất model NumPy tại: {save_path}")
+
+def representative_dataset(split_dir=PACKED_TRAIN_DIR, num_samples=REPRESENTATIVE_SAMPLES, seed=0):
+    """Ô mẫu (ngẫu nhiên, từ bộ train) cho bộ chuyển đổi TFLite khi lượng tử hóa int8."""
+    _, shards = load_packed_split(split_dir, fields=('crops',))
+    # Chọn chỉ số ngẫu nhiên trên toàn bộ dữ liệu rồi chỉ đọc đúng các dòng đó từ memmap của từng shard
+    # (không nạp cả bộ train vào RAM)
+    ends = np.cumsum([len(shard['crops']) for shard in shards])
+    rows = np.sort(np.random.default_rng(seed).permutation(int(ends[-1]))[:num_samples])
+    shard_ids = np.searchsorted(ends, rows, side='right')
+    starts = ends - [len(shard['crops']) for shard in shards]
+    crops = np.concatenate([shards[i]['crops'][rows[shard_ids == i] - starts[i]] for i in np.unique(shard_ids)])
+
+    def generator():
+        for crop in crops:
+            yield [crop[np.newaxis, ..., np.newaxis].astype(np.float32)]
+    return generator
+
+def export_tflite_model(model, save_path=TFLITE_SAVE_PATH, quantize=None):
+    """
+    Xuất model ra file .tflite cho backend TFLite.
+    quantize='int8': lượng tử hóa toàn bộ (trọng số, phép tính, đầu vào/đầu ra) về int8;
+    TFLiteBubbleModel tự lượng tử hóa đầu vào / giải lượng tử đầu ra nên grader không phải đổi gì.
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantize == 'int8':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset()
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+    elif quantize is not None:
+        raise ValueError(f"Kiểu lượng tử hóa không hợp lệ: '{quantize}' (chọn: int8)")
+    with open(save_path, 'wb') as f:
+        f.write(converter.convert())
+    print(f"✅ Đã xuất model TFLite{' (int8)' if quantize else ''} tại: {save_path}")
+
+def export_inference_artifacts(model, quantize=None):
+    """Xuất tất cả các bản gọn nhẹ (NumPy + TFLite) từ model Keras."""
+    export_numpy_model(model)
+    try:
+        export_tflite_model(model, quantize=quantize)
+    except Exception as e:
+        # TFLite là tùy chọn: backend NumPy vẫn dùng được
+        print(f"Cảnh báo: Không thể xuất model TFLite: {e}")
+
+# --- 6. SO SÁNH CÁC BIẾN THỂ MODEL (ĐỘ CHÍNH XÁC / KÍCH THƯỚC / ĐỘ TRỄ) ---
+# Mỗi kiến trúc được huấn luyện 1 lần, rồi tỉa dần theo từng độ thưa (tỉa tiếp từ biến thể trước).
+# Mỗi biến thể được xuất ra mọi định dạng và đo bằng đúng backend mà server dùng
+# (omr_engine/inference_backends.py): độ chính xác trên processed_data/valid, kích thước file,
+# độ trễ predict trên CPU. Kết quả ghi vào <thư mục biến thể>/report.json.
+
+# Định dạng (backend) -> đuôi file của 1 biến thể
+VARIANT_FILES = {
+    'keras': '.h5',
+    'numpy': '.npz',
+    'tflite': '.tflite',
+    'tflite_int8': '.int8.tflite',
+}
+
+def evaluate_accuracy(model, split_dir=PACKED_VALID_DIR, chunk_size=4096):
+    """Tỉ lệ ô phân loại đúng (ngưỡng ANSWER_THRESHOLD) trên 1 bộ dữ liệu đã đóng gói."""
+    _, shards = load_packed_split(split_dir, fields=('crops', 'labels'))
+    correct = total = 0
+    for shard in shards:
+        for start in range(0, len(shard['labels']), chunk_size):
+            crops = np.asarray(shard['crops'][start:start + chunk_size])
+            labels = np.asarray(shard['labels'][start:start + chunk_size])
+            probs = model.predict(to_model_input(crops), batch_size=len(crops), verbose=0).reshape(-1)
+            correct += int(((probs > ANSWER_THRESHOLD) == (labels == 1)).sum())
+            total += len(labels)
+    return correct / total if total else None
+
+def measure_latency(model, sample_crops, batch_size, repeats=LATENCY_REPEATS):
+    """Độ trễ trung vị (ms) của 1 lần predict với lô `batch_size` ô."""
+    batch = to_model_input(np.resize(sample_crops, (batch_size,) + sample_crops.shape[1:]))
+    model.predict(batch, batch_size=batch_size, verbose=0) # Khởi động (cấp phát bộ nhớ, dựng đồ thị)
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.predict(batch, batch_size=batch_size, verbose=0)
+        samples.append(time.perf_counter() - start)
+    return round(float(np.median(samples)) * 1000, 3)
+
+def file_sizes(path):
+    """(kích thước file, kích thước sau khi nén zlib) - model đã tỉa chỉ nhỏ đi khi nén."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    return len(data), len(zlib.compress(data, 9))
+
+def load_runtime(runtime, path):
+    from omr_engine.inference_backends import CompiledKerasModel, NumpyBubbleModel, TFLiteBubbleModel, load_keras_model
+    if runtime == 'keras':
+        return CompiledKerasModel(load_keras_model(path)) # Giống lúc chạy thật (model_loader)
+    if runtime == 'numpy':
+        return NumpyBubbleModel(path)
+    return TFLiteBubbleModel(path)
+
+def export_variant(model, name, out_dir):
+    """Lưu 1 biến thể ra mọi định dạng trong VARIANT_FILES. Trả về dict định dạng -> đường dẫn."""
+    paths = {runtime: os.path.join(out_dir, name + ext) for runtime, ext in VARIANT_FILES.items()}
+    model.save(paths['keras'])
+    export_numpy_model(model, paths['numpy'])
+    export_tflite_model(model, paths['tflite'])
+    export_tflite_model(model, paths['tflite_int8'], quantize='int8')
+    return paths
+
+def current_model_paths():
+    """Các file model đang dùng (data/saved_model), định dạng -> đường dẫn."""
+    paths = {runtime: path for runtime, path in (('keras', MODEL_SAVE_PATH), ('numpy', NUMPY_SAVE_PATH),
+                                                  ('tflite', TFLITE_SAVE_PATH)) if os.path.exists(path)}
+    if 'tflite' in paths and load_runtime('tflite', paths['tflite'])._input['dtype'] != np.float32:
+        paths['tflite_int8'] = paths.pop('tflite')
+    return paths
+
+def evaluate_variant(name, paths, sample_crops, info):
+    """Đo từng định dạng của 1 biến thể. Trả về danh sách dòng báo cáo."""
+    rows = []
+    for runtime, path in paths.items():
+        model = load_runtime(runtime, path)
+        size, compressed = file_sizes(path)
+        row = dict(info, variant=name, runtime=runtime, file=os.path.relpath(path, SCRIPT_DIR),
+                   accuracy=round(evaluate_accuracy(model), 6), size_bytes=size, compressed_bytes=compressed,
+                   latency_ms={str(batch_size): measure_latency(model, sample_crops, batch_size)
+                               for batch_size in LATENCY_BATCH_SIZES})
+        print(f"  {name:<20} {runtime:<12} độ chính xác {row['accuracy']:.4f}  "
+              f"{size / 1024:8.1f} KB (nén: {compressed / 1024:7.1f} KB)  "
+              + "  ".join(f"lô {b}: {ms} ms" for b, ms in row['latency_ms'].items()))
+        rows.append(row)
+    return rows
+
+def recommend_variant(rows, baseline_accuracy, tolerance=ACCURACY_TOLERANCE, by='size'):
+    """
+    Trong các biến thể có độ chính xác >= baseline - tolerance:
+    by='size': biến thể nhỏ nhất (sau khi nén), ngang nhau thì nhanh hơn; by='latency': biến thể nhanh nhất (lô 1 phiếu).
+    """
+    eligible = [row for row in rows if row['accuracy'] >= baseline_accuracy - tolerance]
+    if not eligible:
+        return None
+    first_batch = str(LATENCY_BATCH_SIZES[0])
+    if by == 'latency':
+        return min(eligible, key=lambda row: (row['latency_ms'][first_batch], row['compressed_bytes']))
+    return min(eligible, key=lambda row: (row['compressed_bytes'], row['latency_ms'][first_batch]))
+
+def compare_variants(train_dataset, val_dataset, architectures=tuple(ARCHITECTURES), sparsities=REPORT_SPARSITIES,
+                     epochs=EPOCHS, tolerance=ACCURACY_TOLERANCE, out_dir=VARIANTS_DIR):
+    """Huấn luyện + đo tất cả các biến thể, ghi report.json. Trả về báo cáo (dict)."""
+    os.makedirs(out_dir, exist_ok=True)
+    input_shape = (IMG_HEIGHT, IMG_WIDTH, IMG_CHANNELS)
+    _, valid_shards = load_packed_split(PACKED_VALID_DIR, fields=('crops',))
+    sample_crops = np.asarray(valid_shards[0]['crops'][:max(LATENCY_BATCH_SIZES)])
+
+    rows = []
+    print("\n--- ĐO MODEL ĐANG DÙNG ---")
+    rows += evaluate_variant('current', current_model_paths(), sample_crops,
+                             {'architecture': None, 'sparsity': None, 'params': None, 'nonzero_params': None})
+
+    for architecture in architectures:
+        print(f"\n--- HUẤN LUYỆN KIẾN TRÚC '{architecture}' ({epochs} epoch) ---")
+        model = build_model(input_shape, architecture)
+        model.fit(train_dataset, epochs=epochs, validation_data=val_dataset, verbose=2)
+        params = model.count_params()
+        for sparsity in (0.0,) + tuple(sorted(sparsities)):
+            if sparsity:
+                prune_model(model, sparsity, train_dataset, val_dataset)
+            name = architecture if not sparsity else f"{architecture}_pruned{int(round(sparsity * 100))}"
+            zeros = sum(int((layer.kernel.numpy() == 0).sum()) for layer in prunable_layers(model))
+            paths = export_variant(model, name, out_dir)
+            rows += evaluate_variant(name, paths, sample_crops,
+                                     {'architecture': architecture, 'sparsity': round(model_sparsity(model), 4),
+                                      'params': params, 'nonzero_params': params - zeros})
+
+    # Mốc so sánh: kiến trúc gốc vừa huấn luyện (cùng dữ liệu, cùng số epoch), nếu không có thì model đang dùng
+    baseline = next((row for row in rows if row['variant'] == DEFAULT_ARCHITECTURE and row['runtime'] == 'keras'),
+                    next((row for row in rows if row['variant'] == 'current'), None))
+    if baseline is None:
+        raise ValueError("Không có model gốc để so sánh: hãy thêm kiến trúc 'standard' hoặc huấn luyện model trước.")
+    recommended = recommend_variant(rows, baseline['accuracy'], tolerance)
+    fastest = recommend_variant(rows, baseline['accuracy'], tolerance, by='latency')
+
+    report = {
+        'config': {'architectures': list(architectures), 'sparsities': list(sparsities), 'epochs': epochs,
+                   'tolerance': tolerance, 'answer_threshold': ANSWER_THRESHOLD,
+                   'latency_batch_sizes': list(LATENCY_BATCH_SIZES), 'latency_repeats': LATENCY_REPEATS,
+                   'tensorflow': tf.__version__, 'cpu_count': os.cpu_count()},
+        'baseline': {'variant': baseline['variant'], 'runtime': baseline['runtime'], 'accuracy': baseline['accuracy']},
+        'recommended': recommended,
+        'fastest': fastest, # int8 không phải lúc nào cũng nhanh hơn trên CPU x86
+        'variants': rows,
+    }
+    report_path = os.path.join(out_dir, 'report.json')
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    print(f"\n✅ Đã ghi báo cáo tại: {report_path}")
+    print(f"Mốc so sánh: {baseline['variant']} ({baseline['runtime']}), độ chính xác {baseline['accuracy']:.4f}")
+    if recommended:
+        print(f"Đề xuất: {recommended['variant']} ({recommended['runtime']}), độ chính xác "
+              f"{recommended['accuracy']:.4f}, {recommended['compressed_bytes'] / 1024:.1f} KB (nén)")
+        print(f"Nhanh nhất: {fastest['variant']} ({fastest['runtime']}), "
+              f"{fastest['latency_ms'][str(LATENCY_BATCH_SIZES[0])]} ms / lô {LATENCY_BATCH_SIZES[0]} ô")
+    else:
+        print(f"Không có biến thể nào giữ được độ chính xác trong ngưỡng {tolerance}.")
+    return report
+
+def promote_variant(row):
+    """Chép biến thể được đề xuất vào data/saved_model (thay cho model đang dùng)."""
+    if row['variant'] == 'current':
+        print("Model đang dùng đã là lựa chọn tốt nhất: không thay đổi gì.")
+        return
+    base = os.path.join(SCRIPT_DIR, row['file'])[:-len(VARIANT_FILES[row['runtime']])]
+    tflite_ext = VARIANT_FILES['tflite_int8' if row['runtime'] == 'tflite_int8' else 'tflite']
+    for ext, target in ((VARIANT_FILES['keras'], MODEL_SAVE_PATH), (VARIANT_FILES['numpy'], NUMPY_SAVE_PATH),
+                        (tflite_ext, TFLITE_SAVE_PATH)):
+        shutil.copyfile(base + ext, target)
+        print(f"✅ {base + ext} -> {target}")
+    if row['runtime'] != 'keras':
+        backend = 'tflite' if row['runtime'].startswith('tflite') else row['runtime']
+        print(f"Đặt OMR_MODEL_BACKEND={backend} để server dùng đúng định dạng đã đo.")
+
+# --- 7. HÀM CHẠY CHÍNH ---
 def main():
+    parser = argparse.ArgumentParser(description="Huấn luyện model nhận diện bong bóng.")
+    parser.add_argument("--export-only", action="store_true",
+                        help="Không huấn luyện, chỉ xuất model .h5 đã lưu sang .npz/.tflite")
+    parser.add_argument("--data-format", choices=("packed", "png"), default="packed",
+                        help="packed: đọc shard .npy (mặc định); png: đọc cây thư mục PNG (prepare_data.py --png)")
+    parser.add_argument("--arch", choices=tuple(ARCHITECTURES), default=DEFAULT_ARCHITECTURE,
+                        help=f"Kiến trúc CNN (mặc định: {DEFAULT_ARCHITECTURE})")
+    parser.add_argument("--epochs", type=int, default=EPOCHS, help=f"Số epoch huấn luyện (mặc định: {EPOCHS})")
+    parser.add_argument("--prune", type=float, default=None, metavar="SPARSITY",
+                        help="Tỉa trọng số tới độ thưa này (0 -> 1, vd: 0.8) rồi huấn luyện lại")
+    parser.add_argument("--quantize", choices=("int8",), default=None,
+                        help="Xuất file .tflite đã lượng tử hóa int8")
+    parser.add_argument("--report", action="store_true",
+                        help="Huấn luyện và so sánh mọi biến thể (kiến trúc x độ thưa x định dạng), ghi report.json")
+    parser.add_argument("--report-archs", nargs="+", choices=tuple(ARCHITECTURES), default=tuple(ARCHITECTURES),
+                        help="Các kiến trúc đưa vào báo cáo")
+    parser.add_argument("--report-sparsities", nargs="*", type=float, default=REPORT_SPARSITIES,
+                        help="Các độ thưa đưa vào báo cáo")
+    parser.add_argument("--report-dir", default=VARIANTS_DIR, help="Thư mục lưu các biến thể + report.json")
+    parser.add_argument("--tolerance", type=float, default=ACCURACY_TOLERANCE,
+                        help="Độ chính xác được phép giảm tối đa so với model gốc")
+    parser.add_argument("--promote", action="store_true",
+                        help="(với --report) Thay model đang dùng bằng biến thể được đề xuất")
+    args = parser.parse_args()
+
+    if args.export_only:
+        model = tf.keras.models.load_model(MODEL_SAVE_PATH)
+        export_inference_artifacts(model, quantize=args.quantize)
+        return
+
     # Bước 1: Tải dữ liệu
     try:
-        train_dataset, val_dataset = load_data_from_folders(TRAIN_DIR, VALID_DIR)
+        if args.data_format == "packed":
+            train_dataset, val_dataset = load_packed_data(PACKED_TRAIN_DIR, PACKED_VALID_DIR)
+        else:
+            train_dataset, val_dataset = load_data_from_folders(TRAIN_DIR, VALID_DIR)
     except Exception as e:
         print(f"\n--- LỖI TẢI DỮ LIỆU ---")
         print(f"Lỗi: {e}")
         print("\nVui lòng kiểm tra lại các đường dẫn:")
-        print(f"TRAIN_DIR: {TRAIN_DIR}")
-        print(f"VALID_DIR: {VALID_DIR}")
-        print("Hãy chắc chắn rằng bên trong 2 thư mục này có 2 thư mục con '0' và '1'.")
+        if args.data_format == "packed":
+            print(f"PACKED_TRAIN_DIR: {PACKED_TRAIN_DIR}")
+            print(f"PACKED_VALID_DIR: {PACKED_VALID_DIR}")
+            print("Hãy chạy 'python prepare_data.py' để tạo dữ liệu đóng gói.")
+        else:
+            print(f"TRAIN_DIR: {TRAIN_DIR}")
+            print(f"VALID_DIR: {VALID_DIR}")
+            print("Hãy chắc chắn rằng bên trong 2 thư mục này có 2 thư mục con '0' và '1'.")
         return
 
     print("--- Đã tải dữ liệu thành công ---")
+
+    if args.report:
+        if args.data_format != "packed":
+            print("Báo cáo cần dữ liệu đóng gói: hãy chạy 'python prepare_data.py'.")
+            return
+        report = compare_variants(train_dataset, val_dataset, args.report_archs, args.report_sparsities,
+                                  args.epochs, args.tolerance, args.report_dir)
+        if args.promote and report['recommended']:
+            promote_variant(report['recommended'])
+        return
     
     # Bước 2: Xây dựng model
     input_shape = (IMG_HEIGHT, IMG_WIDTH, IMG_CHANNELS)
-    model = build_model(input_shape)
+    model = build_model(input_shape, args.arch)
     
     print("\n--- Cấu trúc Model ---")
     model.summary() # In ra cấu trúc của model
@@ -125,9 +566,11 @@ def main():
     print("\n--- BẮT ĐẦU HUẤN LUYỆN ---")
     history = model.fit(
         train_dataset,
-        epochs=EPOCHS,
+        epochs=args.epochs,
         validation_data=val_dataset
     )
+    if args.prune:
+        prune_model(model, args.prune, train_dataset, val_dataset)
     
     # Bước 4: Lưu model
     print("\n--- HUẤN LUYỆN HOÀN TẤT ---")
@@ -137,6 +580,9 @@ def main():
     
     model.save(MODEL_SAVE_PATH)
     print(f"\n✅ Model đã được lưu tại: {MODEL_SAVE_PATH}")
+
+    # Bước 5: Xuất bản gọn nhẹ cho server
+    export_inference_artifacts(model, quantize=args.quantize)
     print("Bạn đã sẵn sàng cho bước tiếp theo: xây dựng file 'grader.py'!")
 
 # --- Chạy script ---